@@ -0,0 +1,169 @@
+# Scaling benchmark for each stage of the encoder, on synthetic queries
+#
+# python -m benchmark.bench_encoder --shapes chain,diamond --ctes 10,50,100 --output bench.json
+# python -m benchmark.bench_encoder --baseline bench.json   # exits non zero on a regression
+
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import click
+
+sys.path.append(".")
+from benchmark.generator import SHAPES, CACHED_PREFIX, synthetic_query
+from src.source import Source, ParsedSource, DecomposedSource, EncodedSource
+from src.bq.data_source import DataSource
+
+STAGES = ["parsed_source", "decomposed_source", "encoded_from_str", "data_source", "compact_data_source"]
+
+
+def stage(name: str, source_str: str, prefix: str) -> Tuple[Callable[[], object], Callable[[object], object]]:
+    # (setup, run) for a stage. setup is neither timed nor traced. the parse cache lives within one encode run,
+    # so every stage starts cold
+    def nothing():
+        return None
+
+    def parse():
+        return ParsedSource(Source(source_str))
+
+    def encode():
+        return EncodedSource.from_str(source_str, prefix=prefix)
+
+    def apply_all(encoded_source):
+        data_source = DataSource(encoded_source)
+        data_source.apply_dependency_first(lambda hashed, sql: None)
+        return data_source
+
+    def compact(_):
+        # what a long running service keeps per query: the data source alone, encoder and parse cache released
+        return DataSource(EncodedSource.from_str(source_str, prefix=prefix))
+
+    stages = {
+        "parsed_source": (nothing, lambda _: parse()),
+        "decomposed_source": (parse, lambda parsed_source: DecomposedSource(parsed_source)),
+        "encoded_from_str": (nothing, lambda _: encode()),
+        "data_source": (encode, apply_all),
+        "compact_data_source": (nothing, compact),
+    }
+    return stages[name]
+
+
+def measure(setup: Callable[[], object], run: Callable[[object], object], repeat: int = 3) -> Dict[str, float]:
+    # best wall time of untraced runs, then peak memory of one traced run and what its result still holds
+    seconds = None
+    for _ in range(repeat):
+        arg = setup()
+        gc.collect()
+        tic = time.perf_counter()
+        run(arg)
+        toc = time.perf_counter()
+        seconds = toc - tic if seconds is None else min(seconds, toc - tic)
+    arg = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = run(arg)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        gc.collect()
+        retained_bytes = tracemalloc.get_traced_memory()[0]
+        del result
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak_bytes, "retained_bytes": retained_bytes}
+
+
+def run_benchmarks(shapes: List[str],
+                   cte_counts: List[int],
+                   body_sizes: List[int],
+                   cached_fractions: List[float],
+                   width: int = 3,
+                   repeat: int = 3,
+                   stages: List[str] = STAGES) -> List[Dict]:
+    results = []
+    for shape in shapes:
+        for ctes in cte_counts:
+            for body_size in body_sizes:
+                for cached_fraction in cached_fractions:
+                    source_str = synthetic_query(shape, ctes, body_size=body_size,
+                                                 cached_fraction=cached_fraction, width=width)
+                    for stage_name in stages:
+                        setup, run = stage(stage_name, source_str, CACHED_PREFIX)
+                        result = {
+                            "shape": shape,
+                            "ctes": ctes,
+                            "body_size": body_size,
+                            "cached_fraction": cached_fraction,
+                            "stage": stage_name,
+                            "source_bytes": len(source_str),
+                        }
+                        result.update(measure(setup, run, repeat=repeat))
+                        results.append(result)
+                        print(format_result(result), flush=True)
+    return results
+
+
+def result_key(result: Dict) -> Tuple:
+    return result["shape"], result["ctes"], result["body_size"], result["cached_fraction"], result["stage"]
+
+
+def format_result(result: Dict) -> str:
+    return (f"{result['shape']:>8} ctes:{result['ctes']:>5} body:{result['body_size']:>3} "
+            f"cached:{result['cached_fraction']:>4.2f} {result['stage']:>18} "
+            f"{result['seconds'] * 1000:>10.1f} ms {result['peak_bytes'] / 2 ** 20:>9.2f} MiB peak "
+            f"{result['retained_bytes'] / 2 ** 20:>9.2f} MiB retained")
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    # a regression is any measured stage slower or bigger than its baseline by more than the tolerance
+    baseline_by_key = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_key.get(result_key(result))
+        if previous is None:
+            continue
+        for metric in ["seconds", "peak_bytes", "retained_bytes"]:
+            if previous.get(metric) and result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{format_result(result)} {metric} was {previous[metric]:.4g}, "
+                                   f"now {result[metric]:.4g}")
+    return regressions
+
+
+def csv_list(cast: Callable[[str], object]) -> Callable:
+    def parse(ctx, param, value: str) -> List:
+        return [cast(item) for item in value.split(",") if item]
+    return parse
+
+
+@click.command()
+@click.option("--shapes", help=f"comma separated shapes out of {','.join(SHAPES)}", default=",".join(SHAPES),
+              callback=csv_list(str))
+@click.option("--ctes", help="comma separated CTE counts", default="10,50,100", callback=csv_list(int))
+@click.option("--body-sizes", help="comma separated extra columns per CTE", default="5", callback=csv_list(int))
+@click.option("--cached-fractions", help="comma separated fractions of cached_ nodes", default="0,0.5,1",
+              callback=csv_list(float))
+@click.option("--width", help="CTEs per layer of a diamond", type=int, default=3)
+@click.option("--repeat", help="timed runs per measurement, the best is kept", type=int, default=3)
+@click.option("--stages", help=f"comma separated stages out of {','.join(STAGES)}", default=",".join(STAGES),
+              callback=csv_list(str))
+@click.option("--output", help="write results as json to this file", default=None)
+@click.option("--baseline", help="json results to compare against", default=None)
+@click.option("--tolerance", help="allowed relative slowdown against the baseline", type=float, default=0.25)
+def main(shapes, ctes, body_sizes, cached_fractions, width, repeat, stages, output, baseline, tolerance):
+    results = run_benchmarks(shapes, ctes, body_sizes, cached_fractions, width=width, repeat=repeat, stages=stages)
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if baseline:
+        with open(baseline, "r") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
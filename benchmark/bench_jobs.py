@@ -0,0 +1,137 @@
+# Simulated cache builds as jobs on a fake job backend, one blocked thread per job against asyncio submission
+# with collective polling
+#
+# python -m benchmark.bench_jobs --shapes fan_in --ctes 200 --max-in-flight 50,200
+# python -m benchmark.bench_jobs --seconds 0.5 --latency 0.02   # slower jobs, a round trip per call
+
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import click
+
+sys.path.append(".")
+from benchmark.generator import SHAPES, synthetic_query
+from benchmark.bench_encoder import csv_list
+from benchmark.bench_scheduler import node_durations
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend
+from src.bq.data_source import DataSource
+from src.bq.jobs import AsyncDependencyExecutor, FakeJobBackend
+
+MODES = ["threads", "async"]
+
+
+class PeakThreads:
+    # samples the number of live threads while in use
+
+    def __init__(self, interval: float = 0.001):
+        self._interval = interval
+        self._peak = threading.active_count()
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self) -> "PeakThreads":
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._done.wait(self._interval):
+            # not counting the sampler itself
+            self._peak = max(self._peak, threading.active_count() - 1)
+
+    def peak(self) -> int:
+        return self._peak
+
+
+def simulate(encoded_source: EncodedSource,
+             durations: Dict[str, float],
+             mode: str,
+             max_in_flight: int,
+             latency: float = 0.0,
+             poll_interval: float = 0.01) -> Dict:
+    # builds every node into an empty backend, through jobs that take their simulated duration
+    backend = InMemoryBackend()
+    jobs = FakeJobBackend(backend, duration=durations.get, latency=latency)
+    datasource = DataSource(encoded_source, backend)
+    tic = time.perf_counter()
+    with PeakThreads() as threads:
+        if mode == "threads":
+            # what a blocking query_job.result() amounts to: every running job holds a thread polling it alone
+            def build(hashed: str, sql: str) -> int:
+                job_id = jobs.submit(hashed, sql)
+                while True:
+                    time.sleep(poll_interval)
+                    state = jobs.poll([job_id])[job_id]
+                    if state.done():
+                        return state.bytes_processed()
+
+            datasource.build(max_in_flight=max_in_flight, build_func=build)
+        elif mode == "async":
+            executor = AsyncDependencyExecutor(jobs, max_in_flight=max_in_flight, poll_interval=poll_interval,
+                                               max_poll_interval=poll_interval * 10)
+            datasource.build_async(executor)
+        else:
+            raise ValueError(f"unknown mode:{mode}, expected one of {MODES}")
+    return {
+        "seconds": time.perf_counter() - tic,
+        "peak_threads": threads.peak(),
+        "submits": jobs.submits(),
+        "polls": jobs.polls(),
+    }
+
+
+def run_simulations(shapes: List[str],
+                    cte_counts: List[int],
+                    max_in_flights: List[int],
+                    modes: List[str] = MODES,
+                    seconds: float = 0.05,
+                    seed: int = 0,
+                    latency: float = 0.0) -> List[Dict]:
+    results = []
+    for shape in shapes:
+        for ctes in cte_counts:
+            encoded_source = EncodedSource.from_str(synthetic_query(shape, ctes))
+            durations = node_durations(DataSource(encoded_source).plan(), seconds, seed=seed)
+            for max_in_flight in max_in_flights:
+                for mode in modes:
+                    result = {
+                        "shape": shape,
+                        "ctes": ctes,
+                        "max_in_flight": max_in_flight,
+                        "mode": mode,
+                        **simulate(encoded_source, durations, mode, max_in_flight, latency=latency),
+                    }
+                    results.append(result)
+                    print(format_result(result), flush=True)
+    return results
+
+
+def format_result(result: Dict) -> str:
+    return (f"{result['shape']:>8} ctes:{result['ctes']:>5} in flight:{result['max_in_flight']:>4} "
+            f"{result['mode']:>8} {result['seconds'] * 1000:>9.1f} ms "
+            f"peak threads:{result['peak_threads']:>4} submits:{result['submits']:>5} polls:{result['polls']:>6}")
+
+
+@click.command()
+@click.option("--shapes", help=f"comma separated shapes out of {','.join(SHAPES)}", default="fan_in",
+              callback=csv_list(str))
+@click.option("--ctes", help="comma separated CTE counts", default="200", callback=csv_list(int))
+@click.option("--max-in-flight", help="comma separated limits on concurrent jobs", default="50,200",
+              callback=csv_list(int))
+@click.option("--modes", help=f"comma separated modes out of {','.join(MODES)}", default=",".join(MODES),
+              callback=csv_list(str))
+@click.option("--seconds", help="typical simulated job seconds per node", type=float, default=0.05)
+@click.option("--seed", help="seed for the simulated durations", type=int, default=0)
+@click.option("--latency", help="seconds injected into every submit and poll", type=float, default=0.0)
+def main(shapes, ctes, max_in_flight, modes, seconds, seed, latency):
+    run_simulations(shapes, ctes, max_in_flight, modes=modes, seconds=seconds, seed=seed, latency=latency)
+
+
+if __name__ == '__main__':
+    main()
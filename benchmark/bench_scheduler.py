@@ -0,0 +1,131 @@
+# Simulated cache builds against a local backend, comparing ready node orderings
+#
+# python -m benchmark.bench_scheduler --shapes lopsided,diamond --ctes 20 --max-in-flight 2,4
+# python -m benchmark.bench_scheduler --backend sqlite --latency 0.005   # real tables, injected round trips
+
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+import click
+
+sys.path.append(".")
+from benchmark.generator import SHAPES, synthetic_query
+from benchmark.bench_encoder import csv_list
+from src.source import EncodedSource
+from src.bq.backend import CacheBackend, InMemoryBackend, SQLiteBackend
+from src.bq.data_source import DataSource
+from src.bq.plan import ExecutionPlan
+from src.bq.scheduler import NodeStats, CriticalPathScheduler, critical_path
+
+POLICIES = ["fifo", "critical_path", "critical_path_cold"]
+
+BACKENDS = ["memory", "sqlite"]
+
+
+def node_durations(plan: ExecutionPlan, seconds: float, seed: int = 0) -> Dict[str, float]:
+    # every node takes between half and twice seconds, the same on every run for a seed
+    generator = random.Random(seed)
+    return {hashed: seconds * generator.uniform(0.5, 2.0) for hashed in plan.hashes()}
+
+
+def scheduler_for(policy: str, plan: ExecutionPlan, durations: Dict[str, float]) -> CriticalPathScheduler:
+    if policy == "fifo":
+        return None
+    stats = NodeStats(":memory:")
+    if policy == "critical_path":
+        for hashed, seconds in durations.items():
+            stats.record(hashed, seconds, 0)
+        return CriticalPathScheduler(stats)
+    if policy == "critical_path_cold":
+        # nothing recorded yet: the fake dry run reports bytes proportional to the sql, one byte a second
+        return CriticalPathScheduler(stats, backend=InMemoryBackend(dry_run_bytes=len), default_bytes_per_second=1)
+    raise ValueError(f"unknown policy:{policy}, expected one of {POLICIES}")
+
+
+def make_backend(name: str, latency: float = 0.0) -> CacheBackend:
+    if name == "memory":
+        return InMemoryBackend(latency=latency)
+    if name == "sqlite":
+        return SQLiteBackend(":memory:", latency=latency)
+    raise ValueError(f"unknown backend:{name}, expected one of {BACKENDS}")
+
+
+def simulate(encoded_source: EncodedSource,
+             durations: Dict[str, float],
+             policy: str,
+             max_in_flight: int,
+             backend: CacheBackend) -> float:
+    # wall seconds to build every node into an empty backend, each build also sleeping its simulated duration
+    datasource = DataSource(encoded_source, backend)
+
+    def build(hashed: str, sql: str) -> int:
+        time.sleep(durations[hashed])
+        return backend.materialize(hashed, sql)
+
+    scheduler = scheduler_for(policy, datasource.plan(), durations)
+    tic = time.perf_counter()
+    datasource.build(max_in_flight=max_in_flight, scheduler=scheduler, build_func=build)
+    return time.perf_counter() - tic
+
+
+def run_simulations(shapes: List[str],
+                    cte_counts: List[int],
+                    max_in_flights: List[int],
+                    policies: List[str] = POLICIES,
+                    seconds: float = 0.01,
+                    seed: int = 0,
+                    backend: str = "memory",
+                    latency: float = 0.0) -> List[Dict]:
+    results = []
+    for shape in shapes:
+        for ctes in cte_counts:
+            encoded_source = EncodedSource.from_str(synthetic_query(shape, ctes))
+            datasource = DataSource(encoded_source)
+            durations = node_durations(datasource.plan(), seconds, seed=seed)
+            lower_bound = max(critical_path(datasource.plan(), durations).values())
+            for max_in_flight in max_in_flights:
+                for policy in policies:
+                    result = {
+                        "shape": shape,
+                        "ctes": ctes,
+                        "max_in_flight": max_in_flight,
+                        "policy": policy,
+                        "backend": backend,
+                        "seconds": simulate(encoded_source, durations, policy, max_in_flight,
+                                            make_backend(backend, latency)),
+                        "critical_path_seconds": lower_bound,
+                        "serial_seconds": sum(durations.values()),
+                    }
+                    results.append(result)
+                    print(format_result(result), flush=True)
+    return results
+
+
+def format_result(result: Dict) -> str:
+    return (f"{result['shape']:>8} ctes:{result['ctes']:>5} in flight:{result['max_in_flight']:>3} "
+            f"{result['policy']:>18} {result['seconds'] * 1000:>9.1f} ms "
+            f"(critical path {result['critical_path_seconds'] * 1000:.1f} ms, "
+            f"serial {result['serial_seconds'] * 1000:.1f} ms)")
+
+
+@click.command()
+@click.option("--shapes", help=f"comma separated shapes out of {','.join(SHAPES)}", default="lopsided,diamond",
+              callback=csv_list(str))
+@click.option("--ctes", help="comma separated CTE counts", default="20", callback=csv_list(int))
+@click.option("--max-in-flight", help="comma separated limits on concurrent builds", default="2,4",
+              callback=csv_list(int))
+@click.option("--policies", help=f"comma separated policies out of {','.join(POLICIES)}", default=",".join(POLICIES),
+              callback=csv_list(str))
+@click.option("--seconds", help="typical simulated build seconds per node", type=float, default=0.01)
+@click.option("--seed", help="seed for the simulated durations", type=int, default=0)
+@click.option("--backend", help=f"backend to build in, one of {','.join(BACKENDS)}", default="memory")
+@click.option("--latency", help="seconds injected into every backend call", type=float, default=0.0)
+def main(shapes, ctes, max_in_flight, policies, seconds, seed, backend, latency):
+    run_simulations(shapes, ctes, max_in_flight, policies=policies, seconds=seconds, seed=seed,
+                    backend=backend, latency=latency)
+
+
+if __name__ == '__main__':
+    main()
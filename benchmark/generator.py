@@ -0,0 +1,62 @@
+# Synthetic queries of configurable shape for benchmarking the encoder
+
+from typing import List
+
+SHAPES = ["chain", "fan_out", "fan_in", "diamond", "lopsided"]
+
+CACHED_PREFIX = "cached_"
+
+
+def node_names(ctes: int, cached_fraction: float = 0.0) -> List[str]:
+    # spread the cached nodes evenly so any fraction gives the same layout on every run
+    names = []
+    for idx in range(ctes):
+        cached = int((idx + 1) * cached_fraction) > int(idx * cached_fraction)
+        names.append(f"{CACHED_PREFIX if cached else ''}node_{idx}")
+    return names
+
+
+def node_parents(shape: str, ctes: int, width: int = 3) -> List[List[int]]:
+    # indices of the CTEs each CTE reads from
+    if shape == "chain":
+        return [[idx - 1] if idx else [] for idx in range(ctes)]
+    if shape == "fan_out":
+        return [[0] if idx else [] for idx in range(ctes)]
+    if shape == "fan_in":
+        return [[] for _ in range(ctes - 1)] + [list(range(ctes - 1))]
+    if shape == "diamond":
+        # layers of width CTEs, each reading every CTE in the layer before it
+        return [[] if idx < width else list(range((idx // width - 1) * width, idx // width * width))
+                for idx in range(ctes)]
+    if shape == "lopsided":
+        # independent leaves first, then a chain over the last half: the chain is the critical path
+        chain_start = ctes - ctes // 2
+        return [[idx - 1] if idx > chain_start else [] for idx in range(ctes)]
+    raise ValueError(f"unknown shape:{shape}, expected one of {SHAPES}")
+
+
+def cte_body(idx: int, parents: List[str], body_size: int) -> str:
+    # plain aggregate sql, valid in BigQuery as well as embedded databases
+    if parents:
+        source = " UNION ALL ".join(f"SELECT value FROM {parent}" for parent in parents)
+        columns = [f"SUM(value) + {idx} AS value"] + \
+                  [f"SUM(value) * {column + 1} + {idx} AS col_{column}" for column in range(body_size)]
+        return "SELECT\n      " + ",\n      ".join(columns) + f"\n    FROM ({source})"
+    columns = [f"{idx} AS value"] + [f"{idx * (column + 1)} AS col_{column}" for column in range(body_size)]
+    return "SELECT\n      " + ",\n      ".join(columns)
+
+
+def synthetic_query(shape: str,
+                    ctes: int,
+                    body_size: int = 1,
+                    cached_fraction: float = 0.0,
+                    width: int = 3) -> str:
+    names = node_names(ctes, cached_fraction)
+    parents = node_parents(shape, ctes, width=width)
+    definitions = [f"{names[idx]} AS (\n    {cte_body(idx, [names[parent] for parent in parents[idx]], body_size)}\n  )"
+                   for idx in range(ctes)]
+    # the final select reads every CTE nothing else reads
+    read = {parent for node_parents_ in parents for parent in node_parents_}
+    sinks = [names[idx] for idx in range(ctes) if idx not in read]
+    final = " UNION ALL ".join(f"SELECT value FROM {sink}" for sink in sinks)
+    return "WITH\n  " + ",\n  ".join(definitions) + "\n" + final
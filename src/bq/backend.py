@@ -0,0 +1,569 @@
+# where cache tables live and get built. one implementation per warehouse, plus local ones that need no cloud
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+import hashlib
+import itertools
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from typing import Iterable, Set, Callable, Dict, Optional, Tuple
+
+import google.api_core.exceptions
+from google.cloud import bigquery
+sys.path.append(".")
+from src.sqlite_store import SQLiteStore
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# errors that lose track of a job rather than fail it, after which it is looked up again and watched on
+TRANSIENT_ERRORS = (google.api_core.exceptions.ServerError,
+                    google.api_core.exceptions.TooManyRequests,
+                    ConnectionError)
+
+
+# the same for every submitter of hashed within one bucket of bucket_seconds, so that concurrent runs and retries
+# all land on one job. later attempts get their own id, for when the job of the bucket failed
+def job_id_for(dataset: str, hashed: str, bucket_seconds: float = 3600, now: float = None, attempt: int = 0) -> str:
+    bucket = int((time.time() if now is None else now) // bucket_seconds)
+    job_id = f"bq_cache_{dataset}_{hashed}_{bucket}"
+    return f"{job_id}_{attempt}" if attempt else job_id
+
+
+# bigquery drops a table itself once it expires
+def _expiration_options(ttl: float = None) -> str:
+    if not ttl:
+        return ""
+    expires = datetime.fromtimestamp(time.time() + ttl, tz=timezone.utc)
+    return f" OPTIONS (expiration_timestamp = TIMESTAMP '{expires.isoformat()}')"
+
+
+class TableMetadata:
+
+    def __init__(self,
+                 hashed: str,
+                 num_bytes: int,
+                 num_rows: int,
+                 created: float,
+                 modified: float,
+                 expires: Optional[float] = None):
+        self._hashed = hashed
+        self._num_bytes = num_bytes
+        self._num_rows = num_rows
+        self._created = created
+        self._modified = modified
+        self._expires = expires
+
+    def __repr__(self) -> str:
+        return f"TableMetadata(hashed={self._hashed!r}, num_bytes={self._num_bytes}, num_rows={self._num_rows})"
+
+    def hashed(self) -> str:
+        return self._hashed
+
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def num_rows(self) -> int:
+        return self._num_rows
+
+    # seconds since the epoch
+    def created(self) -> float:
+        return self._created
+
+    def modified(self) -> float:
+        return self._modified
+
+    # None when the table never expires
+    def expires(self) -> Optional[float]:
+        return self._expires
+
+
+class CacheBackend(ABC):
+    # every method may be called from several executor threads at once
+
+    # which of hashes already have a cache table, answered in as few round trips as the backend allows
+    @abstractmethod
+    def existing(self, hashes: Iterable[str]) -> Set[str]:
+        pass
+
+    # whether one hash has a cache table, for callers that poll a single table. backends whose existing scans
+    # every table override it with a direct lookup
+    def exists(self, hashed: str) -> bool:
+        return hashed in self.existing([hashed])
+
+    # run sql into the cache table named hashed, returning the bytes it processed.
+    # with a ttl the table expires that many seconds later, and is then gone as if deleted
+    @abstractmethod
+    def materialize(self, hashed: str, sql: str, ttl: float = None) -> int:
+        pass
+
+    # bytes sql would process, without running it or creating anything
+    @abstractmethod
+    def dry_run(self, sql: str) -> int:
+        pass
+
+    # metadata of the hashes that have a cache table, in one batched call. every cache table without hashes
+    @abstractmethod
+    def metadata(self, hashes: Iterable[str] = None) -> Dict[str, TableMetadata]:
+        pass
+
+    # drop the cache tables of hashes, missing ones are ignored
+    @abstractmethod
+    def delete(self, hashes: Iterable[str]):
+        pass
+
+    # a version of each base table that changes whenever its data does, in one batched call. names are as the
+    # queries write them, and tables that cannot be found are left out
+    @abstractmethod
+    def table_versions(self, tables: Iterable[str]) -> Dict[str, str]:
+        pass
+
+    # the partition dates of cache tables, in one batched call. columns maps each hash to the DATE column its
+    # table is partitioned by. missing tables are left out
+    @abstractmethod
+    def partitions(self, columns: Dict[str, str]) -> Dict[str, Set[date]]:
+        pass
+
+    # like materialize, into a table partitioned by the DATE column. with since, only the partitions from since on
+    # are recomputed and replaced in one atomic step, and the older ones are kept as they are. returns the bytes
+    # processed and whether any row of the table changed, which a whole build always counts as
+    @abstractmethod
+    def materialize_partitioned(self,
+                                hashed: str,
+                                sql: str,
+                                column: str,
+                                since: date = None,
+                                ttl: float = None) -> Tuple[int, bool]:
+        pass
+
+
+class BigQueryBackend(CacheBackend):
+
+    def __init__(self,
+                 client: bigquery.Client,
+                 dataset: str,
+                 page_size: int = 1000,
+                 max_in_flight: int = 8,
+                 bucket_seconds: float = 3600,
+                 max_retries: int = 5):
+        self._client = client
+        self._dataset = dataset
+        self._dataset_id = f"{client.project}.{dataset}"
+        self._page_size = page_size
+        self._max_in_flight = max_in_flight
+        self._bucket_seconds = bucket_seconds
+        self._max_retries = max_retries
+
+    def client(self) -> bigquery.Client:
+        return self._client
+
+    def dataset(self) -> str:
+        return self._dataset
+
+    # a single list_tables pass over the dataset, one request per page_size tables, instead of a get_table per hash
+    def existing(self, hashes: Iterable[str]) -> Set[str]:
+        wanted = set(hashes)
+        if not wanted:
+            return set()
+        found = {table.table_id for table in self._client.list_tables(self._dataset, page_size=self._page_size)
+                 if table.table_id in wanted}
+        logger.info(f"{len(found)} of {len(wanted)} hashes cached in dataset:{self._dataset}")
+        return found
+
+    # waits on the job of start, looking it up again after transient errors instead of running it twice
+    def materialize(self, hashed: str, sql: str, ttl: float = None) -> int:
+        query_job = self.start(hashed, sql, ttl)
+        for retry in itertools.count(1):
+            try:
+                query_job.result()
+                break
+            except TRANSIENT_ERRORS as error:
+                if retry > self._max_retries:
+                    raise
+                logger.warning(f"lost track of job:{query_job.job_id} for hash:{hashed} ({error}), watching it again")
+                time.sleep(min(2 ** retry, 60))
+                # a job that failed meanwhile raises its own error from result()
+                query_job = self._client.get_job(query_job.job_id)
+        return query_job.total_bytes_processed or 0
+
+    # submit the job building hashed, without waiting on it. its id is job_id_for the hash, so when another run
+    # or an earlier try already submitted it this bucket, that job is attached to instead. a job of the bucket
+    # that failed, or whose table is gone since, does not count and the next attempt is submitted
+    def start(self, hashed: str, sql: str, ttl: float = None) -> bigquery.QueryJob:
+        options = _expiration_options(ttl)
+        job_config = bigquery.QueryJobConfig(
+            default_dataset=self._dataset_id,
+            priority=bigquery.QueryPriority.INTERACTIVE)
+        now = time.time()
+        for attempt in itertools.count():
+            job_id = job_id_for(self._dataset, hashed, self._bucket_seconds, now=now, attempt=attempt)
+            try:
+                return self._client.query(
+                    f"CREATE OR REPLACE TABLE `{self._dataset_id}.{hashed}`{options} AS {sql}",
+                    job_config=job_config,
+                    job_id=job_id)
+            except google.api_core.exceptions.Conflict:
+                query_job = self._client.get_job(job_id)
+            if query_job.state != "DONE":
+                logger.info(f"attaching to job:{job_id} already building hash:{hashed}")
+                return query_job
+            if not query_job.error_result and self.exists(hashed):
+                return query_job
+
+    # a single script job. a refresh is one MERGE that deletes and reinserts from since on, so concurrent or
+    # repeated refreshes never duplicate rows, between fingerprints of those partitions taken before and after
+    def materialize_partitioned(self,
+                                hashed: str,
+                                sql: str,
+                                column: str,
+                                since: date = None,
+                                ttl: float = None) -> Tuple[int, bool]:
+        target = f"`{self._dataset_id}.{hashed}`"
+        options = _expiration_options(ttl)
+        job_config = bigquery.QueryJobConfig(
+            default_dataset=self._dataset_id,
+            priority=bigquery.QueryPriority.INTERACTIVE)
+        if since is None:
+            query_job = self._client.query(
+                f"CREATE OR REPLACE TABLE {target} PARTITION BY {column}{options} AS {sql}", job_config=job_config)
+            query_job.result()
+            return query_job.total_bytes_processed or 0, True
+        # identical rows are counted, so that a duplicate appearing or going away is a change too
+        fingerprint = (f"(SELECT BIT_XOR(FARM_FINGERPRINT(FORMAT('%d:%d', row_fingerprint, copies))) FROM "
+                       f"(SELECT FARM_FINGERPRINT(TO_JSON_STRING(t)) AS row_fingerprint, COUNT(*) AS copies "
+                       f"FROM {target} t WHERE {column} >= @since GROUP BY row_fingerprint))")
+        script = (f"DECLARE before INT64 DEFAULT {fingerprint};\n"
+                  f"MERGE {target} t USING (SELECT * FROM ({sql}) WHERE {column} >= @since) s ON FALSE "
+                  f"WHEN NOT MATCHED BY SOURCE AND t.{column} >= @since THEN DELETE "
+                  f"WHEN NOT MATCHED THEN INSERT ROW;\n")
+        if options:
+            script += f"ALTER TABLE {target} SET{options};\n"
+        script += f"SELECT before IS DISTINCT FROM {fingerprint} AS changed;"
+        job_config.query_parameters = [bigquery.ScalarQueryParameter("since", "DATE", since)]
+        query_job = self._client.query(script, job_config=job_config)
+        changed = next(iter(query_job.result())).changed
+        return query_job.total_bytes_processed or 0, changed
+
+    # one query on the dataset's INFORMATION_SCHEMA.PARTITIONS view, which lists the partitions of every table
+    def partitions(self, columns: Dict[str, str]) -> Dict[str, Set[date]]:
+        if not columns:
+            return {}
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("hashes", "STRING", list(columns))])
+        rows = self._client.query(
+            f"SELECT table_name, partition_id FROM `{self._dataset_id}.INFORMATION_SCHEMA.PARTITIONS` "
+            "WHERE table_name IN UNNEST(@hashes)", job_config=job_config).result()
+        found = {}
+        for row in rows:
+            dates = found.setdefault(row.table_name, set())
+            # __NULL__ and __UNPARTITIONED__ hold rows without a date
+            if row.partition_id and row.partition_id.isdigit():
+                dates.add(datetime.strptime(row.partition_id, "%Y%m%d").date())
+        return found
+
+    # last modified times from the __TABLES__ meta table of every dataset read, all in one query
+    def table_versions(self, tables: Iterable[str]) -> Dict[str, str]:
+        by_dataset = {}
+        for table in set(tables):
+            parts = table.split(".")
+            if len(parts) == 2:
+                parts.insert(0, self._client.project)
+            if len(parts) != 3:
+                continue
+            by_dataset.setdefault(f"{parts[0]}.{parts[1]}", {}).setdefault(parts[2], []).append(table)
+        if not by_dataset:
+            return {}
+        selects = []
+        parameters = []
+        for index, (dataset_id, table_ids) in enumerate(sorted(by_dataset.items())):
+            selects.append(f"SELECT '{dataset_id}' AS dataset_id, table_id, last_modified_time "
+                           f"FROM `{dataset_id}.__TABLES__` WHERE table_id IN UNNEST(@tables_{index})")
+            parameters.append(bigquery.ArrayQueryParameter(f"tables_{index}", "STRING", sorted(table_ids)))
+        rows = self._client.query(" UNION ALL ".join(selects),
+                                  job_config=bigquery.QueryJobConfig(query_parameters=parameters)).result()
+        return {table: str(row.last_modified_time)
+                for row in rows for table in by_dataset[row.dataset_id][row.table_id]}
+
+    # one get_table, rather than the list_tables pass of existing
+    def exists(self, hashed: str) -> bool:
+        try:
+            self._client.get_table(f"{self._dataset_id}.{hashed}")
+            return True
+        except google.api_core.exceptions.NotFound:
+            return False
+
+    def dry_run(self, sql: str) -> int:
+        job_config = bigquery.QueryJobConfig(
+            dry_run=True,
+            use_query_cache=False,
+            default_dataset=self._dataset_id)
+        return self._client.query(sql, job_config=job_config).total_bytes_processed
+
+    # one query on the dataset's __TABLES__ meta table, which is free
+    def metadata(self, hashes: Iterable[str] = None) -> Dict[str, TableMetadata]:
+        query = ("SELECT table_id, size_bytes, row_count, creation_time, last_modified_time "
+                 f"FROM `{self._dataset_id}.__TABLES__`")
+        job_config = bigquery.QueryJobConfig()
+        if hashes is not None:
+            hashes = list(hashes)
+            if not hashes:
+                return {}
+            query += " WHERE table_id IN UNNEST(@hashes)"
+            job_config.query_parameters = [bigquery.ArrayQueryParameter("hashes", "STRING", hashes)]
+        rows = self._client.query(query, job_config=job_config).result()
+        return {row.table_id: TableMetadata(row.table_id,
+                                            row.size_bytes,
+                                            row.row_count,
+                                            row.creation_time / 1000,
+                                            row.last_modified_time / 1000)
+                for row in rows}
+
+    def delete(self, hashes: Iterable[str]):
+        with ThreadPoolExecutor(max_workers=self._max_in_flight) as pool:
+            list(pool.map(lambda hashed: self._client.delete_table(f"{self._dataset_id}.{hashed}", not_found_ok=True),
+                          hashes))
+
+
+class InMemoryBackend(CacheBackend):
+    # tables are only names with metadata. materialize and dry_run size the sql with dry_run_bytes, its length
+    # unless given, and every call sleeps latency seconds outside the lock, like a round trip would
+
+    def __init__(self,
+                 tables: Iterable[str] = (),
+                 dry_run_bytes: Callable[[str], int] = len,
+                 latency: float = 0.0):
+        self._dry_run_bytes = dry_run_bytes
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._calls = 0
+        now = time.time()
+        self._tables = {hashed: TableMetadata(hashed, 0, 0, now, now) for hashed in tables}
+        self._partitions = {}
+        self._table_versions = {}
+
+    def add(self, hashed: str, num_bytes: int = 0, ttl: float = None, partitions: Iterable[date] = ()):
+        now = time.time()
+        with self._lock:
+            self._tables[hashed] = TableMetadata(hashed, num_bytes, 0, now, now, now + ttl if ttl else None)
+            self._partitions[hashed] = set(partitions)
+
+    def calls(self) -> int:
+        return self._calls
+
+    def _round_trip(self):
+        now = time.time()
+        with self._lock:
+            self._calls += 1
+            expired = [hashed for hashed, table in self._tables.items() if table.expires() and table.expires() <= now]
+            for hashed in expired:
+                del self._tables[hashed]
+        if self._latency:
+            time.sleep(self._latency)
+
+    def existing(self, hashes: Iterable[str]) -> Set[str]:
+        self._round_trip()
+        with self._lock:
+            return self._tables.keys() & set(hashes)
+
+    def materialize(self, hashed: str, sql: str, ttl: float = None) -> int:
+        self._round_trip()
+        num_bytes = self._dry_run_bytes(sql)
+        self.add(hashed, num_bytes, ttl=ttl)
+        return num_bytes
+
+    def dry_run(self, sql: str) -> int:
+        return self._dry_run_bytes(sql)
+
+    def metadata(self, hashes: Iterable[str] = None) -> Dict[str, TableMetadata]:
+        self._round_trip()
+        with self._lock:
+            if hashes is None:
+                return dict(self._tables)
+            return {hashed: self._tables[hashed] for hashed in hashes if hashed in self._tables}
+
+    def delete(self, hashes: Iterable[str]):
+        self._round_trip()
+        with self._lock:
+            for hashed in hashes:
+                self._tables.pop(hashed, None)
+                self._partitions.pop(hashed, None)
+
+    # base tables only exist as the versions given here
+    def set_table_version(self, table: str, version: str):
+        with self._lock:
+            self._table_versions[table] = version
+
+    def table_versions(self, tables: Iterable[str]) -> Dict[str, str]:
+        self._round_trip()
+        with self._lock:
+            return {table: self._table_versions[table] for table in tables if table in self._table_versions}
+
+    def partitions(self, columns: Dict[str, str]) -> Dict[str, Set[date]]:
+        self._round_trip()
+        with self._lock:
+            return {hashed: set(self._partitions.get(hashed, ())) for hashed in columns if hashed in self._tables}
+
+    # the sql is never run, so an append only marks the partitions from since until today as present, and always
+    # counts as a change
+    def materialize_partitioned(self,
+                                hashed: str,
+                                sql: str,
+                                column: str,
+                                since: date = None,
+                                ttl: float = None) -> Tuple[int, bool]:
+        self._round_trip()
+        num_bytes = self._dry_run_bytes(sql)
+        with self._lock:
+            partitions = self._partitions.get(hashed, set()) if since is not None else set()
+        if since is not None:
+            partitions |= {date.fromordinal(day) for day in range(since.toordinal(), date.today().toordinal() + 1)}
+        self.add(hashed, num_bytes, ttl=ttl, partitions=partitions)
+        return num_bytes, True
+
+
+class SQLiteBackend(SQLiteStore, CacheBackend):
+    # cache tables in an embedded database file, to run whole pipelines offline. the sql must be valid in sqlite,
+    # which reads the backtick quoted hash references as plain identifiers. latency is slept on every call and
+    # build_latency on top of it for every materialize, both outside the lock, so concurrency still pays off
+
+    def __init__(self, path: str = ":memory:", latency: float = 0.0, build_latency: float = 0.0):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS cache_tables ("
+            " hash TEXT PRIMARY KEY,"
+            " num_bytes INTEGER NOT NULL,"
+            " num_rows INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " modified REAL NOT NULL,"
+            " expires REAL)"])
+        self._latency = latency
+        self._build_latency = build_latency
+
+    def connection(self) -> sqlite3.Connection:
+        return self._connection
+
+    def _round_trip(self, seconds: float = 0.0):
+        if self._latency + seconds:
+            time.sleep(self._latency + seconds)
+        with self._lock:
+            expired = [row[0] for row in self._connection.execute(
+                "SELECT hash FROM cache_tables WHERE expires <= ?", (time.time(),))]
+            self._drop(expired)
+
+    def existing(self, hashes: Iterable[str]) -> Set[str]:
+        self._round_trip()
+        return {row[0] for row in self._select_in("SELECT hash FROM cache_tables WHERE hash IN ({})", hashes)}
+
+    def materialize(self, hashed: str, sql: str, ttl: float = None) -> int:
+        self._round_trip(self._build_latency)
+        with self._lock:
+            read = self._read_bytes(sql)
+            self._connection.execute(f'DROP TABLE IF EXISTS "{hashed}"')
+            self._connection.execute(f'CREATE TABLE "{hashed}" AS {sql}')
+            num_rows, num_bytes = self._size(hashed)
+            now = time.time()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO cache_tables (hash, num_bytes, num_rows, created, modified, expires) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (hashed, num_bytes, num_rows, now, now, now + ttl if ttl else None))
+            self._connection.commit()
+        return read
+
+    # dates are compared as ISO text, which is how sqlite stores them. the refreshed rows are compared as
+    # multisets before and after
+    def materialize_partitioned(self,
+                                hashed: str,
+                                sql: str,
+                                column: str,
+                                since: date = None,
+                                ttl: float = None) -> Tuple[int, bool]:
+        if since is None:
+            return self.materialize(hashed, sql, ttl), True
+        self._round_trip(self._build_latency)
+        refreshed = f'SELECT * FROM "{hashed}" WHERE "{column}" >= ?'
+        with self._lock:
+            read = self._read_bytes(sql)
+            before = Counter(self._connection.execute(refreshed, (since.isoformat(),)))
+            self._connection.execute(f'DELETE FROM "{hashed}" WHERE "{column}" >= ?', (since.isoformat(),))
+            self._connection.execute(f'INSERT INTO "{hashed}" SELECT * FROM ({sql}) WHERE "{column}" >= ?',
+                                     (since.isoformat(),))
+            changed = before != Counter(self._connection.execute(refreshed, (since.isoformat(),)))
+            num_rows, num_bytes = self._size(hashed)
+            now = time.time()
+            self._connection.execute(
+                "UPDATE cache_tables SET num_bytes = ?, num_rows = ?, modified = ?, expires = ? WHERE hash = ?",
+                (num_bytes, num_rows, now, now + ttl if ttl else None, hashed))
+            self._connection.commit()
+        return read, changed
+
+    def partitions(self, columns: Dict[str, str]) -> Dict[str, Set[date]]:
+        self._round_trip()
+        found = {}
+        with self._lock:
+            existing = {row[0] for row in self._connection.execute("SELECT hash FROM cache_tables")}
+            for hashed, column in columns.items():
+                if hashed in existing:
+                    found[hashed] = {date.fromisoformat(str(row[0])[:10]) for row in self._connection.execute(
+                        f'SELECT DISTINCT "{column}" FROM "{hashed}" WHERE "{column}" IS NOT NULL')}
+        return found
+
+    # sqlite keeps no modification times, so the version is a digest of the rows in storage order. that reads
+    # every base table whole, which is fine for the local data this backend is meant for
+    def table_versions(self, tables: Iterable[str]) -> Dict[str, str]:
+        self._round_trip()
+        versions = {}
+        with self._lock:
+            for table in set(tables):
+                quoted = ".".join(f'"{part}"' for part in table.split("."))
+                hasher = hashlib.sha1()
+                try:
+                    for row in self._connection.execute(f"SELECT * FROM {quoted}"):
+                        hasher.update(repr(row).encode('utf-8'))
+                except sqlite3.OperationalError:
+                    continue
+                versions[table] = hasher.hexdigest()
+        return versions
+
+    # read bytes are the sizes of the cache tables the query reads
+    def _read_bytes(self, sql: str) -> int:
+        return self._connection.execute(
+            "SELECT COALESCE(SUM(num_bytes), 0) FROM cache_tables WHERE instr(?, hash) > 0", (sql,)).fetchone()[0]
+
+    def _size(self, hashed: str) -> Tuple[int, int]:
+        columns = [row[1] for row in self._connection.execute(f'PRAGMA table_info("{hashed}")')]
+        row_bytes = " + ".join(f'LENGTH(QUOTE("{column}"))' for column in columns) or "0"
+        return self._connection.execute(
+            f'SELECT COUNT(*), COALESCE(SUM({row_bytes}), 0) FROM "{hashed}"').fetchone()
+
+    # sqlite validates the query without running it, and the estimate is what the cache tables it reads hold
+    def dry_run(self, sql: str) -> int:
+        self._round_trip()
+        with self._lock:
+            self._connection.execute(f"EXPLAIN {sql}")
+            return self._read_bytes(sql)
+
+    def metadata(self, hashes: Iterable[str] = None) -> Dict[str, TableMetadata]:
+        self._round_trip()
+        columns = "hash, num_bytes, num_rows, created, modified, expires"
+        if hashes is None:
+            with self._lock:
+                rows = self._connection.execute(f"SELECT {columns} FROM cache_tables").fetchall()
+        else:
+            rows = self._select_in(f"SELECT {columns} FROM cache_tables WHERE hash IN ({{}})", hashes)
+        return {row[0]: TableMetadata(*row) for row in rows}
+
+    def delete(self, hashes: Iterable[str]):
+        self._round_trip()
+        with self._lock:
+            self._drop(hashes)
+
+    def _drop(self, hashes: Iterable[str]):
+        for hashed in hashes:
+            self._connection.execute(f'DROP TABLE IF EXISTS "{hashed}"')
+            self._connection.execute("DELETE FROM cache_tables WHERE hash = ?", (hashed,))
+        self._connection.commit()
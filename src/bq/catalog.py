@@ -0,0 +1,238 @@
+# what each cache table is, where it came from and how much it has been reused. written on every build and hit
+from abc import ABC, abstractmethod
+import logging
+import os
+import sys
+import time
+from typing import Dict, Iterable, List, Optional
+
+from google.cloud import bigquery
+sys.path.append(".")
+from src.sqlite_store import SQLiteStore
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.expanduser("~"), ".bq_shared_cache", "catalog.db")
+
+CATALOG_TABLE = "_catalog"
+
+CATALOG_COLUMNS = ["hash", "alias", "source", "num_bytes", "num_rows", "bytes_processed", "build_seconds",
+                   "created", "last_used", "hits"]
+
+
+class CatalogEntry:
+
+    def __init__(self,
+                 hashed: str,
+                 alias: Optional[str],
+                 source: str,
+                 num_bytes: int,
+                 num_rows: int,
+                 bytes_processed: int,
+                 build_seconds: float,
+                 created: float,
+                 last_used: float,
+                 hits: int = 0):
+        self._hashed = hashed
+        self._alias = alias
+        self._source = source
+        self._num_bytes = num_bytes
+        self._num_rows = num_rows
+        self._bytes_processed = bytes_processed
+        self._build_seconds = build_seconds
+        self._created = created
+        self._last_used = last_used
+        self._hits = hits
+
+    def __repr__(self) -> str:
+        return f"CatalogEntry(hashed={self._hashed!r}, alias={self._alias!r}, hits={self._hits})"
+
+    def hashed(self) -> str:
+        return self._hashed
+
+    def alias(self) -> Optional[str]:
+        return self._alias
+
+    # the encoded sql that produced the table
+    def source(self) -> str:
+        return self._source
+
+    def num_bytes(self) -> int:
+        return self._num_bytes
+
+    def num_rows(self) -> int:
+        return self._num_rows
+
+    def bytes_processed(self) -> int:
+        return self._bytes_processed
+
+    def build_seconds(self) -> float:
+        return self._build_seconds
+
+    def created(self) -> float:
+        return self._created
+
+    def last_used(self) -> float:
+        return self._last_used
+
+    def hits(self) -> int:
+        return self._hits
+
+    def row(self) -> tuple:
+        return (self._hashed, self._alias, self._source, self._num_bytes, self._num_rows, self._bytes_processed,
+                self._build_seconds, self._created, self._last_used, self._hits)
+
+
+class Catalog(ABC):
+
+    # insert or replace the entries of freshly built tables, hit counts start over
+    @abstractmethod
+    def record_builds(self, entries: Iterable[CatalogEntry]):
+        pass
+
+    # refresh when hashes were last used, counting a hit for each unless hit is False
+    @abstractmethod
+    def touch(self, hashes: Iterable[str], hit: bool = True, now: float = None):
+        pass
+
+    # entries of the hashes that have one, in one lookup. every entry without hashes
+    @abstractmethod
+    def entries(self, hashes: Iterable[str] = None) -> Dict[str, CatalogEntry]:
+        pass
+
+    @abstractmethod
+    def forget(self, hashes: Iterable[str]):
+        pass
+
+    def last_used(self, hashes: Iterable[str]) -> Dict[str, float]:
+        return {hashed: entry.last_used() for hashed, entry in self.entries(hashes).items()}
+
+    def hits(self, hashes: Iterable[str]) -> Dict[str, int]:
+        return {hashed: entry.hits() for hashed, entry in self.entries(hashes).items()}
+
+    # sizes and reuse of the given tables, or of the whole cache. saved bytes are what the hits did not reprocess
+    def totals(self, hashes: Iterable[str] = None) -> Dict[str, float]:
+        entries = self.entries(hashes).values()
+        return {
+            "tables": len(entries),
+            "num_bytes": sum(entry.num_bytes() for entry in entries),
+            "hits": sum(entry.hits() for entry in entries),
+            "build_seconds": sum(entry.build_seconds() for entry in entries),
+            "bytes_processed": sum(entry.bytes_processed() for entry in entries),
+            "bytes_saved": sum(entry.hits() * entry.bytes_processed() for entry in entries),
+        }
+
+
+class SQLiteCatalog(SQLiteStore, Catalog):
+    # local stand-in, one indexed table in a sqlite file
+
+    def __init__(self, path: str = DEFAULT_CATALOG_PATH):
+        super().__init__(path, [
+            f"CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} ("
+            " hash TEXT PRIMARY KEY,"
+            " alias TEXT,"
+            " source TEXT NOT NULL,"
+            " num_bytes INTEGER NOT NULL,"
+            " num_rows INTEGER NOT NULL,"
+            " bytes_processed INTEGER NOT NULL,"
+            " build_seconds REAL NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " hits INTEGER NOT NULL)",
+            f"CREATE INDEX IF NOT EXISTS {CATALOG_TABLE}_last_used ON {CATALOG_TABLE} (last_used)"])
+
+    def record_builds(self, entries: Iterable[CatalogEntry]):
+        with self._lock:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO {CATALOG_TABLE} ({', '.join(CATALOG_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(CATALOG_COLUMNS))})",
+                [entry.row() for entry in entries])
+            self._connection.commit()
+
+    def touch(self, hashes: Iterable[str], hit: bool = True, now: float = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._connection.executemany(
+                f"UPDATE {CATALOG_TABLE} SET last_used = ?, hits = hits + ? WHERE hash = ?",
+                [(now, int(hit), hashed) for hashed in hashes])
+            self._connection.commit()
+
+    def entries(self, hashes: Iterable[str] = None) -> Dict[str, CatalogEntry]:
+        select = f"SELECT {', '.join(CATALOG_COLUMNS)} FROM {CATALOG_TABLE}"
+        if hashes is None:
+            with self._lock:
+                rows = self._connection.execute(select).fetchall()
+        else:
+            rows = self._select_in(f"{select} WHERE hash IN ({{}})", hashes)
+        return {row[0]: CatalogEntry(*row) for row in rows}
+
+    def forget(self, hashes: Iterable[str]):
+        with self._lock:
+            self._connection.executemany(f"DELETE FROM {CATALOG_TABLE} WHERE hash = ?",
+                                         [(hashed,) for hashed in hashes])
+            self._connection.commit()
+
+
+class BigQueryCatalog(Catalog):
+    # a table next to the cache tables, so every user of the dataset shares it. each call is one batched statement
+
+    def __init__(self, client: bigquery.Client, dataset: str, table: str = CATALOG_TABLE):
+        self._client = client
+        self._table_id = f"{client.project}.{dataset}.{table}"
+        self._client.query(
+            f"CREATE TABLE IF NOT EXISTS `{self._table_id}` ("
+            " hash STRING NOT NULL, alias STRING, source STRING NOT NULL,"
+            " num_bytes INT64 NOT NULL, num_rows INT64 NOT NULL, bytes_processed INT64 NOT NULL,"
+            " build_seconds FLOAT64 NOT NULL, created FLOAT64 NOT NULL, last_used FLOAT64 NOT NULL,"
+            " hits INT64 NOT NULL)"
+            " CLUSTER BY hash").result()
+
+    def record_builds(self, entries: Iterable[CatalogEntry]):
+        rows = [dict(zip(CATALOG_COLUMNS, entry.row())) for entry in entries]
+        if not rows:
+            return
+        updates = ", ".join(f"{column} = built.{column}" for column in CATALOG_COLUMNS[1:])
+        self._run(
+            f"MERGE `{self._table_id}` catalog USING UNNEST(@rows) built ON catalog.hash = built.hash "
+            f"WHEN MATCHED THEN UPDATE SET {updates} "
+            f"WHEN NOT MATCHED THEN INSERT ROW",
+            [bigquery.ArrayQueryParameter("rows", "STRUCT", [
+                bigquery.StructQueryParameter(None, *[
+                    bigquery.ScalarQueryParameter(column, kind, row[column])
+                    for column, kind in zip(CATALOG_COLUMNS, ["STRING", "STRING", "STRING", "INT64", "INT64", "INT64",
+                                                              "FLOAT64", "FLOAT64", "FLOAT64", "INT64"])])
+                for row in rows])])
+
+    def touch(self, hashes: Iterable[str], hit: bool = True, now: float = None):
+        hashes = list(hashes)
+        if hashes:
+            self._run(f"UPDATE `{self._table_id}` SET last_used = @now, hits = hits + @hit "
+                      "WHERE hash IN UNNEST(@hashes)",
+                      [bigquery.ScalarQueryParameter("now", "FLOAT64", time.time() if now is None else now),
+                       bigquery.ScalarQueryParameter("hit", "INT64", int(hit)),
+                       bigquery.ArrayQueryParameter("hashes", "STRING", hashes)])
+
+    def entries(self, hashes: Iterable[str] = None) -> Dict[str, CatalogEntry]:
+        query = f"SELECT {', '.join(CATALOG_COLUMNS)} FROM `{self._table_id}`"
+        parameters = []
+        if hashes is not None:
+            hashes = list(hashes)
+            if not hashes:
+                return {}
+            query += " WHERE hash IN UNNEST(@hashes)"
+            parameters.append(bigquery.ArrayQueryParameter("hashes", "STRING", hashes))
+        return {row["hash"]: CatalogEntry(*[row[column] for column in CATALOG_COLUMNS])
+                for row in self._run(query, parameters)}
+
+    def forget(self, hashes: Iterable[str]):
+        hashes = list(hashes)
+        if hashes:
+            self._run(f"DELETE FROM `{self._table_id}` WHERE hash IN UNNEST(@hashes)",
+                      [bigquery.ArrayQueryParameter("hashes", "STRING", hashes)])
+
+    def _run(self, query: str, parameters: List) -> List:
+        job_config = bigquery.QueryJobConfig(query_parameters=parameters)
+        return list(self._client.query(query, job_config=job_config).result())
@@ -1,11 +1,21 @@
 # abstraction data interface for BQ queries
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import logging
 import time
 import sys
-from typing import Tuple, Union, Dict, List, Set, Callable, Any
+from typing import Tuple, Union, Dict, List, Set, Callable, Any, Iterable
 sys.path.append(".")
-from src.source import EncodedSource
+from src.source import EncodedSource, EncodedNode
+from src.freshness import versioned_nodes
+from src.bq.backend import CacheBackend
+from src.bq.catalog import Catalog, CatalogEntry
+from src.bq.executor import DependencyExecutor
+from src.bq.incremental import IncrementalSpec, incremental_hashes, refresh_since
+from src.bq.jobs import AsyncDependencyExecutor, JobError, JobState
+from src.bq.lease import LeasedBuilder
+from src.bq.lineage import LineageIndex, lineage_edges
+from src.bq.plan import ExecutionPlan
+from src.bq.scheduler import CriticalPathScheduler
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s %(name)s %(message)s',
@@ -24,42 +34,242 @@ class DataSource:
     def __init__(
             self,
             source: EncodedSource,
-            #client: bigquery.client
+            backend: CacheBackend = None,
+            versioned: bool = False,
+            stable: Iterable[str] = ()
     ):
-        self._source = source
-        #self._client = client
-        self._encoded_sources = self._get_dependencies()
+        # keep only the compact nodes, so the encoder and its token trees can be released
+        self._source = source.node()
+        self._backend = backend
+        self._encoded_sources = self._get_dependencies(source)
+        self._plan = None
+        if versioned:
+            # the base tables every node reads are versioned in one backend call and folded into the hashes,
+            # except for the nodes aliased in stable
+            if backend is None:
+                raise ValueError("DataSource needs a backend to version base tables")
+            rekeyed = versioned_nodes(self._source, self._encoded_sources, backend.table_versions, stable=stable)
+            self._source = rekeyed[self._source.hashed()]
+            self._encoded_sources = {node.hashed(): node for node in rekeyed.values()}
 
         # def build(self):
     #     unmets = self._fetch_ummet_dependencies()
     #     if unmets:
 
-    def encoded_source(self):
+    def backend(self) -> CacheBackend:
+        return self._backend
+
+    def encoded_source(self) -> EncodedNode:
         return self._source
 
-    def all_encoded_sources(self) -> Dict[str, EncodedSource]:
+    def all_encoded_sources(self) -> Dict[str, EncodedNode]:
         return self._encoded_sources
 
-    def apply_dependency_first(self, apply_func: Callable[[str, str], bool]):
-        _apply_dependency_first(self._source, apply_func)
+    # the unique nodes reachable from the root, dependencies first, computed once
+    def plan(self) -> ExecutionPlan:
+        if self._plan is None:
+            self._plan = ExecutionPlan.from_root(self._source, self._encoded_sources)
+        return self._plan
+
+    # apply_func once per unique node, dependencies first
+    def apply_dependency_first(self, apply_func: Callable[[str, str], bool]) -> ExecutionPlan:
+        plan = self.plan()
+        for node in plan:
+            apply_func(node.hashed(), node.sql())
+        return plan
+
+    # each unique node once, as soon as its dependencies are done, up to max_in_flight at a time. results by hash.
+    # with only, just those hashes are applied and everything else is taken as already built.
+    # with a scheduler, ready nodes on the longest remaining path start first
+    def apply_concurrently(self,
+                           apply_func: Callable[[str, str], Any],
+                           max_in_flight: int = 8,
+                           only: Iterable[str] = None,
+                           scheduler: CriticalPathScheduler = None) -> Dict[str, Any]:
+        plan = self.plan() if only is None else self.plan().subset(only)
+        priorities = scheduler.priorities(plan) if scheduler is not None else None
+        return DependencyExecutor(max_in_flight).run(plan, apply_func, priorities=priorities)
+
+    # hashes whose tables are missing, dependencies first. the root is checked first and only the subtrees
+    # under missing tables are descended into, so a fully cached source costs a single exists call.
+    # the existing tables that were reached, the cache hits, are appended to hits
+    def missing_dependency_first(self, exists: Callable[[str], bool], hits: List[str] = None) -> List[str]:
+        checked = {}
+        missing = []
+        _missing_top_down(self._source, self._encoded_sources, exists, checked, missing)
+        if hits is not None:
+            hits.extend(hashed for hashed, found in checked.items() if found)
+        return missing
+
+    # same as missing_dependency_first, with every hash looked up in one batched call to the backend
+    def missing_batched(self, backend: CacheBackend, hits: List[str] = None) -> List[str]:
+        found = backend.existing(self.plan().hashes())
+        return self.missing_dependency_first(lambda hashed: hashed in found, hits=hits)
 
-    def _get_dependencies(self) -> Dict[str, EncodedSource]:
+    # materialize every missing table in the backend, dependencies first, expiring ttl seconds later.
+    # build_func replaces the backend's materialize, for timing or logging. returns what it returned by hash.
+    # hits and builds are recorded in the catalog, builds with their size, provenance and build time.
+    # with leases, a table another run is building is waited for instead, and comes back as None.
+    # nodes whose alias is in incremental are built into date partitioned tables, and when they exist only their
+    # missing and recent partitions are recomputed, bypassing build_func and leases. when that changed any row,
+    # what is downstream of them is dropped and rebuilt, and otherwise kept as a hit. with lineage, the edges of
+    # the plan are recorded before anything is built, so that tables built before a failure can be invalidated too,
+    # and a refresh that changed rows also drops the tables other plans derived from it, which they rebuild
+    def build(self,
+              max_in_flight: int = 8,
+              scheduler: CriticalPathScheduler = None,
+              build_func: Callable[[str, str], Any] = None,
+              ttl: float = None,
+              catalog: Catalog = None,
+              leases: LeasedBuilder = None,
+              incremental: Dict[str, IncrementalSpec] = None,
+              today: date = None,
+              lineage: LineageIndex = None) -> Dict[str, Any]:
+        if self._backend is None:
+            raise ValueError("DataSource has no backend to build in")
+        hits = []
+        missing = self.missing_batched(self._backend, hits=hits)
+        specs = incremental_hashes(self.plan(), incremental or {})
+        since = {}
+        downstream = set()
+        if specs:
+            missing, since, downstream = self._refresh_incremental(missing, specs, today or date.today())
+            hits = [hashed for hashed in hits if hashed not in missing]
+        logger.info(f"{len(missing) - len(downstream)} of {len(self.plan())} hashes missing, building...")
+        if catalog is not None:
+            catalog.touch(hits)
+        if lineage is not None:
+            lineage.record(lineage_edges(self.plan(), lineage.project()))
+        build_func = build_func or (lambda hashed, sql: self._backend.materialize(hashed, sql, ttl))
+        if leases is not None:
+            build_func = leases.wrap(build_func)
+        build_seconds = {}
+        dropped = set()
+        planned = set(self.plan().hashes())
 
-        return self._source.all_encoded_sources_by_name()
+        def timed_build(hashed: str, sql: str) -> Any:
+            # a node runs only after all of its dependencies, so every refresh it reads has dropped it by now if
+            # it changed anything. another run may have dropped it too, then it is missing
+            if hashed in downstream and hashed not in dropped and self._backend.existing([hashed]):
+                return None
+            tic = time.perf_counter()
+            if hashed in specs:
+                built, changed = self._backend.materialize_partitioned(hashed, sql, specs[hashed].column(),
+                                                                       since=since.get(hashed), ttl=ttl)
+                if changed:
+                    stale = self.plan().downstream([hashed]) & downstream
+                    elsewhere = lineage.downstream([hashed]) - planned if lineage is not None else set()
+                    if stale or elsewhere:
+                        logger.info(f"incremental hash:{hashed} changed, dropping {len(stale | elsewhere)} tables "
+                                    f"downstream of it")
+                        self._backend.delete(stale | elsewhere)
+                        dropped.update(stale)
+                        if catalog is not None and elsewhere:
+                            catalog.forget(elsewhere)
+            else:
+                built = build_func(hashed, sql)
+            build_seconds[hashed] = time.perf_counter() - tic
+            return built
 
-def _apply_dependency_first(encoded_source: EncodedSource, apply_func: Callable[[str, str], bool]):
+        # what completed is cataloged even when another node failed, since its table exists all the same
+        completed = {}
 
-    last_dependencies = encoded_source.encoded_dependencies()[-1]
-    for dependency in last_dependencies:
-        _apply_dependency_first(dependency, apply_func)
-    last_statement = encoded_source.encoded_sources()[-1]
-    last_hash = encoded_source.hashed_sources()[-1]
-    return apply_func(last_hash, last_statement)
+        def recorded_build(hashed: str, sql: str) -> Any:
+            completed[hashed] = timed_build(hashed, sql)
+            return completed[hashed]
 
+        try:
+            built = self.apply_concurrently(recorded_build, max_in_flight=max_in_flight, only=missing,
+                                            scheduler=scheduler)
+        finally:
+            if catalog is not None and completed:
+                self._record_builds(catalog,
+                                    {hashed: result for hashed, result in completed.items() if result is not None},
+                                    build_seconds)
+                catalog.touch(hashed for hashed, result in completed.items() if result is None)
+        return built
 
+    # same as build, but the missing tables are submitted as jobs and polled together by executor, so hundreds
+    # can run at once on a few threads. returns the final job states by hash
+    def build_async(self,
+                    executor: AsyncDependencyExecutor,
+                    scheduler: CriticalPathScheduler = None,
+                    catalog: Catalog = None,
+                    lineage: LineageIndex = None) -> Dict[str, JobState]:
+        if self._backend is None:
+            raise ValueError("DataSource has no backend to build in")
+        hits = []
+        missing = self.missing_batched(self._backend, hits=hits)
+        logger.info(f"{len(missing)} of {len(self.plan())} hashes missing, submitting...")
+        if catalog is not None:
+            catalog.touch(hits)
+        plan = self.plan().subset(missing)
+        priorities = scheduler.priorities(plan) if scheduler is not None else None
+        if lineage is not None:
+            lineage.record(lineage_edges(self.plan(), lineage.project()))
+        states = {}
+        try:
+            states = executor.run(plan, priorities=priorities)
+        except JobError as error:
+            states = error.states
+            raise
+        finally:
+            if catalog is not None:
+                succeeded = {hashed: state for hashed, state in states.items() if not state.error()}
+                self._record_builds(catalog,
+                                    {hashed: state.bytes_processed() for hashed, state in succeeded.items()},
+                                    {hashed: state.seconds() for hashed, state in succeeded.items()})
+        return states
 
+    # missing plus the incremental tables to refresh and everything downstream of them, dependencies first, the
+    # partition each refresh starts from, and the existing tables downstream, which are only rebuilt when a
+    # refresh they read changes
+    def _refresh_incremental(self,
+                             missing: List[str],
+                             specs: Dict[str, IncrementalSpec],
+                             today: date) -> Tuple[List[str], Dict[str, date], Set[str]]:
+        existing = [hashed for hashed in specs if hashed not in missing]
+        partitions = self._backend.partitions({hashed: specs[hashed].column() for hashed in existing})
+        since = {hashed: refresh_since(specs[hashed], partitions.get(hashed, set()), today) for hashed in existing}
+        for hashed, first in since.items():
+            logger.info(f"refreshing incremental hash:{hashed} from partition:{first or 'scratch'}")
+        downstream = self.plan().downstream(existing) - set(missing) - set(existing)
+        rebuild = set(missing) | set(existing) | downstream
+        return [hashed for hashed in self.plan().hashes() if hashed in rebuild], since, downstream
 
+    def _record_builds(self, catalog: Catalog, built: Dict[str, Any], build_seconds: Dict[str, float]):
+        # one metadata call for the sizes of everything just built
+        if not built:
+            return
+        tables = self._backend.metadata(built)
+        now = time.time()
+        catalog.record_builds(
+            CatalogEntry(hashed,
+                         self._encoded_sources[hashed].alias(),
+                         self._encoded_sources[hashed].sql(),
+                         tables[hashed].num_bytes() if hashed in tables else 0,
+                         tables[hashed].num_rows() if hashed in tables else 0,
+                         bytes_processed if isinstance(bytes_processed, int) else 0,
+                         build_seconds[hashed],
+                         now,
+                         now)
+            for hashed, bytes_processed in built.items())
 
+    def _get_dependencies(self, source: EncodedSource) -> Dict[str, EncodedNode]:
 
+        return source.all_encoded_nodes()
 
+def _missing_top_down(encoded_node: EncodedNode,
+                      encoded_nodes: Dict[str, EncodedNode],
+                      exists: Callable[[str], bool],
+                      checked: Dict[str, bool],
+                      missing: List[str]) -> bool:
+    hashed = encoded_node.hashed()
+    if hashed not in checked:
+        checked[hashed] = exists(hashed)
+        if not checked[hashed]:
+            for dependency_hash in encoded_node.dependency_hashes():
+                _missing_top_down(encoded_nodes[dependency_hash], encoded_nodes, exists, checked, missing)
+            missing.append(hashed)
+    return checked[hashed]
 
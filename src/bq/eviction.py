@@ -0,0 +1,38 @@
+# keeps the cache dataset under a size budget by dropping the least recently used tables first
+import logging
+import sys
+from typing import Iterable, List
+sys.path.append(".")
+from src.bq.backend import CacheBackend
+from src.bq.catalog import Catalog
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def evict(backend: CacheBackend,
+          catalog: Catalog,
+          budget_bytes: int,
+          protect: Iterable[str] = ()) -> List[str]:
+    # drops least recently used tables until the dataset fits budget_bytes, never the protected ones.
+    # recency comes from the catalog, tables it does not know count from their creation.
+    # returns the evicted hashes, deleted in one batch
+    # cache tables are named by hash. everything else kept in the dataset, the catalog, the lineage index and the
+    # build leases, starts with an underscore and is never evicted
+    tables = {hashed: table for hashed, table in backend.metadata().items() if not hashed.startswith("_")}
+    total_bytes = sum(table.num_bytes() for table in tables.values())
+    protect = set(protect)
+    last_used = catalog.last_used(tables)
+    evicted = []
+    for hashed in sorted(tables, key=lambda hashed: (last_used.get(hashed, tables[hashed].created()), hashed)):
+        if total_bytes <= budget_bytes:
+            break
+        if hashed not in protect:
+            evicted.append(hashed)
+            total_bytes -= tables[hashed].num_bytes()
+    if evicted:
+        logger.info(f"evicting {len(evicted)} of {len(tables)} cache tables, {total_bytes:,} bytes left")
+        backend.delete(evicted)
+        catalog.forget(evicted)
+    return evicted
@@ -0,0 +1,66 @@
+# concurrent dependency first execution of encoded nodes
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import heapq
+import logging
+import sys
+from typing import Dict, Callable, Any
+sys.path.append(".")
+from src.bq.plan import ExecutionPlan
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class DependencyExecutor:
+    # submits each node as soon as all of its dependencies completed, with at most max_in_flight running at once.
+    # a failure stops new submissions, lets running nodes finish, then is raised.
+    # ready nodes start highest priority first, in plan order without priorities
+
+    def __init__(self, max_in_flight: int = 8):
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got:{max_in_flight}")
+        self._max_in_flight = max_in_flight
+
+    def max_in_flight(self) -> int:
+        return self._max_in_flight
+
+    def run(self,
+            plan: ExecutionPlan,
+            apply_func: Callable[[str, str], Any],
+            priorities: Dict[str, float] = None) -> Dict[str, Any]:
+        order = {hashed: index for index, hashed in enumerate(plan.hashes())}
+
+        def ready_entry(hashed: str):
+            return -(priorities or {}).get(hashed, 0.0), order[hashed], hashed
+
+        unmet = {hashed: len(plan.dependencies(hashed)) for hashed in plan.hashes()}
+        ready = [ready_entry(hashed) for hashed in plan.hashes() if not unmet[hashed]]
+        heapq.heapify(ready)
+        results = {}
+        in_flight: Dict[Future, str] = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self._max_in_flight) as pool:
+            while ready or in_flight:
+                while ready and error is None and len(in_flight) < self._max_in_flight:
+                    hashed = heapq.heappop(ready)[-1]
+                    in_flight[pool.submit(apply_func, hashed, plan.node(hashed).sql())] = hashed
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    hashed = in_flight.pop(future)
+                    try:
+                        results[hashed] = future.result()
+                    except Exception as e:
+                        logger.error(f"failed hash:{hashed} error:{e}")
+                        error = error or e
+                        continue
+                    for dependent in plan.dependents(hashed):
+                        unmet[dependent] -= 1
+                        if not unmet[dependent]:
+                            heapq.heappush(ready, ready_entry(dependent))
+        if error is not None:
+            raise error
+        return results
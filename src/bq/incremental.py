@@ -0,0 +1,46 @@
+# nodes designated incremental keep one date partitioned cache table under their hash. each run recomputes only
+# the partitions that are missing or recent enough to still change, instead of the whole table
+from datetime import date, timedelta
+import logging
+import sys
+from typing import Dict, Optional, Set
+sys.path.append(".")
+from src.bq.plan import ExecutionPlan
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class IncrementalSpec:
+    # column is the DATE column the table is partitioned by. the last lookback_days partitions before today are
+    # recomputed on every run, for late arriving data
+
+    def __init__(self, column: str, lookback_days: int = 2):
+        if lookback_days < 0:
+            raise ValueError(f"lookback_days must not be negative, got:{lookback_days}")
+        self._column = column
+        self._lookback_days = lookback_days
+
+    def __repr__(self) -> str:
+        return f"IncrementalSpec(column={self._column!r}, lookback_days={self._lookback_days})"
+
+    def column(self) -> str:
+        return self._column
+
+    def lookback_days(self) -> int:
+        return self._lookback_days
+
+
+# the first partition to recompute: the day after the newest one, or lookback_days before today when that is
+# earlier. None without any partition, when the table has to be built whole
+def refresh_since(spec: IncrementalSpec, partitions: Set[date], today: date) -> Optional[date]:
+    if not partitions:
+        return None
+    return min(max(partitions) + timedelta(days=1), today - timedelta(days=spec.lookback_days()))
+
+
+# the specs of the plan's nodes designated by alias, by hash
+def incremental_hashes(plan: ExecutionPlan, incremental: Dict[str, IncrementalSpec]) -> Dict[str, IncrementalSpec]:
+    return {node.hashed(): incremental[node.alias()] for node in plan if node.alias() in incremental}
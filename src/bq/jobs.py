@@ -0,0 +1,296 @@
+# asynchronous builds: jobs are submitted without waiting on them and all in-flight jobs are polled together,
+# so a handful of threads can drive hundreds of concurrent builds
+from abc import ABC, abstractmethod
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+import itertools
+from typing import Callable, Dict, Iterable, Optional
+
+from google.cloud import bigquery
+sys.path.append(".")
+from src.bq.backend import BigQueryBackend, InMemoryBackend, job_id_for
+from src.bq.plan import ExecutionPlan
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class JobState:
+    # job_id is None for a submission that failed before a job was created
+
+    def __init__(self,
+                 job_id: Optional[str],
+                 done: bool,
+                 error: Optional[str] = None,
+                 bytes_processed: int = 0,
+                 seconds: float = 0.0):
+        self._job_id = job_id
+        self._done = done
+        self._error = error
+        self._bytes_processed = bytes_processed
+        self._seconds = seconds
+
+    def __repr__(self) -> str:
+        return f"JobState(job_id={self._job_id!r}, done={self._done}, error={self._error!r})"
+
+    def job_id(self) -> Optional[str]:
+        return self._job_id
+
+    def done(self) -> bool:
+        return self._done
+
+    # None unless the job failed
+    def error(self) -> Optional[str]:
+        return self._error
+
+    def bytes_processed(self) -> int:
+        return self._bytes_processed
+
+    # seconds from submission until the job was seen done, filled in by the executor
+    def seconds(self) -> float:
+        return self._seconds
+
+    def timed(self, seconds: float) -> "JobState":
+        return JobState(self._job_id, self._done, self._error, self._bytes_processed, seconds)
+
+
+class JobError(RuntimeError):
+    # states holds every job that finished by the time the error was raised, by hash, the failed ones included
+
+    def __init__(self, hashed: str, state: JobState):
+        super().__init__(f"job:{state.job_id()} for hash:{hashed} failed: {state.error()}")
+        self.hashed = hashed
+        self.state = state
+        self.states = {hashed: state}
+
+
+class JobBackend(ABC):
+
+    # start building sql into the cache table hashed and return its job id, without waiting for it
+    @abstractmethod
+    def submit(self, hashed: str, sql: str, ttl: float = None) -> str:
+        pass
+
+    # states of all the given jobs in as few round trips as the backend allows. unknown jobs are left out
+    @abstractmethod
+    def poll(self, job_ids: Iterable[str]) -> Dict[str, JobState]:
+        pass
+
+
+class BigQueryJobBackend(JobBackend):
+    # jobs are started by BigQueryBackend.start, so their ids are deterministic and a job another run already
+    # submitted is attached to. polling lists this user's jobs created since the oldest one in flight, one request
+    # per page_size jobs, instead of a get_job per job
+
+    def __init__(self, client: bigquery.Client, dataset: str, page_size: int = 1000, bucket_seconds: float = 3600):
+        self._client = client
+        self._backend = BigQueryBackend(client, dataset, page_size=page_size, bucket_seconds=bucket_seconds)
+        self._page_size = page_size
+        self._lock = threading.Lock()
+        self._submitted = {}
+
+    def submit(self, hashed: str, sql: str, ttl: float = None) -> str:
+        query_job = self._backend.start(hashed, sql, ttl)
+        with self._lock:
+            self._submitted[query_job.job_id] = query_job.created or datetime.now(tz=timezone.utc)
+        return query_job.job_id
+
+    def poll(self, job_ids: Iterable[str]) -> Dict[str, JobState]:
+        wanted = set(job_ids)
+        with self._lock:
+            created = [self._submitted[job_id] for job_id in wanted if job_id in self._submitted]
+        if not created:
+            return {}
+        states = {}
+        for job in self._client.list_jobs(min_creation_time=min(created), page_size=self._page_size):
+            if job.job_id in wanted:
+                states[job.job_id] = _job_state(job)
+                if len(states) == len(wanted):
+                    break
+        # jobs attached to from another user's run are not listed, those are looked up one by one
+        for job_id in wanted - states.keys():
+            states[job_id] = _job_state(self._client.get_job(job_id))
+        with self._lock:
+            for state in states.values():
+                if state.done():
+                    self._submitted.pop(state.job_id(), None)
+        return states
+
+
+def _job_state(job: bigquery.QueryJob) -> JobState:
+    done = job.state == "DONE"
+    error = job.error_result.get("message") if done and job.error_result else None
+    return JobState(job.job_id, done, error, getattr(job, "total_bytes_processed", None) or 0)
+
+
+class FakeJobBackend(JobBackend):
+    # jobs finish duration(hashed) seconds after submission, then their table appears in backend.
+    # submit and poll each cost a round trip of latency seconds. job ids are deterministic like on bigquery:
+    # submitting a hash whose job of the bucket is running, or built a table that is still there, attaches to it
+
+    def __init__(self,
+                 backend: InMemoryBackend = None,
+                 duration: Callable[[str], float] = lambda hashed: 0.0,
+                 latency: float = 0.0,
+                 fail: Iterable[str] = (),
+                 dataset: str = "fake",
+                 bucket_seconds: float = 3600):
+        self._backend = backend if backend is not None else InMemoryBackend()
+        self._duration = duration
+        self._latency = latency
+        self._fail = set(fail)
+        self._dataset = dataset
+        self._bucket_seconds = bucket_seconds
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._landed = set()
+        self._submits = 0
+        self._attaches = 0
+        self._polls = 0
+
+    def backend(self) -> InMemoryBackend:
+        return self._backend
+
+    # jobs actually started, not counting attaches
+    def submits(self) -> int:
+        return self._submits
+
+    def attaches(self) -> int:
+        return self._attaches
+
+    def polls(self) -> int:
+        return self._polls
+
+    def submit(self, hashed: str, sql: str, ttl: float = None) -> str:
+        time.sleep(self._latency)
+        now = time.time()
+        with self._lock:
+            for attempt in itertools.count():
+                job_id = job_id_for(self._dataset, hashed, self._bucket_seconds, now=now, attempt=attempt)
+                if job_id not in self._jobs:
+                    self._submits += 1
+                    self._jobs[job_id] = (hashed, sql, ttl, time.perf_counter() + self._duration(hashed))
+                    return job_id
+                state = self._state(job_id, time.perf_counter())
+                if not state.done() or (not state.error() and self._backend.existing([hashed])):
+                    self._attaches += 1
+                    return job_id
+
+    def poll(self, job_ids: Iterable[str]) -> Dict[str, JobState]:
+        time.sleep(self._latency)
+        now = time.perf_counter()
+        with self._lock:
+            self._polls += 1
+            return {job_id: self._state(job_id, now) for job_id in job_ids if job_id in self._jobs}
+
+    def _state(self, job_id: str, now: float) -> JobState:
+        hashed, sql, ttl, finishes = self._jobs[job_id]
+        if finishes > now:
+            return JobState(job_id, False)
+        if hashed in self._fail:
+            return JobState(job_id, True, error="failed on purpose")
+        if job_id not in self._landed:
+            self._landed.add(job_id)
+            self._backend.add(hashed, len(sql), ttl=ttl)
+        return JobState(job_id, True, bytes_processed=len(sql))
+
+
+class AsyncDependencyExecutor:
+    # like DependencyExecutor, but a node holds no thread while its job runs: submissions and the one poll of
+    # every job in flight go through a pool of only threads threads. polling backs off by backoff while nothing
+    # finishes, from poll_interval up to max_poll_interval, and starts over as soon as something does.
+    # on a failed job, or a submission that raised, nothing more is submitted, the jobs in flight are seen through
+    # and the error raised
+
+    def __init__(self,
+                 job_backend: JobBackend,
+                 max_in_flight: int = 100,
+                 threads: int = 4,
+                 poll_interval: float = 0.5,
+                 max_poll_interval: float = 10.0,
+                 backoff: float = 1.5,
+                 ttl: float = None):
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got:{max_in_flight}")
+        self._job_backend = job_backend
+        self._max_in_flight = max_in_flight
+        self._threads = threads
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._backoff = backoff
+        self._ttl = ttl
+
+    def run(self, plan: ExecutionPlan, priorities: Dict[str, float] = None) -> Dict[str, JobState]:
+        return asyncio.run(self.run_async(plan, priorities=priorities))
+
+    async def run_async(self, plan: ExecutionPlan, priorities: Dict[str, float] = None) -> Dict[str, JobState]:
+        loop = asyncio.get_running_loop()
+        order = {hashed: index for index, hashed in enumerate(plan.hashes())}
+
+        def ready_entry(hashed: str):
+            return -(priorities or {}).get(hashed, 0.0), order[hashed], hashed
+
+        unmet = {hashed: len(plan.dependencies(hashed)) for hashed in plan.hashes()}
+        ready = [ready_entry(hashed) for hashed in plan.hashes() if not unmet[hashed]]
+        heapq.heapify(ready)
+        in_flight: Dict[str, str] = {}
+        submitted = {}
+        results = {}
+        error = None
+        interval = self._poll_interval
+        with ThreadPoolExecutor(max_workers=self._threads) as pool:
+            while ready or in_flight:
+                if error is None:
+                    batch = [heapq.heappop(ready)[-1] for _ in range(min(len(ready),
+                                                                         self._max_in_flight - len(in_flight)))]
+                    job_ids = await asyncio.gather(*[
+                        loop.run_in_executor(pool, self._job_backend.submit, hashed, plan.node(hashed).sql(), self._ttl)
+                        for hashed in batch], return_exceptions=True)
+                    for hashed, job_id in zip(batch, job_ids):
+                        if isinstance(job_id, Exception):
+                            # a submission that failed is a failed job that never got an id
+                            logger.error(f"submitting hash:{hashed} failed error:{job_id}")
+                            results[hashed] = JobState(None, True, error=str(job_id))
+                            if error is None:
+                                error = JobError(hashed, results[hashed])
+                                error.__cause__ = job_id
+                            continue
+                        if isinstance(job_id, BaseException):
+                            raise job_id
+                        in_flight[job_id] = hashed
+                        submitted[hashed] = time.perf_counter()
+                    if error is not None:
+                        ready = []
+                if not in_flight:
+                    break
+                await asyncio.sleep(interval)
+                states = await loop.run_in_executor(pool, self._job_backend.poll, list(in_flight))
+                finished = [state for state in states.values() if state.done()]
+                interval = self._poll_interval if finished else min(interval * self._backoff,
+                                                                     self._max_poll_interval)
+                for state in finished:
+                    hashed = in_flight.pop(state.job_id())
+                    state = state.timed(time.perf_counter() - submitted[hashed])
+                    results[hashed] = state
+                    if state.error():
+                        logger.error(f"job:{state.job_id()} failed for hash:{hashed} error:{state.error()}")
+                        error = error or JobError(hashed, state)
+                        continue
+                    for dependent in plan.dependents(hashed):
+                        unmet[dependent] -= 1
+                        if not unmet[dependent]:
+                            heapq.heappush(ready, ready_entry(dependent))
+                if error is not None:
+                    ready = []
+        if error is not None:
+            error.states = results
+            raise error
+        return results
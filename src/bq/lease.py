@@ -0,0 +1,245 @@
+# build leases keyed by hash, so concurrent runs, of any user, never pay for the same table twice
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+import getpass
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Callable, Optional
+
+import google.api_core.exceptions
+from google.cloud import bigquery
+sys.path.append(".")
+from src.bq.backend import CacheBackend
+from src.sqlite_store import SQLiteStore
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_PATH = os.path.join(os.path.expanduser("~"), ".bq_shared_cache", "leases.db")
+
+LEASE_TABLE_PREFIX = "_lease_"
+
+
+def default_owner() -> str:
+    return f"{getpass.getuser()}@{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseStore(ABC):
+    # a lease is held by one owner until it is released or expires, whichever comes first
+
+    # claim hashed for ttl seconds. true when owner now holds it, because it was free, stale or already owner's
+    @abstractmethod
+    def acquire(self, hashed: str, owner: str, ttl: float) -> bool:
+        pass
+
+    # extend owner's lease by ttl seconds from now. false when it was lost to expiry
+    @abstractmethod
+    def renew(self, hashed: str, owner: str, ttl: float) -> bool:
+        pass
+
+    @abstractmethod
+    def release(self, hashed: str, owner: str):
+        pass
+
+    # current owner of a lease that has not expired
+    @abstractmethod
+    def holder(self, hashed: str) -> Optional[str]:
+        pass
+
+
+class SQLiteLeaseStore(SQLiteStore, LeaseStore):
+    # safe across the processes of one machine through sqlite's own locking
+
+    def __init__(self, path: str = DEFAULT_LEASE_PATH):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " hash TEXT PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires REAL NOT NULL)"], isolation_level=None, timeout=30)
+
+    def acquire(self, hashed: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute("SELECT owner, expires FROM leases WHERE hash = ?", (hashed,)).fetchone()
+                acquired = row is None or row[0] == owner or row[1] <= now
+                if acquired:
+                    if row is not None and row[0] != owner:
+                        logger.info(f"taking over stale lease on hash:{hashed} from owner:{row[0]}")
+                    self._connection.execute("INSERT OR REPLACE INTO leases (hash, owner, expires) VALUES (?, ?, ?)",
+                                             (hashed, owner, now + ttl))
+            finally:
+                self._connection.execute("COMMIT")
+        return acquired
+
+    def renew(self, hashed: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            renewed = self._connection.execute(
+                "UPDATE leases SET expires = ? WHERE hash = ? AND owner = ? AND expires > ?",
+                (now + ttl, hashed, owner, now)).rowcount
+        return renewed > 0
+
+    def release(self, hashed: str, owner: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM leases WHERE hash = ? AND owner = ?", (hashed, owner))
+
+    def holder(self, hashed: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute("SELECT owner FROM leases WHERE hash = ? AND expires > ?",
+                                           (hashed, time.time())).fetchone()
+        return row[0] if row else None
+
+
+class BigQueryLeaseStore(LeaseStore):
+    # a lease is an empty table in the cache dataset. creating a table that exists fails, which makes the claim
+    # atomic across users. the owner is the table description, and the table expires with the lease. updates of
+    # a table read by get_table carry its etag, so they fail when anyone changed the table in between
+
+    def __init__(self, client: bigquery.Client, dataset: str):
+        self._client = client
+        self._dataset_id = f"{client.project}.{dataset}"
+
+    def _table_id(self, hashed: str) -> str:
+        return f"{self._dataset_id}.{LEASE_TABLE_PREFIX}{hashed}"
+
+    def _table(self, hashed: str, owner: str, ttl: float) -> bigquery.Table:
+        table = bigquery.Table(self._table_id(hashed))
+        table.description = owner
+        table.expires = _expires(ttl)
+        return table
+
+    def acquire(self, hashed: str, owner: str, ttl: float) -> bool:
+        try:
+            self._client.create_table(self._table(hashed, owner, ttl))
+            return True
+        except google.api_core.exceptions.Conflict:
+            pass
+        try:
+            table = self._client.get_table(self._table_id(hashed))
+        except google.api_core.exceptions.NotFound:
+            # released between the two calls, try once more
+            return self._create(hashed, owner, ttl)
+        if table.description == owner:
+            return self.renew(hashed, owner, ttl)
+        if table.expires is not None and table.expires.timestamp() <= time.time():
+            # expired tables can linger before bigquery drops them. they are taken over in place rather than
+            # deleted and created again, so of several runs taking over at once only the first update applies
+            logger.info(f"taking over stale lease on hash:{hashed} from owner:{table.description}")
+            table.description = owner
+            table.expires = _expires(ttl)
+            try:
+                self._client.update_table(table, ["description", "expires"])
+                return True
+            except google.api_core.exceptions.PreconditionFailed:
+                return False
+            except google.api_core.exceptions.NotFound:
+                return self._create(hashed, owner, ttl)
+        return False
+
+    def _create(self, hashed: str, owner: str, ttl: float) -> bool:
+        try:
+            self._client.create_table(self._table(hashed, owner, ttl))
+            return True
+        except google.api_core.exceptions.Conflict:
+            return False
+
+    def renew(self, hashed: str, owner: str, ttl: float) -> bool:
+        try:
+            table = self._client.get_table(self._table_id(hashed))
+        except google.api_core.exceptions.NotFound:
+            return False
+        if table.description != owner:
+            return False
+        table.expires = _expires(ttl)
+        try:
+            self._client.update_table(table, ["expires"])
+        except (google.api_core.exceptions.PreconditionFailed, google.api_core.exceptions.NotFound):
+            # taken over or dropped since it was read
+            return False
+        return True
+
+    def release(self, hashed: str, owner: str):
+        if self.holder(hashed) == owner:
+            self._client.delete_table(self._table_id(hashed), not_found_ok=True)
+
+    def holder(self, hashed: str) -> Optional[str]:
+        try:
+            table = self._client.get_table(self._table_id(hashed))
+        except google.api_core.exceptions.NotFound:
+            return None
+        if table.expires is not None and table.expires.timestamp() <= time.time():
+            return None
+        return table.description
+
+
+def _expires(ttl: float) -> datetime:
+    return datetime.fromtimestamp(time.time() + ttl, tz=timezone.utc)
+
+
+class LeasedBuilder:
+    # wraps a build so that only the lease holder runs it. everyone else waits until the table exists, or takes
+    # the build over when the holder gave up or died and its lease went stale. the holder renews its lease
+    # every third of lease_seconds while building, so only a dead holder's lease goes stale
+
+    def __init__(self,
+                 lease_store: LeaseStore,
+                 backend: CacheBackend,
+                 owner: str = None,
+                 lease_seconds: float = 600,
+                 poll_interval: float = 5):
+        self._lease_store = lease_store
+        self._backend = backend
+        self._owner = owner or default_owner()
+        self._lease_seconds = lease_seconds
+        self._poll_interval = poll_interval
+
+    def owner(self) -> str:
+        return self._owner
+
+    # the wrapped build returns None when another run built the table
+    def wrap(self, build_func: Callable[[str, str], Any]) -> Callable[[str, str], Any]:
+        def leased_build(hashed: str, sql: str) -> Any:
+            while True:
+                if self._lease_store.acquire(hashed, self._owner, self._lease_seconds):
+                    try:
+                        # another run may have finished it between our existence check and the claim
+                        if self._backend.exists(hashed):
+                            return None
+                        return self._build_renewing(hashed, sql, build_func)
+                    finally:
+                        self._lease_store.release(hashed, self._owner)
+                logger.info(f"hash:{hashed} is being built by owner:{self._lease_store.holder(hashed)}, waiting...")
+                while self._lease_store.holder(hashed) is not None:
+                    if self._backend.exists(hashed):
+                        return None
+                    time.sleep(self._poll_interval)
+                if self._backend.exists(hashed):
+                    return None
+
+        return leased_build
+
+    def _build_renewing(self, hashed: str, sql: str, build_func: Callable[[str, str], Any]) -> Any:
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(self._lease_seconds / 3):
+                if not self._lease_store.renew(hashed, self._owner, self._lease_seconds):
+                    logger.warning(f"lost the lease on hash:{hashed} while building")
+                    return
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            return build_func(hashed, sql)
+        finally:
+            done.set()
+            renewer.join()
@@ -0,0 +1,166 @@
+# reverse lineage of the cache: which cache tables were derived from each base table and each cache table, so a
+# restated source drops exactly what was built from it
+from abc import ABC, abstractmethod
+import logging
+import os
+import sys
+from typing import Iterable, List, Optional, Set, Tuple
+
+from google.cloud import bigquery
+sys.path.append(".")
+from src.bq.backend import CacheBackend
+from src.bq.catalog import Catalog
+from src.bq.plan import ExecutionPlan
+from src.freshness import physical_tables
+from src.sqlite_store import SQLiteStore
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_LINEAGE_PATH = os.path.join(os.path.expanduser("~"), ".bq_shared_cache", "lineage.db")
+
+LINEAGE_TABLE = "_lineage"
+
+
+def qualified_table(table: str, project: str = None) -> str:
+    # one spelling per base table: backticks dropped, and a dataset.table name qualified with the default project
+    # the queries run in, so `dataset`.`table` and project.dataset.table are the same upstream
+    table = table.replace("`", "")
+    if project and table.count(".") == 1:
+        return f"{project}.{table}"
+    return table
+
+
+def lineage_edges(plan: ExecutionPlan, project: str = None) -> List[Tuple[str, str]]:
+    # (upstream, dependent hash) for every base table a node reads and every cache table it is built from.
+    # base tables are qualified with project
+    edges = []
+    for node in plan:
+        edges.extend((qualified_table(table, project), node.hashed())
+                     for table in sorted(physical_tables(node.sql())))
+        edges.extend((dependency_hash, node.hashed()) for dependency_hash in plan.dependencies(node.hashed()))
+    return edges
+
+
+class LineageIndex(ABC):
+    # upstreams are base table names, spelled by qualified_table with project, or cache table hashes
+
+    # the default project base table names are qualified with, None to leave them as written
+    @abstractmethod
+    def project(self) -> Optional[str]:
+        pass
+
+    # edges already known are ignored
+    @abstractmethod
+    def record(self, edges: Iterable[Tuple[str, str]]):
+        pass
+
+    # every hash derived from one of upstreams, directly or not, in one lookup
+    @abstractmethod
+    def downstream(self, upstreams: Iterable[str]) -> Set[str]:
+        pass
+
+
+class SQLiteLineage(SQLiteStore, LineageIndex):
+    # one table of edges indexed by upstream, walked by a single recursive query
+
+    def __init__(self, path: str = DEFAULT_LINEAGE_PATH, project: str = None):
+        self._project = project
+        super().__init__(path, [
+            f"CREATE TABLE IF NOT EXISTS {LINEAGE_TABLE} ("
+            " upstream TEXT NOT NULL,"
+            " dependent TEXT NOT NULL,"
+            " PRIMARY KEY (upstream, dependent))"])
+
+    def project(self) -> Optional[str]:
+        return self._project
+
+    def record(self, edges: Iterable[Tuple[str, str]]):
+        with self._lock:
+            self._connection.executemany(
+                f"INSERT OR IGNORE INTO {LINEAGE_TABLE} (upstream, dependent) VALUES (?, ?)", list(edges))
+            self._connection.commit()
+
+    def downstream(self, upstreams: Iterable[str]) -> Set[str]:
+        upstreams = list(upstreams)
+        if not upstreams:
+            return set()
+        with self._lock:
+            # UNION, unlike UNION ALL, visits a node reached through several paths only once
+            rows = self._connection.execute(
+                f"WITH RECURSIVE downstream(hash) AS ("
+                f" SELECT dependent FROM {LINEAGE_TABLE} WHERE upstream IN ({','.join('?' * len(upstreams))})"
+                f" UNION"
+                f" SELECT lineage.dependent FROM {LINEAGE_TABLE} lineage"
+                f" JOIN downstream ON lineage.upstream = downstream.hash)"
+                f" SELECT hash FROM downstream", upstreams).fetchall()
+        return {row[0] for row in rows}
+
+
+class BigQueryLineage(LineageIndex):
+    # bigquery's recursive queries only take UNION ALL, which repeats every path through a diamond, so the edges
+    # are read in one query and walked here
+
+    def __init__(self, client: bigquery.Client, dataset: str, table: str = LINEAGE_TABLE):
+        self._client = client
+        self._table_id = f"{client.project}.{dataset}.{table}"
+        self._client.query(
+            f"CREATE TABLE IF NOT EXISTS `{self._table_id}` ("
+            " upstream STRING NOT NULL, dependent STRING NOT NULL)"
+            " CLUSTER BY upstream").result()
+
+    def project(self) -> Optional[str]:
+        return self._client.project
+
+    def record(self, edges: Iterable[Tuple[str, str]]):
+        edges = list(dict.fromkeys(edges))
+        if not edges:
+            return
+        self._run(
+            f"MERGE `{self._table_id}` lineage USING UNNEST(@edges) edge "
+            "ON lineage.upstream = edge.upstream AND lineage.dependent = edge.dependent "
+            "WHEN NOT MATCHED THEN INSERT ROW",
+            [bigquery.ArrayQueryParameter("edges", "STRUCT", [
+                bigquery.StructQueryParameter(None,
+                                              bigquery.ScalarQueryParameter("upstream", "STRING", upstream),
+                                              bigquery.ScalarQueryParameter("dependent", "STRING", dependent))
+                for upstream, dependent in edges])])
+
+    def downstream(self, upstreams: Iterable[str]) -> Set[str]:
+        frontier = list(set(upstreams))
+        if not frontier:
+            return set()
+        dependents = {}
+        for row in self._run(f"SELECT upstream, dependent FROM `{self._table_id}`", []):
+            dependents.setdefault(row["upstream"], []).append(row["dependent"])
+        found = set()
+        while frontier:
+            for dependent in dependents.get(frontier.pop(), ()):
+                if dependent not in found:
+                    found.add(dependent)
+                    frontier.append(dependent)
+        return found
+
+    def _run(self, query: str, parameters: List) -> List:
+        job_config = bigquery.QueryJobConfig(query_parameters=parameters)
+        return list(self._client.query(query, job_config=job_config).result())
+
+
+def invalidate(backend: CacheBackend,
+               lineage: LineageIndex,
+               tables: Iterable[str] = (),
+               hashes: Iterable[str] = (),
+               catalog: Catalog = None) -> List[str]:
+    # drops the given cache tables and every cache table derived from them or from the given base tables,
+    # deleted in one batch. returns the dropped hashes
+    tables = [qualified_table(table, lineage.project()) for table in tables]
+    hashes = list(hashes)
+    dropped = sorted(set(hashes) | lineage.downstream(tables + hashes))
+    if dropped:
+        logger.info(f"invalidating {len(dropped)} cache tables derived from {tables + hashes}")
+        backend.delete(dropped)
+        if catalog is not None:
+            catalog.forget(dropped)
+    return dropped
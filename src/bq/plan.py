@@ -0,0 +1,92 @@
+# the unique node DAG under a root, in the order it can be built
+import sys
+from typing import Dict, List, Set, Tuple, Iterable, Iterator
+sys.path.append(".")
+from src.source import EncodedNode
+
+
+def unique_nodes(root: EncodedNode, encoded_nodes: Dict[str, EncodedNode]) -> List[EncodedNode]:
+    # every node reachable from root exactly once, dependencies before dependents
+    ordered = []
+    seen = {root.hashed()}
+    stack = [(root, iter(root.dependency_hashes()))]
+    while stack:
+        node, dependency_hashes = stack[-1]
+        for dependency_hash in dependency_hashes:
+            if dependency_hash not in seen:
+                seen.add(dependency_hash)
+                dependency = encoded_nodes[dependency_hash]
+                stack.append((dependency, iter(dependency.dependency_hashes())))
+                break
+        else:
+            stack.pop()
+            ordered.append(node)
+    return ordered
+
+
+class ExecutionPlan:
+    # ordered unique nodes with their edges by hash. iterating yields every node after all of its dependencies.
+    # edges only ever point at nodes inside the plan, so a subset plan treats everything left out as built
+
+    def __init__(self, nodes: List[EncodedNode], root: str = None):
+        self._nodes = nodes
+        self._by_hash = {node.hashed(): node for node in nodes}
+        self._root = root if root is not None else (nodes[-1].hashed() if nodes else None)
+        self._dependencies: Dict[str, Tuple[str, ...]] = {}
+        self._dependents: Dict[str, List[str]] = {hashed: [] for hashed in self._by_hash}
+        for node in nodes:
+            dependencies = tuple(dict.fromkeys(dependency_hash for dependency_hash in node.dependency_hashes()
+                                               if dependency_hash in self._by_hash))
+            self._dependencies[node.hashed()] = dependencies
+            for dependency_hash in dependencies:
+                self._dependents[dependency_hash].append(node.hashed())
+
+    @staticmethod
+    def from_root(root: EncodedNode, encoded_nodes: Dict[str, EncodedNode]) -> "ExecutionPlan":
+        return ExecutionPlan(unique_nodes(root, encoded_nodes), root=root.hashed())
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __iter__(self) -> Iterator[EncodedNode]:
+        return iter(self._nodes)
+
+    def __contains__(self, hashed: str) -> bool:
+        return hashed in self._by_hash
+
+    def root(self) -> str:
+        return self._root
+
+    def nodes(self) -> List[EncodedNode]:
+        return self._nodes
+
+    def hashes(self) -> List[str]:
+        return [node.hashed() for node in self._nodes]
+
+    def node(self, hashed: str) -> EncodedNode:
+        return self._by_hash[hashed]
+
+    def dependencies(self, hashed: str) -> Tuple[str, ...]:
+        return self._dependencies[hashed]
+
+    def dependents(self, hashed: str) -> List[str]:
+        return self._dependents[hashed]
+
+    # every node that depends on one of hashes, directly or not
+    def downstream(self, hashes: Iterable[str]) -> Set[str]:
+        found = set()
+        stack = [hashed for hashed in hashes if hashed in self._by_hash]
+        while stack:
+            for dependent in self._dependents[stack.pop()]:
+                if dependent not in found:
+                    found.add(dependent)
+                    stack.append(dependent)
+        return found
+
+    def edges(self) -> List[Tuple[str, str]]:
+        return [(dependency_hash, node.hashed()) for node in self._nodes
+                for dependency_hash in self._dependencies[node.hashed()]]
+
+    def subset(self, hashes: Iterable[str]) -> "ExecutionPlan":
+        hashes = set(hashes)
+        return ExecutionPlan([node for node in self._nodes if node.hashed() in hashes], root=self._root)
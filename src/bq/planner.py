@@ -0,0 +1,141 @@
+# dry run of an execution plan: what is cached, what is missing and roughly what building it would cost
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sys
+from typing import List, Set, Tuple
+sys.path.append(".")
+from src.source import hash_reference
+from src.bq.backend import CacheBackend
+from src.bq.plan import ExecutionPlan
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def inlined_sql(plan: ExecutionPlan, hashed: str, existing: Set[str]) -> str:
+    # sql of hashed with every missing table under it defined as a CTE, so it can be dry run before anything exists
+    missing = set()
+    stack = [dependency_hash for dependency_hash in plan.dependencies(hashed) if dependency_hash not in existing]
+    while stack:
+        dependency_hash = stack.pop()
+        if dependency_hash not in missing:
+            missing.add(dependency_hash)
+            stack.extend(below for below in plan.dependencies(dependency_hash) if below not in existing)
+    sql = plan.node(hashed).sql()
+    if not missing:
+        return sql
+    ctes = ",\n".join(f"{hash_reference(dependency_hash)} AS ({plan.node(dependency_hash).sql()})"
+                      for dependency_hash in plan.hashes() if dependency_hash in missing)
+    return f"WITH {ctes}\nSELECT * FROM ({sql})"
+
+
+class NodeEstimate:
+
+    def __init__(self, hashed: str, alias: str, cached: bool, estimated_bytes: int, dependencies: Tuple[str, ...]):
+        self._hashed = hashed
+        self._alias = alias
+        self._cached = cached
+        self._estimated_bytes = estimated_bytes
+        self._dependencies = dependencies
+
+    def hashed(self) -> str:
+        return self._hashed
+
+    def alias(self) -> str:
+        return self._alias
+
+    def cached(self) -> bool:
+        return self._cached
+
+    # bytes the node's query processes with every missing table under it computed inline
+    def estimated_bytes(self) -> int:
+        return self._estimated_bytes
+
+    def dependencies(self) -> Tuple[str, ...]:
+        return self._dependencies
+
+
+class DryRunReport:
+    # only the nodes a run would touch: missing ones and the cached ones directly under them (or a cached root)
+
+    def __init__(self, root: str, estimates: List[NodeEstimate]):
+        self._root = root
+        self._estimates = estimates
+        self._by_hash = {estimate.hashed(): estimate for estimate in estimates}
+
+    def root(self) -> str:
+        return self._root
+
+    def estimates(self) -> List[NodeEstimate]:
+        return self._estimates
+
+    def estimate(self, hashed: str) -> NodeEstimate:
+        return self._by_hash[hashed]
+
+    def missing(self) -> List[str]:
+        return [estimate.hashed() for estimate in self._estimates if not estimate.cached()]
+
+    # the topmost missing node already computes everything missing under it inline, so it is the cost of the build
+    def total_to_build(self) -> int:
+        missing = self.missing()
+        below = {dependency_hash for hashed in missing for dependency_hash in self._by_hash[hashed].dependencies()}
+        return sum(self._by_hash[hashed].estimated_bytes() for hashed in missing if hashed not in below)
+
+    # what the cached tables a run reads from would have cost to compute
+    def total_avoided(self) -> int:
+        return sum(estimate.estimated_bytes() for estimate in self._estimates if estimate.cached())
+
+    def format(self) -> str:
+        lines = []
+        shown = set()
+
+        def show(hashed: str, depth: int):
+            estimate = self._by_hash[hashed]
+            status = "HIT " if estimate.cached() else "MISS"
+            line = (f"{'  ' * depth}{status} {estimate.alias() or '<root>'} {hashed} "
+                    f"{format_bytes(estimate.estimated_bytes())}")
+            if hashed in shown:
+                lines.append(f"{line} (see above)")
+                return
+            shown.add(hashed)
+            lines.append(line)
+            if not estimate.cached():
+                for dependency_hash in estimate.dependencies():
+                    show(dependency_hash, depth + 1)
+
+        show(self._root, 0)
+        lines.append(f"{len(self.missing())} of {len(self._estimates)} nodes to build")
+        lines.append(f"estimated bytes to build: {format_bytes(self.total_to_build())}")
+        lines.append(f"estimated bytes avoided by cache hits: {format_bytes(self.total_avoided())}")
+        return "\n".join(lines)
+
+
+def format_bytes(num_bytes: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if num_bytes < 1024 or unit == "TiB":
+            return f"{num_bytes:,.0f} {unit}" if unit == "B" else f"{num_bytes:,.2f} {unit}"
+        num_bytes /= 1024
+
+
+def dry_run_plan(plan: ExecutionPlan, backend: CacheBackend, max_in_flight: int = 8) -> DryRunReport:
+    # one batched existence lookup, then every touched node dry run in parallel. nothing is created
+    existing = backend.existing(plan.hashes())
+    seen = set()
+    stack = [plan.root()]
+    while stack:
+        hashed = stack.pop()
+        if hashed not in seen:
+            seen.add(hashed)
+            if hashed not in existing:
+                stack.extend(plan.dependencies(hashed))
+    touched = [hashed for hashed in plan.hashes() if hashed in seen]
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        estimated_bytes = list(pool.map(lambda hashed: backend.dry_run(inlined_sql(plan, hashed, existing)), touched))
+    return DryRunReport(plan.root(), [NodeEstimate(hashed,
+                                                   plan.node(hashed).alias(),
+                                                   hashed in existing,
+                                                   node_bytes,
+                                                   plan.dependencies(hashed))
+                                      for hashed, node_bytes in zip(touched, estimated_bytes)])
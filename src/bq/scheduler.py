@@ -0,0 +1,123 @@
+# critical path first scheduling, from the durations of earlier builds of the same hash
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import sys
+import time
+from typing import Dict, Iterable, Optional, Tuple
+sys.path.append(".")
+from src.bq.backend import CacheBackend
+from src.bq.plan import ExecutionPlan
+from src.bq.planner import inlined_sql
+from src.sqlite_store import SQLiteStore
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATS_PATH = os.path.join(os.path.expanduser("~"), ".bq_shared_cache", "node_stats.db")
+
+
+class NodeStats(SQLiteStore):
+    # mean build seconds and bytes processed per hash. safe to record from the executor threads
+
+    def __init__(self, path: str = DEFAULT_STATS_PATH):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS node_stats ("
+            " hash TEXT PRIMARY KEY,"
+            " runs INTEGER NOT NULL,"
+            " seconds REAL NOT NULL,"
+            " bytes INTEGER NOT NULL,"
+            " updated REAL NOT NULL)"])
+
+    def record(self, hashed: str, seconds: float, bytes_processed: int):
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO node_stats (hash, runs, seconds, bytes, updated) VALUES (?, 1, ?, ?, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET"
+                " seconds = (seconds * runs + excluded.seconds) / (runs + 1),"
+                " bytes = (bytes * runs + excluded.bytes) / (runs + 1),"
+                " runs = runs + 1,"
+                " updated = excluded.updated",
+                (hashed, seconds, bytes_processed or 0, time.time()))
+            self._connection.commit()
+
+    # (mean seconds, mean bytes) of every hash seen before
+    def known(self, hashes: Iterable[str]) -> Dict[str, Tuple[float, int]]:
+        rows = self._select_in("SELECT hash, seconds, bytes FROM node_stats WHERE hash IN ({})", hashes)
+        return {hashed: (seconds, num_bytes) for hashed, seconds, num_bytes in rows}
+
+    def get(self, hashed: str) -> Optional[Tuple[float, int]]:
+        return self.known([hashed]).get(hashed)
+
+    # throughput over every recorded build, to turn byte estimates into seconds
+    def bytes_per_second(self) -> Optional[float]:
+        with self._lock:
+            seconds, num_bytes = self._connection.execute(
+                "SELECT SUM(seconds * runs), SUM(bytes * runs) FROM node_stats").fetchone()
+        return num_bytes / seconds if seconds and num_bytes else None
+
+
+def critical_path(plan: ExecutionPlan, costs: Dict[str, float]) -> Dict[str, float]:
+    # per hash, its own cost plus the longest chain of costs that can only start after it
+    remaining = {}
+    for node in reversed(plan.nodes()):
+        hashed = node.hashed()
+        remaining[hashed] = costs[hashed] + max((remaining[dependent] for dependent in plan.dependents(hashed)),
+                                                default=0.0)
+    return remaining
+
+
+class CriticalPathScheduler:
+    # costs come from the stats of earlier builds. never seen hashes are dry run when there is a backend,
+    # their bytes converted to seconds at the recorded throughput, and otherwise cost default_seconds
+
+    def __init__(self,
+                 stats: NodeStats,
+                 backend: CacheBackend = None,
+                 default_seconds: float = 1.0,
+                 default_bytes_per_second: float = 2 ** 30,
+                 max_in_flight: int = 8):
+        self._stats = stats
+        self._backend = backend
+        self._default_seconds = default_seconds
+        self._default_bytes_per_second = default_bytes_per_second
+        self._max_in_flight = max_in_flight
+
+    def costs(self, plan: ExecutionPlan) -> Dict[str, float]:
+        known = self._stats.known(plan.hashes())
+        costs = {hashed: seconds for hashed, (seconds, _) in known.items()}
+        unknown = [hashed for hashed in plan.hashes() if hashed not in known]
+        if unknown and self._backend is not None:
+            estimated_bytes = self.estimated_bytes(plan, unknown)
+            bytes_per_second = self._stats.bytes_per_second() or self._default_bytes_per_second
+            costs.update({hashed: num_bytes / bytes_per_second for hashed, num_bytes in estimated_bytes.items()})
+        for hashed in unknown:
+            costs.setdefault(hashed, self._default_seconds)
+        return costs
+
+    def estimated_bytes(self, plan: ExecutionPlan, hashes: Iterable[str]) -> Dict[str, int]:
+        # dry runs inline every missing table below a node, so its own share is what it adds over its dependencies
+        needed = set(hashes)
+        needed.update(dependency_hash for hashed in list(needed) for dependency_hash in plan.dependencies(hashed))
+        needed = [hashed for hashed in plan.hashes() if hashed in needed]
+
+        def dry_run(hashed: str) -> Optional[int]:
+            try:
+                return self._backend.dry_run(inlined_sql(plan, hashed, set()))
+            except Exception as e:
+                logger.warning(f"dry run failed for hash:{hashed} error:{e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self._max_in_flight) as pool:
+            inlined_bytes = dict(zip(needed, pool.map(dry_run, needed)))
+        own_bytes = {}
+        for hashed in hashes:
+            if inlined_bytes[hashed] is not None:
+                below = sum(inlined_bytes[dependency_hash] or 0 for dependency_hash in plan.dependencies(hashed))
+                own_bytes[hashed] = max(inlined_bytes[hashed] - below, 0)
+        return own_bytes
+
+    def priorities(self, plan: ExecutionPlan) -> Dict[str, float]:
+        return critical_path(plan, self.costs(plan))
@@ -0,0 +1,110 @@
+# On-disk cache of encoded sources, so an unchanged query skips parsing entirely
+
+import json
+import logging
+import os
+import sys
+import time
+from typing import Optional
+
+sys.path.append(".")
+from src.source import EncodedSource, source_digest
+from src.sqlite_store import SQLiteStore
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# bump whenever normalization or hashing changes, so stale encodings are never served
+ENCODE_CACHE_VERSION = 4
+
+DEFAULT_ENCODE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".bq_shared_cache", "encode_cache.db")
+
+
+def encode_cache_key(source_str: str, prefix: str) -> str:
+    return source_digest(f"{ENCODE_CACHE_VERSION}\0{prefix}\0{source_str}")
+
+
+def dump_encoded(encoded_source: EncodedSource) -> str:
+    # number every node reachable from the root, dependencies first, so loading can link them in one pass
+    node_ids = {}
+    nodes = []
+
+    def visit(node: EncodedSource) -> int:
+        node_id = node_ids.get(id(node))
+        if node_id is None:
+            dependency_ids = [[visit(dependency) for dependency in dependencies]
+                              for dependencies in node.encoded_dependencies()]
+            node_id = len(nodes)
+            node_ids[id(node)] = node_id
+            nodes.append({
+                "alias": node.alias(),
+                "encoded_sources": node.encoded_sources(),
+                "hashed_sources": node.hashed_sources(),
+                "child_hashes": node.child_hashes(),
+                "encoded_dependencies": dependency_ids,
+            })
+        return node_id
+
+    root_id = visit(encoded_source)
+    by_name = [[hashed, visit(node)] for hashed, node in encoded_source.all_encoded_sources_by_name().items()]
+    return json.dumps({"root": root_id, "nodes": nodes, "by_name": by_name})
+
+
+def load_encoded(payload: str) -> EncodedSource:
+    loaded = json.loads(payload)
+    known_dependencies = {}
+    nodes = []
+    for node in loaded["nodes"]:
+        nodes.append(EncodedSource.restore(
+            alias=node["alias"],
+            encoded_sources=node["encoded_sources"],
+            hashed_sources=node["hashed_sources"],
+            child_hashes=[tuple(tuple(child) for child in children) for children in node["child_hashes"]],
+            encoded_dependencies=[[nodes[dependency_id] for dependency_id in dependencies]
+                                  for dependencies in node["encoded_dependencies"]],
+            known_dependencies=known_dependencies))
+    for hashed, node_id in loaded["by_name"]:
+        known_dependencies[hashed] = nodes[node_id]
+    return nodes[loaded["root"]]
+
+
+class EncodeCache(SQLiteStore):
+
+    def __init__(self, path: str = DEFAULT_ENCODE_CACHE_PATH):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS encoded ("
+            " key TEXT PRIMARY KEY,"
+            " prefix TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " payload TEXT NOT NULL)"])
+
+    def get(self, source_str: str, prefix: str = "") -> Optional[EncodedSource]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT payload FROM encoded WHERE key = ?", (encode_cache_key(source_str, prefix),)).fetchone()
+        return load_encoded(row[0]) if row else None
+
+    def put(self, source_str: str, encoded_source: EncodedSource, prefix: str = ""):
+        payload = dump_encoded(encoded_source)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO encoded (key, prefix, created, payload) VALUES (?, ?, ?, ?)",
+                (encode_cache_key(source_str, prefix), prefix, time.time(), payload))
+            self._connection.commit()
+
+    def from_str(self, source_str: str, prefix: str = "") -> EncodedSource:
+        encoded_source = self.get(source_str, prefix=prefix)
+        if encoded_source is None:
+            logger.info("encode cache miss, encoding source")
+            encoded_source = EncodedSource.from_str(source_str, prefix=prefix)
+            self.put(source_str, encoded_source, prefix=prefix)
+        else:
+            logger.info(f"encode cache hit for root hash:{encoded_source.hashed_sources()[-1]}")
+        return encoded_source
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM encoded")
+            self._connection.commit()
@@ -0,0 +1,125 @@
+# Folds the versions of the base tables a query reads into its node hashes, so a cache table built before a base
+# table changed is missed instead of served. only nodes downstream of a changed table get a new hash
+
+import hashlib
+import logging
+import sys
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+import sqlparse
+from sqlparse import lexer
+sys.path.append(".")
+from src.source import EncodedNode, hash_reference
+from src.bq.plan import unique_nodes
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# clauses that end the FROM list of their query
+_AFTER_FROM = {"WHERE", "GROUP", "HAVING", "QUALIFY", "WINDOW", "ORDER", "LIMIT", "UNION", "INTERSECT", "EXCEPT",
+               "SELECT"}
+
+
+def physical_tables(sql: str) -> Set[str]:
+    # the base tables sql reads, inlined dependencies included, as written without backticks. those are the names
+    # after FROM, JOIN and the commas of a FROM list, in queries only, so EXTRACT(... FROM column) is no table.
+    # physical tables are always qualified by at least a dataset, which keeps out CTE names and cache table hashes,
+    # and table functions are followed by their arguments
+    tokens = [(ttype, value) for ttype, value in lexer.tokenize(sql)
+              if ttype not in sqlparse.tokens.Comment]
+    tables = set()
+    # per open parenthesis: whether it holds a query, None until its first token, and whether it is in a FROM list
+    frames = [[True, False]]
+    expect_table = False
+    position = 0
+    while position < len(tokens):
+        ttype, value = tokens[position]
+        if ttype in sqlparse.tokens.Whitespace:
+            position += 1
+            continue
+        frame = frames[-1]
+        if frame[0] is None:
+            frame[0] = value.upper() in ("SELECT", "WITH")
+        if expect_table and ttype in sqlparse.tokens.Name:
+            name, position = _dotted_name(tokens, position)
+            following = next((value for ttype, value in tokens[position:]
+                              if ttype not in sqlparse.tokens.Whitespace), None)
+            if "." in name and following != "(":
+                tables.add(name)
+            expect_table = False
+            continue
+        expect_table = False
+        if value == "(":
+            frames.append([None, False])
+        elif value == ")":
+            if len(frames) > 1:
+                frames.pop()
+        elif frame[0] and ttype in sqlparse.tokens.Keyword:
+            keyword = value.upper()
+            if keyword == "FROM" or keyword.endswith("JOIN"):
+                frame[1] = expect_table = True
+            elif keyword.split()[0] in _AFTER_FROM:
+                frame[1] = False
+        elif frame[1] and value == ",":
+            expect_table = True
+        position += 1
+    return tables
+
+
+def _dotted_name(tokens: List[Tuple], position: int) -> Tuple[str, int]:
+    # the name starting at position, with its parts joined by dots and their backticks dropped, and where it ends.
+    # the lexer splits a project like my-project-123 into a name, an operator and a number
+    parts = []
+    while position < len(tokens):
+        ttype, value = tokens[position]
+        if not (ttype in sqlparse.tokens.Name or ttype in sqlparse.tokens.Number or value in (".", "-")
+                or (ttype in sqlparse.tokens.Keyword and "".join(parts).endswith("."))):
+            break
+        parts.append(value)
+        position += 1
+    return "".join(parts).replace("`", ""), position
+
+
+def versioned_nodes(root: EncodedNode,
+                    encoded_nodes: Dict[str, EncodedNode],
+                    versions: Callable[[Iterable[str]], Dict[str, str]],
+                    stable: Iterable[str] = ()) -> Dict[str, EncodedNode]:
+    # the nodes under root rehashed with the versions of the base tables they read and the new hashes of their
+    # dependencies, by their original hash. versions is called once, with every base table of every node. nodes
+    # that read no base table and whose dependencies kept their hash keep theirs, and so do the nodes aliased in
+    # stable, like incremental nodes that refresh themselves
+    stable = set(stable)
+    ordered = unique_nodes(root, encoded_nodes)
+    tables = {node.hashed(): physical_tables(node.sql()) for node in ordered}
+    all_tables = set().union(*tables.values())
+    found = versions(all_tables) if all_tables else {}
+    for table in sorted(all_tables - found.keys()):
+        logger.warning(f"no version found for base table:{table}, its changes will not be noticed")
+    renamed = {}
+    rekeyed = {}
+    for node in ordered:
+        hashed = node.hashed()
+        changed_dependencies = [dependency_hash for dependency_hash in node.dependency_hashes()
+                                if renamed.get(dependency_hash, dependency_hash) != dependency_hash]
+        new_hash = hashed
+        if node.alias() not in stable and (tables[hashed] or changed_dependencies):
+            hasher = hashlib.sha1()
+            hasher.update(hashed.encode('utf-8'))
+            for table in sorted(tables[hashed]):
+                hasher.update(f"\0{table}\0{found.get(table, '')}".encode('utf-8'))
+            for dependency_hash in node.dependency_hashes():
+                hasher.update(f"\0{renamed[dependency_hash]}".encode('utf-8'))
+            new_hash = hasher.hexdigest()
+        renamed[hashed] = new_hash
+        sql = node.sql()
+        for dependency_hash in changed_dependencies:
+            sql = sql.replace(hash_reference(dependency_hash), hash_reference(renamed[dependency_hash]))
+        rekeyed[hashed] = EncodedNode(node.alias(),
+                                      new_hash,
+                                      sql,
+                                      tuple((alias, renamed.get(child_hash, child_hash))
+                                            for alias, child_hash in node.child_hashes()),
+                                      tuple(renamed[dependency_hash] for dependency_hash in node.dependency_hashes()))
+    return rekeyed
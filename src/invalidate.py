@@ -0,0 +1,42 @@
+# drops the cache tables derived from restated base tables or from given cache tables, and nothing else
+import click
+
+from bq.backend import BigQueryBackend
+from bq.catalog import SQLiteCatalog, BigQueryCatalog, DEFAULT_CATALOG_PATH
+from bq.lineage import SQLiteLineage, BigQueryLineage, DEFAULT_LINEAGE_PATH, invalidate, qualified_table
+from google.cloud import bigquery
+import logging
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+@click.command()
+@click.option("--project", help="gcp project to use", default="massive-clone-705")
+@click.option("--dataset",  help="cache dataset to drop tables from", default="rmartin_bq_cache")
+@click.option("--table", help="restated base table, with or without its project, repeat for several", multiple=True)
+@click.option("--hash", "hashes", help="cache table to drop with everything derived from it, repeat for several", multiple=True)
+@click.option("--lineage", help="sqlite file of the lineage index main.py records", default=DEFAULT_LINEAGE_PATH)
+@click.option("--shared-lineage", help="use the lineage index table in the cache dataset instead", is_flag=True)
+@click.option("--catalog", help="sqlite file cataloging every cache table and its reuse", default=DEFAULT_CATALOG_PATH)
+@click.option("--shared-catalog", help="use the catalog table in the cache dataset instead", is_flag=True)
+@click.option("--dry-run", help="only print what would be dropped", is_flag=True)
+def main(project, dataset, table, hashes, lineage, shared_lineage, catalog, shared_catalog, dry_run):
+    if not table and not hashes:
+        raise click.UsageError("give at least one --table or --hash")
+    client = bigquery.Client(project=project)
+    lineage_index = BigQueryLineage(client, dataset) if shared_lineage else SQLiteLineage(lineage, project=project)
+    if dry_run:
+        tables = [qualified_table(name, lineage_index.project()) for name in table]
+        for hashed in sorted(set(hashes) | lineage_index.downstream(tables + list(hashes))):
+            print(hashed)
+        return
+    cache_catalog = BigQueryCatalog(client, dataset) if shared_catalog else SQLiteCatalog(catalog)
+    dropped = invalidate(BigQueryBackend(client, dataset), lineage_index, tables=table, hashes=hashes,
+                         catalog=cache_catalog)
+    logger.info(f"dropped {len(dropped)} cache tables from dataset:{dataset}")
+
+
+if __name__ == '__main__':
+    main()
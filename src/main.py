@@ -1,7 +1,16 @@
 import click
 
+from bq.backend import BigQueryBackend
 from bq.data_source import DataSource
-from concurrent.futures.thread import ThreadPoolExecutor
+from bq.catalog import SQLiteCatalog, BigQueryCatalog, DEFAULT_CATALOG_PATH
+from bq.eviction import evict
+from bq.incremental import IncrementalSpec
+from bq.jobs import AsyncDependencyExecutor, BigQueryJobBackend
+from bq.lineage import SQLiteLineage, BigQueryLineage, DEFAULT_LINEAGE_PATH
+from bq.lease import LeasedBuilder, BigQueryLeaseStore
+from bq.planner import dry_run_plan
+from bq.scheduler import NodeStats, CriticalPathScheduler, DEFAULT_STATS_PATH
+from encode_cache import EncodeCache, DEFAULT_ENCODE_CACHE_PATH
 import google.api_core
 from google.cloud import bigquery
 import json
@@ -20,55 +29,86 @@ logger = logging.getLogger(__name__)
 @click.option("--timeout", help="Seconds to wait for the bigquery job to complete", type=float,  default=1800)
 @click.option("--project", help="gcp project to use", default="massive-clone-705")
 @click.option("--dataset",  help="gcp project to use", default="rmartin_bq_cache")
-def main(timeout, project, dataset):
+@click.option("--encode-cache", help="sqlite file caching encoded queries, empty to disable", default=DEFAULT_ENCODE_CACHE_PATH)
+@click.option("--max-in-flight", help="maximum number of bigquery jobs running at once", type=int, default=8)
+@click.option("--plan", help="dry run every node that would be built and print the estimates, creating nothing", is_flag=True)
+@click.option("--stats", help="sqlite file of per hash build durations for scheduling, empty to disable", default=DEFAULT_STATS_PATH)
+@click.option("--ttl-days", help="days until a newly built cache table expires, 0 to keep it forever", type=float, default=30)
+@click.option("--budget-gb", help="evict least recently used cache tables beyond this many GB, 0 to never evict, needs --shared-catalog", type=float, default=0)
+@click.option("--catalog", help="sqlite file cataloging every cache table and its reuse", default=DEFAULT_CATALOG_PATH)
+@click.option("--shared-catalog", help="keep the catalog as a table in the cache dataset instead", is_flag=True)
+@click.option("--lease-seconds", help="seconds a build lease lasts without renewal, before others take over", type=float, default=600)
+@click.option("--job-bucket-minutes", help="runs and retries within the same window of this many minutes share the job of a hash", type=float, default=60)
+@click.option("--incremental", help="ALIAS:COLUMN, build the node of ALIAS partitioned by the DATE COLUMN and refresh only recent partitions", multiple=True)
+@click.option("--lookback-days", help="partitions before today recomputed on every run of an incremental node", type=int, default=2)
+@click.option("--versioned", help="fold the last modified times of the base tables read into the cache keys", is_flag=True)
+@click.option("--lineage", help="sqlite file indexing which cache tables derive from which tables, for invalidate.py", default=DEFAULT_LINEAGE_PATH)
+@click.option("--shared-lineage", help="keep the lineage index as a table in the cache dataset instead", is_flag=True)
+@click.option("--async-jobs", help="submit jobs without waiting and poll them together, --max-in-flight can be in the hundreds", is_flag=True)
+def main(timeout, project, dataset, encode_cache, max_in_flight, plan, stats, ttl_days, budget_gb, catalog,
+         shared_catalog, lease_seconds, job_bucket_minutes, incremental, lookback_days, versioned, lineage,
+         shared_lineage, async_jobs):
+    # a local catalog knows nothing of other users' reads, so their busiest tables would look unused and go first
+    if budget_gb and not shared_catalog:
+        raise click.UsageError("--budget-gb evicts by recency across every user of the dataset, "
+                               "which needs --shared-catalog")
     client = bigquery.Client(project=project)
-    dataset_ref = client.dataset(dataset)
+    backend = BigQueryBackend(client, dataset, bucket_seconds=job_bucket_minutes * 60)
     #datasource = DataSource(EncodedSource.from_str(offering_query_cached, prefix="cached_"))
+    incremental_specs = {alias: IncrementalSpec(column, lookback_days=lookback_days)
+                         for alias, column in (option.split(":", 1) for option in incremental)}
     with open("resources/complex.sql", "r") as sql_file:
-        datasource = DataSource(EncodedSource.from_str(sql_file.read(), prefix="cached_"))
+        if encode_cache:
+            encoded_source = EncodeCache(encode_cache).from_str(sql_file.read(), prefix="cached_")
+        else:
+            encoded_source = EncodedSource.from_str(sql_file.read(), prefix="cached_")
+    # incremental nodes refresh their own partitions, so they keep their hash when base tables change
+    datasource = DataSource(encoded_source, backend, versioned=versioned, stable=incremental_specs)
 
-    completed = {}
-    running = {}
+    # before the shared catalog and lineage, which create their tables in the dataset
+    if plan:
+        print(dry_run_plan(datasource.plan(), backend, max_in_flight=max_in_flight).format())
+        return
 
-    def apply_to_encoded(hashed: str, source: str, running: List[str] = running, completed: Dict[str, str] = completed):
-        this_completed = completed.get(hashed)
-        if not this_completed:
-            this_running = running.get(hashed)
-            if not this_running:
-                try:
-                    table_ref = client.get_table(f"{dataset}.{hashed}")
-                    completed[hashed] = table_ref
-                    logger.info(f"dependencies met for hash:{hashed}")
-                except google.api_core.exceptions.NotFound as e:
-                    logger.info(f"dependencies NOT met for hash:{hashed}, building...")
-                    running[hashed] = True
-                    completed[hashed] = do_query(hashed, source)
+    node_stats = NodeStats(stats) if stats else None
+    cache_catalog = BigQueryCatalog(client, dataset) if shared_catalog else SQLiteCatalog(catalog)
+    lineage_index = BigQueryLineage(client, dataset) if shared_lineage else SQLiteLineage(lineage, project=project)
 
+    # called from the executor threads, at most once per missing hash, only after every dependency completed
     def do_query(hash, sql):
         logger.info(f"sql:{sql}")
         tic = time.perf_counter()
-        query_config = google.cloud.bigquery.job.QueryJobConfig(
-            destination=f"{project}.{dataset}.{hash}",
-            default_dataset=dataset_ref,
-            priority=bigquery.QueryPriority.INTERACTIVE
-        )
-        query_job = client.query(
-            sql,
-            job_config=query_config,
-        )
-        result = query_job.result()
+        bytes_processed = backend.materialize(hash, sql, ttl=ttl_days * 24 * 3600 or None)
         toc = time.perf_counter()
         logger.info(f"query took:{toc - tic} seconds")
-        logger.info(f"total bytes processed:{query_job.total_bytes_processed:,}")
-        logger.info(f"result:{result}")
-        # logger.info(f"df:{df}")
-        return result
+        logger.info(f"total bytes processed:{bytes_processed:,}")
+        if node_stats:
+            node_stats.record(hash, toc - tic, bytes_processed)
+        return bytes_processed
 
     tic = time.perf_counter()
-    datasource.apply_dependency_first(apply_func=apply_to_encoded)
+    scheduler = CriticalPathScheduler(node_stats, backend, max_in_flight=max_in_flight) if node_stats else None
+    if async_jobs:
+        if incremental:
+            raise click.UsageError("--incremental nodes are only refreshed without --async-jobs")
+        executor = AsyncDependencyExecutor(BigQueryJobBackend(client, dataset, bucket_seconds=job_bucket_minutes * 60),
+                                           max_in_flight=max_in_flight,
+                                           ttl=ttl_days * 24 * 3600 or None)
+        completed = datasource.build_async(executor, scheduler=scheduler, catalog=cache_catalog, lineage=lineage_index)
+        if node_stats:
+            for hash, state in completed.items():
+                node_stats.record(hash, state.seconds(), state.bytes_processed())
+    else:
+        leases = LeasedBuilder(BigQueryLeaseStore(client, dataset), backend, lease_seconds=lease_seconds)
+        completed = datasource.build(max_in_flight=max_in_flight, scheduler=scheduler, build_func=do_query,
+                                     ttl=ttl_days * 24 * 3600 or None, catalog=cache_catalog, leases=leases,
+                                     incremental=incremental_specs, lineage=lineage_index)
     toc = time.perf_counter()
     logger.info(f"completed:{completed}")
     logger.info(f"TOTAL queries took:{toc - tic} seconds")
+    logger.info(f"catalog totals for this query:{cache_catalog.totals(datasource.plan().hashes())}")
+    if budget_gb:
+        evict(backend, cache_catalog, int(budget_gb * 2 ** 30), protect=datasource.plan().hashes())
 
 
 
@@ -2,11 +2,15 @@
 
 from __future__ import annotations
 
+from contextlib import contextmanager
 import functools
+import hashlib
 import logging
-from typing import Union, Dict, List, Tuple
+import threading
+from typing import Union, Dict, Iterator, List, Tuple
 
 import sqlparse
+from sqlparse import engine
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)s %(name)s %(message)s',
@@ -45,6 +49,22 @@ def clean(tokens: sqlparse.tokens, recurse=False) -> sqlparse.tokens:
         prev_token = token
     return ret_tokens
 
+def normalize_tokens(tokens: sqlparse.tokens) -> str:
+    # single pass over an ungrouped token stream: drop comments, collapse whitespace runs and trim the ends
+    out = []
+    pending_whitespace = None
+    for token in tokens:
+        if token.is_whitespace or token.ttype in sqlparse.tokens.Comment:
+            if pending_whitespace is None:
+                # a comment on its own still separates the tokens around it
+                pending_whitespace = token.value if token.is_whitespace else " "
+        else:
+            if pending_whitespace is not None and out:
+                out.append(pending_whitespace)
+            pending_whitespace = None
+            out.append(token.value)
+    return "".join(out)
+
 def serialize_tokens(tokens: sqlparse.tokens):
 
     out = ""
@@ -56,12 +76,69 @@ def serialize_tokens(tokens: sqlparse.tokens):
             out += token.value
     return out
 
+def source_digest(source_str: str) -> str:
+    hasher = hashlib.sha1()
+    hasher.update(source_str.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+# grouped statements of the encode run in progress, keyed by the digest of the text they were parsed from.
+# normalized text is stored under its own digest too, so re-parsing a serialized CTE body is a lookup.
+# the cache lives as long as the outermost parse_scope of its thread, so no token tree outlives the run
+# that parsed it
+_parse_scopes = threading.local()
+
+
+@contextmanager
+def parse_scope() -> Iterator[Dict[str, Tuple[sqlparse.sql.Statement, ...]]]:
+    cache = getattr(_parse_scopes, "cache", None)
+    if cache is not None:
+        yield cache
+        return
+    _parse_scopes.cache = {}
+    try:
+        yield _parse_scopes.cache
+    finally:
+        _parse_scopes.cache = None
+
+
+def parse_normalized(source_str: str) -> Tuple[sqlparse.sql.Statement, ...]:
+    with parse_scope() as parse_cache:
+        digest = source_digest(source_str)
+        statements = parse_cache.get(digest)
+        if statements is None:
+            split_statements = []
+            # split without grouping, normalize the flat tokens, then group the normalized text exactly once
+            for split in engine.FilterStack().run(source_str):
+                normalized = normalize_tokens(split.tokens)
+                normalized_digest = source_digest(normalized)
+                normalized_statements = parse_cache.get(normalized_digest)
+                if normalized_statements is None:
+                    normalized_statements = tuple(sqlparse.parse(normalized))
+                    parse_cache[normalized_digest] = normalized_statements
+                split_statements.extend(normalized_statements)
+            statements = tuple(split_statements)
+            parse_cache[digest] = statements
+        return statements
+
+
+def node_key(body: str, child_keys: List[Tuple[str, str]]) -> str:
+    # merkle key of a node: its normalized body plus the (alias, key) of each direct dependency, in alias order.
+    # a subtree can be verified from its body and child keys alone, without rendering any sql.
+    hasher = hashlib.sha1()
+    hasher.update(body.encode('utf-8'))
+    for alias, child_key in sorted(child_keys):
+        hasher.update(f"\0{alias}\0{child_key}".encode('utf-8'))
+    return hasher.hexdigest()
+
+
 class ParsedSource:
 
     def __init__(self,
                  source: Source):
         self._source = source
         self._parsed_statements = self.__parse()
+        self._serialized = {}
 
     def source(self) -> Source:
         return self._source
@@ -70,18 +147,15 @@ class ParsedSource:
         return self._parsed_statements
 
     def serialize(self, reindent=False) -> str:
-        raw_string = ";".join([serialize_tokens(statement.tokens) for statement in self._parsed_statements])
-        return sqlparse.format(raw_string, reindent=reindent, keyword_case='upper')
+        serialized = self._serialized.get(reindent)
+        if serialized is None:
+            raw_string = ";".join([serialize_tokens(statement.tokens) for statement in self._parsed_statements])
+            serialized = sqlparse.format(raw_string, reindent=reindent, keyword_case='upper')
+            self._serialized[reindent] = serialized
+        return serialized
 
     def __parse(self) -> List[sqlparse.sql.Statement]:
-        split_statements = []
-        for split in sqlparse.split(self._source.source()):
-            parsed_split = sqlparse.parse(split)  # sqlparse.format(split, reindent=True, keyword_case='upper'))
-            for statement in parsed_split:
-                serialized = serialize_tokens(statement.tokens)
-                stripped_tokens = sqlparse.parse(serialized)
-                split_statements.extend(stripped_tokens)
-        return split_statements
+        return list(parse_normalized(self._source.source()))
 
     def extract_statements(self) -> List[Tuple[str, sqlparse.tokens]]:
         statements = []
@@ -97,21 +171,33 @@ class DecomposedSource:
 
     def __init__(self,
                  parsed_source: ParsedSource,
-                 known_dependencies: Dict[str, DecomposedSource] = None,
+                 known_dependencies: Dict[str, Tuple[str, sqlparse.tokens]] = None,
                  extract_statements = True,
-                 alias: str = None):
+                 alias: str = None,
+                 decomposed_by_alias: Dict[str, DecomposedSource] = None):
         self._alias = alias
         self._dependencies = []
         self._parsed_sources = []
         self._known_dependencies = known_dependencies
+        self._keys = None
+        self._reachability = None
+        self._serialized = None
+        self._transitive_dependencies = None
+        if alias and decomposed_by_alias is not None:
+            # register before decomposing so every other reference to this alias shares this node
+            decomposed_by_alias[alias] = self
         if extract_statements:
             for statements in parsed_source.extract_statements():
+                # each CTE of a statement is decomposed once, however many paths reference it
+                statement_decomposed_by_alias = {} if decomposed_by_alias is None else decomposed_by_alias
+                statement_alias_index = self._known_dependencies or alias_index(statements)
                 for name, tokens in statements:
                     sub_source = ParsedSource(Source(serialize_tokens(tokens)))
                     decomposed_dependencies = self._decompose_dependencies(
                         name,
                         sub_source,
-                        top_level_statements=self._known_dependencies or statements)
+                        top_level_statements=statement_alias_index,
+                        decomposed_by_alias=statement_decomposed_by_alias)
                     self._dependencies.extend(decomposed_dependencies)
                     self._parsed_sources.append(sub_source)
         else:
@@ -120,7 +206,8 @@ class DecomposedSource:
                 decomposed_dependencies = self._decompose_dependencies(
                     self._alias,
                     sub_source,
-                    top_level_statements=self._known_dependencies)
+                    top_level_statements=self._known_dependencies,
+                    decomposed_by_alias={} if decomposed_by_alias is None else decomposed_by_alias)
                 self._dependencies.extend(decomposed_dependencies)
                 self._parsed_sources.append(sub_source)
 
@@ -133,32 +220,73 @@ class DecomposedSource:
     def dependencies(self, recurse: bool = False) -> List[Dict[str, DecomposedSource]]:
         dependencies = self._dependencies
         if recurse:
-            for dependency_map in dependencies:
-                for name, dependency in dependency_map.items():
-                    dependencies.extend(dependency.dependencies())
+            # our own maps followed by the direct maps of every transitive dependency, each node once
+            dependencies = list(dependencies)
+            for dependency in self.transitive_dependencies():
+                dependencies.extend(dependency.dependencies())
         return dependencies
 
+    # every node this one depends on, directly or not, once each and dependencies first.
+    # produced lazily and memoized per node, so partial iteration or membership only pays for what it reads
+    def transitive_dependencies(self) -> TransitiveDependencies:
+        if self._transitive_dependencies is None:
+            self._transitive_dependencies = TransitiveDependencies(self._iterate_transitive_dependencies())
+        return self._transitive_dependencies
+
+    def _iterate_transitive_dependencies(self) -> Iterator[DecomposedSource]:
+        seen = set()
+        for dependency_map in self._dependencies:
+            for dependency in dependency_map.values():
+                if id(dependency) not in seen:
+                    # reuses the child's memoized closure rather than walking its subtree again
+                    for transitive_dependency in dependency.transitive_dependencies():
+                        if id(transitive_dependency) not in seen:
+                            seen.add(id(transitive_dependency))
+                            yield transitive_dependency
+                    seen.add(id(dependency))
+                    yield dependency
+
     def alias(self) -> str:
         return self._alias
 
     def serialize(self, recurse: bool = False, top_level: bool = True) -> str:
-        raw_string = ";".join([parsed_source.serialize() for parsed_source in self._parsed_sources])
-        return sqlparse.format(raw_string, keyword_case='upper')
+        # inlined dependencies are rendered once per parent, so format once per node
+        if self._serialized is None:
+            raw_string = ";".join([parsed_source.serialize() for parsed_source in self._parsed_sources])
+            self._serialized = sqlparse.format(raw_string, keyword_case='upper')
+        return self._serialized
+
+    # merkle key per statement, computed bottom up once per node
+    def keys(self) -> List[str]:
+        if self._keys is None:
+            self._keys = [node_key(parsed_source.serialize(), self.child_keys(dependencies))
+                          for parsed_source, dependencies in zip(self._parsed_sources, self._dependencies)]
+        return self._keys
+
+    def key(self) -> str:
+        return self.keys()[-1]
+
+    @staticmethod
+    def child_keys(dependencies: Dict[str, DecomposedSource]) -> List[Tuple[str, str]]:
+        return sorted((alias, dependency.key()) for alias, dependency in dependencies.items() if alias)
 
     def has_dependency(self, potential_dependency: DecomposedSource, recurse: bool = True) -> bool:
 
         ret_val = False
         alias = potential_dependency.alias()
         if alias:
-            ret_val = self._has_dependency(potential_dependency)
             if recurse:
-                for dependency_mapping in self._dependencies:
-                    for decomposed_source in dependency_mapping.values():
-                        if decomposed_source.has_dependency(potential_dependency):
-                            ret_val = True
-                            break
+                ret_val = self.reachability().depends_on(self, potential_dependency)
+            else:
+                ret_val = self._has_dependency(potential_dependency)
         return ret_val
 
+    # index of everything reachable from this node, built on first use
+    def reachability(self) -> ReachabilityIndex:
+        if self._reachability is None:
+            self._reachability = ReachabilityIndex(self)
+        return self._reachability
+
     def _has_dependency(self, potential_dependency: DecomposedSource) -> bool:
         return potential_dependency.alias() and \
                next((dep for dep in self.dependencies() if potential_dependency.alias() in dep.keys()), None) is not None
@@ -167,40 +295,254 @@ class DecomposedSource:
     def _decompose_dependencies(self,
                                 name: str,
                                 parsed_source: ParsedSource,
-                                top_level_statements: Dict[str, DecomposedSource]) -> List[Dict[str, DecomposedSource]]:
+                                top_level_statements: Dict[str, Tuple[str, sqlparse.tokens]],
+                                decomposed_by_alias: Dict[str, DecomposedSource]) -> List[Dict[str, DecomposedSource]]:
 
         all_statement_dependencies = []
         # recursively decompose statements by dependency
         for statement in parsed_source.parsed_statements():
             statement_dependencies = {}
-            aliases = [statement_pair[0] for statement_pair in top_level_statements if statement_pair[0]]
-            for dependency in map_dependencies(name, statement, known_aliases=aliases):
-                dependency_tokens = next(statement_pair[1] for statement_pair in top_level_statements if statement_pair[0] == dependency)
-                sub_source = ParsedSource(Source(serialize_tokens(dependency_tokens)))
-                statement_dependencies[dependency] = DecomposedSource(
-                    sub_source,
-                    known_dependencies=top_level_statements,
-                    alias=dependency,
-                    extract_statements=False)
+            for dependency in map_dependencies(name, statement, known_aliases=top_level_statements):
+                decomposed_dependency = decomposed_by_alias.get(dependency)
+                if decomposed_dependency is None:
+                    dependency_tokens = top_level_statements[normalize_alias(dependency)][1]
+                    sub_source = ParsedSource(Source(serialize_tokens(dependency_tokens)))
+                    decomposed_dependency = DecomposedSource(
+                        sub_source,
+                        known_dependencies=top_level_statements,
+                        alias=dependency,
+                        extract_statements=False,
+                        decomposed_by_alias=decomposed_by_alias)
+                statement_dependencies[dependency] = decomposed_dependency
             all_statement_dependencies.append(statement_dependencies)
         return all_statement_dependencies
 
 
+class TransitiveDependencies:
+    # caches what a generator has produced so far, so any number of readers share one lazy walk
+
+    def __init__(self, generator: Iterator[DecomposedSource]):
+        self._generator = generator
+        self._produced = []
+        self._produced_ids = set()
+
+    def __iter__(self) -> Iterator[DecomposedSource]:
+        idx = 0
+        while idx < len(self._produced) or self._advance():
+            yield self._produced[idx]
+            idx += 1
+
+    def __contains__(self, node: DecomposedSource) -> bool:
+        while id(node) not in self._produced_ids:
+            if not self._advance():
+                return False
+        return True
+
+    def _advance(self) -> bool:
+        if self._generator is not None:
+            node = next(self._generator, None)
+            if node is not None:
+                self._produced.append(node)
+                self._produced_ids.add(id(node))
+                return True
+            self._generator = None
+        return False
+
+    def complete(self) -> bool:
+        return self._generator is None
+
+
+class CycleError(ValueError):
+
+    def __init__(self, aliases: List[str]):
+        super().__init__(f"dependency cycle between: {', '.join(str(alias) for alias in aliases)}")
+        self.aliases = aliases
+
+
+class DependencyGraph:
+    # iterative Kahn sort over hashable vertices, kept in insertion order so the output is deterministic.
+    # levels() groups vertices whose dependencies are all in earlier levels, so each level can run in parallel.
+
+    def __init__(self):
+        self._edges = {}
+        self._names = {}
+
+    def add_vertex(self, vertex, name: str = None):
+        if vertex not in self._edges:
+            self._edges[vertex] = []
+            self._names[vertex] = vertex if name is None else name
+
+    # before must be ordered ahead of after
+    def add_edge(self, before, after):
+        self.add_vertex(before)
+        self.add_vertex(after)
+        self._edges[before].append(after)
+
+    def vertices(self) -> List:
+        return list(self._edges.keys())
+
+    def levels(self) -> List[List]:
+        in_degree = {vertex: 0 for vertex in self._edges}
+        for afters in self._edges.values():
+            for after in afters:
+                in_degree[after] += 1
+        order = {vertex: idx for idx, vertex in enumerate(self._edges)}
+        level = [vertex for vertex, degree in in_degree.items() if degree == 0]
+        levels = []
+        while level:
+            levels.append(level)
+            next_level = []
+            for vertex in level:
+                for after in self._edges[vertex]:
+                    in_degree[after] -= 1
+                    if in_degree[after] == 0:
+                        next_level.append(after)
+            # keep insertion order within a level regardless of discovery order
+            next_level.sort(key=order.__getitem__)
+            level = next_level
+        if sum(len(level) for level in levels) != len(self._edges):
+            raise CycleError([self._names[vertex] for vertex in self._cycle_vertices(in_degree)])
+        return levels
+
+    def topological_sort(self) -> List:
+        return [vertex for level in self.levels() for vertex in level]
+
+    def _cycle_vertices(self, in_degree: Dict) -> List:
+        # whatever kahn could not emit is on a cycle or downstream of one. trim the downstream part
+        remaining = {vertex for vertex, degree in in_degree.items() if degree > 0}
+        trimmed = True
+        while trimmed:
+            trimmed = False
+            for vertex in list(remaining):
+                if not any(after in remaining for after in self._edges[vertex]):
+                    remaining.discard(vertex)
+                    trimmed = True
+        return [vertex for vertex in self._edges if vertex in remaining]
+
+
+class ReachabilityIndex:
+    # transitive dependencies of every node under a root, as one bit per alias in a bitset per node.
+    # built once in topological order, after which "does A depend on B" is a single mask.
+    # raises CycleError if the nodes under the root do not form a DAG.
+
+    def __init__(self, root: DecomposedSource):
+        self._bits = {}
+        self._reachable = {}
+        self._nodes = {}
+        self.add(root)
+
+    def add(self, root: DecomposedSource):
+        # collect the nodes not indexed yet, then fill their bitsets dependencies first
+        graph = DependencyGraph()
+        nodes = {id(root): root}
+        graph.add_vertex(id(root), name=root.alias())
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            for dependency_map in node.dependencies():
+                for child in dependency_map.values():
+                    if id(child) not in self._reachable:
+                        if id(child) not in nodes:
+                            nodes[id(child)] = child
+                            graph.add_vertex(id(child), name=child.alias())
+                            pending.append(child)
+                        graph.add_edge(id(child), id(node))
+        for vertex in graph.topological_sort():
+            node = nodes[vertex]
+            reachable = 0
+            for dependency_map in node.dependencies():
+                for child in dependency_map.values():
+                    reachable |= self._bit(child.alias()) | self._reachable[id(child)]
+            self._reachable[vertex] = reachable
+            self._nodes[vertex] = node
+
+    def _bit(self, alias: str) -> int:
+        bit = self._bits.get(alias)
+        if bit is None:
+            bit = 1 << len(self._bits)
+            self._bits[alias] = bit
+        return bit
+
+    def reachable(self, node: DecomposedSource) -> int:
+        if id(node) not in self._reachable:
+            self.add(node)
+        return self._reachable[id(node)]
+
+    def depends_on(self, node: DecomposedSource, potential_dependency: Union[DecomposedSource, EncodedSource]) -> bool:
+        reachable = self.reachable(node)
+        bit = self._bits.get(potential_dependency.alias())
+        return bit is not None and bool(reachable & bit)
+
+
+class EncodedNode:
+    # what the encoder emits for one statement: no token trees, nothing that can change after encoding.
+    # dependency_hashes are the materialized dependencies to build first, child_hashes every direct
+    # dependency that went into the merkle key.
+    __slots__ = ("_alias", "_hashed", "_sql", "_child_hashes", "_dependency_hashes")
+
+    def __init__(self,
+                 alias: str,
+                 hashed: str,
+                 sql: str,
+                 child_hashes: Tuple[Tuple[str, str], ...],
+                 dependency_hashes: Tuple[str, ...]):
+        object.__setattr__(self, "_alias", alias)
+        object.__setattr__(self, "_hashed", hashed)
+        object.__setattr__(self, "_sql", sql)
+        object.__setattr__(self, "_child_hashes", tuple(child_hashes))
+        object.__setattr__(self, "_dependency_hashes", tuple(dependency_hashes))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self) -> str:
+        return f"EncodedNode(alias={self._alias!r}, hashed={self._hashed!r})"
+
+    def alias(self) -> str:
+        return self._alias
+
+    def hashed(self) -> str:
+        return self._hashed
+
+    def sql(self) -> str:
+        return self._sql
+
+    def child_hashes(self) -> Tuple[Tuple[str, str], ...]:
+        return self._child_hashes
+
+    def dependency_hashes(self) -> Tuple[str, ...]:
+        return self._dependency_hashes
+
+
 class EncodedSource:
 
     def __init__(self,
                  decomposed_source: DecomposedSource,
                  known_dependencies: Dict[str, EncodedSource] = None,
-                 prefix: str = ""):
+                 prefix: str = "",
+                 encoded_by_alias_key: Dict[Tuple[str, str], EncodedSource] = None,
+                 reachability: ReachabilityIndex = None):
         assert(isinstance(decomposed_source, DecomposedSource))
         self._alias = decomposed_source.alias()
         self._decomposed_source = decomposed_source
         self._aliased_source = []
         self._hashed_sources = []
+        self._child_hashes = []
         self._encoded_sources = []
         self._encoded_dependencies = []
+        self._nodes = None
         self._known_dependencies = known_dependencies or {}
-        for parsed_source, dependencies in zip(decomposed_source.parsed_sources(), decomposed_source.dependencies()):
+        # shared dependencies are encoded once per run. keyed by alias too, since the alias is rendered by parents
+        encoded_by_alias_key = {} if encoded_by_alias_key is None else encoded_by_alias_key
+        # one index for the whole run answers every "does A depend on B" while ordering inlined dependencies.
+        # building it first also rejects cyclic queries before anything recurses through them
+        reachability = reachability or decomposed_source.reachability()
+        for parsed_source, dependencies, hashed in zip(decomposed_source.parsed_sources(),
+                                                       decomposed_source.dependencies(),
+                                                       decomposed_source.keys()):
             # recursively encode dependencies first
             sub_encoded_dependencies = []
             include_source_dependencies = []
@@ -209,15 +551,21 @@ class EncodedSource:
             for alias, dependency in dependencies.items():
                 if alias:
                     if dependency.alias().startswith(prefix):
-                        encoded_dependency = EncodedSource(dependency, known_dependencies=self._known_dependencies, prefix=prefix)
+                        encoded_dependency = encoded_by_alias_key.get((alias, dependency.key()))
+                        if encoded_dependency is None:
+                            encoded_dependency = EncodedSource(dependency,
+                                                               known_dependencies=self._known_dependencies,
+                                                               prefix=prefix,
+                                                               encoded_by_alias_key=encoded_by_alias_key,
+                                                               reachability=reachability)
+                            encoded_by_alias_key[(alias, dependency.key())] = encoded_dependency
                         sub_encoded_dependencies.append(encoded_dependency)
                         #all_encoded_dependencies[alias] = encoded_dependency
                         #include_source_dependencies.append(f"{alias} AS (SELECT * FROM `{encoded_dependency.hashed_sources()[-1]}`)")
                     else:
                         unencoded_dependencies_by_name[alias] = dependency
-                        dependency_map_list = dependency.dependencies(recurse=True)
-                        for dependency_map in dependency_map_list:
-                            unencoded_dependencies_by_name.update(dependency_map)
+                        for transitive_dependency in dependency.transitive_dependencies():
+                            unencoded_dependencies_by_name.setdefault(transitive_dependency.alias(), transitive_dependency)
                     #include_source_dependencies.extend(f"{alias} AS ({dependency.serialize(recurse=True)})")
             self._encoded_dependencies.append(sub_encoded_dependencies)
 
@@ -230,44 +578,28 @@ class EncodedSource:
             for alias, dependency in unencoded_dependencies_by_name.items():
                 include_source_dependencies.append(dependency)
 
-            # https://stackoverflow.com/questions/47192626/deceptively-simple-implementation-of-topological-sorting-in-python
-            # def iterative_topological_sort(graph, start):
-            #     seen = set()
-            #     stack = []    # path variable is gone, stack and order are new
-            #     order = []    # order will be in reverse order at first
-            #     q = [start]
-            #     while q:
-            #         v = q.pop()
-            #         if v not in seen:
-            #             seen.add(v) # no need to append to path any more
-            #             q.extend(graph[v])
-            #
-            #             while stack and v not in graph[stack[-1]]:
-            #                 order.append(stack.pop())
-            #             stack.append(v)
-            #
-            #     return stack + order[::-1]
-
             if include_source_dependencies:
                 #logger.info(f"BEFORE include_source_dependencies:{[dep.alias() for dep in include_source_dependencies]}")
-                dep_graph = Graph(len(include_source_dependencies))
+                dep_graph = DependencyGraph()
+                for idx, dep in enumerate(include_source_dependencies):
+                    dep_graph.add_vertex(idx, name=dep.alias())
                 #start = [dep for dep in include_source_dependencies if dep.alias() in dependencies.keys()]
                 #logger.info(f"start deps:{[dep.alias() for dep in start]}")
                 idx_source = 0
                 for source in include_source_dependencies:
                     if isinstance(source, EncodedSource):
-                        decomposed_source = source.decomposed_source()
+                        source_decomposed = source.decomposed_source()
                     else:
-                        decomposed_source = source
+                        source_decomposed = source
                     idx_dep = 0
                     #for dep in [dep for dep in include_source_dependencies if dep.alias() in source_dep_keys]:
                     for target in include_source_dependencies:
-                        if decomposed_source is not target and decomposed_source.has_dependency(target):
+                        if source_decomposed is not target and reachability.depends_on(source_decomposed, target):
                             #logger.info(f"adding edge:source: {source.alias()} dep: {target.alias()}")
-                            dep_graph.addEdge(idx_dep, idx_source)
+                            dep_graph.add_edge(idx_dep, idx_source)
                         idx_dep += 1
                     idx_source += 1
-                sorted_indices = dep_graph.topologicalSort()
+                sorted_indices = dep_graph.topological_sort()
                 #logger.info(f"sorted_indices:{sorted_indices}")
                 include_source_dependencies_new = [include_source_dependencies[idx] for idx in sorted_indices]
                 include_source_dependencies = include_source_dependencies_new
@@ -281,11 +613,8 @@ class EncodedSource:
                 serialized += ",\n".join([f" {dep.alias()} AS ({dep.serialize()})" for dep in include_source_dependencies]) + "\n"
             serialized += f"{parsed_source.serialize()}"
             self._encoded_sources.append(serialized)
-            import hashlib
-            hasher = hashlib.sha1()
-            hasher.update(serialized.encode('utf-8'))
-            hashed = hasher.hexdigest()
             self._hashed_sources.append(hashed)
+            self._child_hashes.append(tuple(DecomposedSource.child_keys(dependencies)))
             self._known_dependencies[hashed] = self
 
     def alias(self) -> str:
@@ -298,10 +627,14 @@ class EncodedSource:
     def encoded_sources(self) -> List[str]:
         return self._encoded_sources
 
-    # hashes all sources, included encoded dependency references
+    # merkle keys of all sources, see node_key
     def hashed_sources(self) -> List[str]:
         return self._hashed_sources
 
+    # (alias, hash) of every direct dependency per source, encoded or inlined, as fed to node_key
+    def child_hashes(self) -> List[Tuple[Tuple[str, str], ...]]:
+        return self._child_hashes
+
     # direct encoded dependencies
     def encoded_dependencies(self) -> List[List[EncodedSource]]:
         return self._encoded_dependencies
@@ -310,29 +643,91 @@ class EncodedSource:
     def all_encoded_sources_by_name(self) -> Dict[str, EncodedSource]:
         return self._known_dependencies
 
+    # compact nodes, one per source. holding these instead of the encoded source lets the token trees go
+    def nodes(self) -> List[EncodedNode]:
+        if self._nodes is None:
+            self._nodes = [EncodedNode(self._alias,
+                                       hashed,
+                                       encoded,
+                                       child_hashes,
+                                       tuple(dependency.hashed_sources()[-1] for dependency in dependencies))
+                           for hashed, encoded, child_hashes, dependencies in zip(self._hashed_sources,
+                                                                                 self._encoded_sources,
+                                                                                 self._child_hashes,
+                                                                                 self._encoded_dependencies)]
+        return self._nodes
+
+    def node(self) -> EncodedNode:
+        return self.nodes()[-1]
+
+    # compact nodes of everything known by this source structure, by hash
+    def all_encoded_nodes(self) -> Dict[str, EncodedNode]:
+        return {hashed: next(node for node in source.nodes() if node.hashed() == hashed)
+                for hashed, source in self._known_dependencies.items()}
+
     def serialize(self, reindent=False) -> str:
         return sqlparse.format(f"SELECT * FROM `{self._hashed_sources[-1]}`", reindent=reindent, keyword_case='upper')
 
     @staticmethod
     def from_str(source_str: str, prefix=""):
-        return EncodedSource(DecomposedSource(ParsedSource(Source(source_str))), prefix=prefix)
-
+        with parse_scope():
+            return EncodedSource(DecomposedSource(ParsedSource(Source(source_str))), prefix=prefix)
 
-def map_dependencies(name: str, statement: sqlparse.sql.Statement, known_aliases: List[str]) -> List[str]:
+    # rebuild an already encoded node without parsing. there is no decomposed source behind it.
+    @staticmethod
+    def restore(alias: str,
+                encoded_sources: List[str],
+                hashed_sources: List[str],
+                child_hashes: List[Tuple[Tuple[str, str], ...]],
+                encoded_dependencies: List[List[EncodedSource]],
+                known_dependencies: Dict[str, EncodedSource]) -> EncodedSource:
+        restored = EncodedSource.__new__(EncodedSource)
+        restored._alias = alias
+        restored._decomposed_source = None
+        restored._aliased_source = []
+        restored._encoded_sources = encoded_sources
+        restored._hashed_sources = hashed_sources
+        restored._child_hashes = child_hashes
+        restored._nodes = None
+        restored._encoded_dependencies = encoded_dependencies
+        restored._known_dependencies = known_dependencies
+        return restored
+
+
+def normalize_alias(alias: str) -> str:
+    # BigQuery CTE names are case insensitive and may be quoted with backticks
+    return alias.strip('`').lower()
+
+
+def alias_index(statements: List[Tuple[str, sqlparse.tokens]]) -> Dict[str, Tuple[str, sqlparse.tokens]]:
+    # normalized alias -> (alias as declared, tokens), built once per statement
+    return {normalize_alias(name): (name, tokens) for name, tokens in statements if name}
+
+
+def map_dependencies(name: str,
+                     statement: sqlparse.sql.Statement,
+                     known_aliases: Dict[str, Tuple[str, sqlparse.tokens]]) -> List[str]:
     single_dependencies = map_dependencies_single(name=name, known_aliases=known_aliases, tokens=statement.tokens)
     return single_dependencies
 
 
-def map_dependencies_single(name: str, known_aliases: List[str], tokens: sqlparse.tokens) -> List[str]:
+def map_dependencies_single(name: str,
+                            known_aliases: Dict[str, Tuple[str, sqlparse.tokens]],
+                            tokens: sqlparse.tokens) -> List[str]:
     dependency_list = []
+    own_alias = normalize_alias(name) if name else None
+    previous_token = None
     for token in tokens:
-        # TODO: might need recursive flatten here
         for flat_token in token.flatten():
-            dependency = flat_token.value
-            # see if we have a query which maps to this name
-            if (not name or dependency != name) and dependency in known_aliases:
-                dependency_list.append(dependency)
-        # dependencies[cte_name] = dependency_list
+            # only identifiers can name a CTE, and not when qualified by something before a dot
+            if flat_token.ttype in sqlparse.tokens.Name and \
+                    not (previous_token is not None and previous_token.match(sqlparse.tokens.Punctuation, '.')):
+                dependency = normalize_alias(flat_token.value)
+                # see if we have a query which maps to this name
+                if dependency != own_alias and dependency in known_aliases:
+                    dependency_list.append(known_aliases[dependency][0])
+            if not flat_token.is_whitespace:
+                previous_token = flat_token
     return dependency_list
 
 
@@ -393,67 +788,3 @@ def extract_statements(tokens: sqlparse.tokens) -> Union[str, sqlparse.tokens]:
 
     if remaining_tokens:
         yield None, remaining_tokens
-
-
-# https://www.geeksforgeeks.org/topological-sorting/
-# Class to represent a graph
-from collections import defaultdict
-class Graph:
-    def __init__(self, vertices):
-        self.graph = defaultdict(list)  # dictionary containing adjacency List
-        self.V = vertices  # No. of vertices
-
-    # function to add an edge to graph
-    def addEdge(self, u, v):
-        self.graph[u].append(v)
-
-        # A recursive function used by topologicalSort
-    def topologicalSortUtil(self, v, visited, stack):
-
-        # Mark the current node as visited.
-        visited[v] = True
-
-        # Recur for all the vertices adjacent to this vertex
-        for i in self.graph[v]:
-            if visited[i] == False:
-                self.topologicalSortUtil(i, visited, stack)
-
-        # Push current vertex to stack which stores result
-        stack.append(v)
-
-        # The function to do Topological Sort. It uses recursive
-    # topologicalSortUtil()
-    def topologicalSort(self):
-        # Mark all the vertices as not visited
-        visited = [False]*self.V
-        stack = []
-
-        # Call the recursive helper function to store Topological
-        # Sort starting from all vertices one by one
-        for i in range(self.V):
-            if visited[i] == False:
-                self.topologicalSortUtil(i, visited, stack)
-
-                # Print contents of the stack
-        return stack[::-1]  # return list in reverse order
-
-# def sort_by_dependence(x, y):
-#     if isinstance(x, EncodedSource):
-#         x = x.decomposed_source()
-#     if isinstance(y, EncodedSource):
-#         y = y.decomposed_source()
-#     # x a dependency of y?
-#     ret_val = 0
-#     if y.has_dependency(x, recurse=True):
-#         ret_val = -1
-#     elif x.has_dependency(y, recurse=True):
-#         ret_val = 1
-#     logger.info("--")
-#     logger.info(f"{ret_val} x.alias(): {x.alias()} x:{x} y.alias():{y.alias()} y:{y}")
-#     return ret_val
-# include_source_dependencies.sort(key=functools.cmp_to_key(sort_by_dependence))
-# logger.info(f"dependency order:{','.join([dep.alias() for dep in include_source_dependencies])}")
-
-
-
-
@@ -0,0 +1,49 @@
+# what every local sqlite store shares: its file, one connection used from any thread under a lock, and lookups
+# of many keys batched under sqlite's limit on parameters
+
+import logging
+import os
+import sqlite3
+import threading
+from typing import Iterable, List
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# keys bound per statement by _select_in, well under the 999 parameters older sqlite versions allow
+SELECT_BATCH = 500
+
+
+class SQLiteStore:
+    # the directory of path is created if needed, and the schema statements run once on opening.
+    # connect_options go to sqlite3.connect
+
+    def __init__(self, path: str, schema: Iterable[str] = (), **connect_options):
+        self._path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, **connect_options)
+        for statement in schema:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def path(self) -> str:
+        return self._path
+
+    def close(self):
+        self._connection.close()
+
+    # rows of query for every key, its {} replaced with the placeholders of one batch of keys at a time.
+    # takes the lock
+    def _select_in(self, query: str, keys: Iterable[str]) -> List[tuple]:
+        keys = list(keys)
+        rows = []
+        with self._lock:
+            for start in range(0, len(keys), SELECT_BATCH):
+                batch = keys[start:start + SELECT_BATCH]
+                rows.extend(self._connection.execute(query.format(",".join("?" * len(batch))), batch))
+        return rows
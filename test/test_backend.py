@@ -0,0 +1,254 @@
+import sqlite3
+import sys
+import time
+import unittest
+import unittest.mock
+from types import SimpleNamespace
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+import google.api_core.exceptions
+from src.bq.backend import BigQueryBackend, InMemoryBackend, SQLiteBackend, job_id_for
+from src.bq.data_source import DataSource
+
+
+class ListTablesClient:
+    # just enough of bigquery.Client for existence checks
+    project = "project"
+
+    def __init__(self, table_ids):
+        self.table_ids = table_ids
+        self.list_calls = 0
+
+    def list_tables(self, dataset, page_size=None):
+        self.list_calls += 1
+        return [SimpleNamespace(table_id=table_id) for table_id in self.table_ids]
+
+    def get_table(self, table):
+        raise AssertionError("existence must not be checked table by table")
+
+
+class QueryJob:
+    # a job that finishes on its first result() call, unless it is to fail or to lose the connection first
+
+    def __init__(self, job_id, state="RUNNING", error_result=None, transient_errors=0):
+        self.job_id = job_id
+        self.state = state
+        self.error_result = error_result
+        self.transient_errors = transient_errors
+        self.total_bytes_processed = 7
+        self.results = 0
+
+    def result(self):
+        self.results += 1
+        if self.transient_errors:
+            self.transient_errors -= 1
+            raise google.api_core.exceptions.ServiceUnavailable("connection dropped")
+        if self.state == "DONE" and self.error_result:
+            raise google.api_core.exceptions.BadRequest(self.error_result["message"])
+        self.state = "DONE"
+
+
+class JobsClient:
+    # just enough of bigquery.Client for jobs with given ids, which conflict like on bigquery
+    project = "project"
+
+    def __init__(self, tables=(), transient_errors=0):
+        self.jobs = {}
+        self.tables = set(tables)
+        self.queries = []
+        self.transient_errors = transient_errors
+
+    def query(self, sql, job_config=None, job_id=None):
+        if job_id in self.jobs:
+            raise google.api_core.exceptions.Conflict(f"job {job_id} exists")
+        self.queries.append(sql)
+        self.jobs[job_id] = QueryJob(job_id, transient_errors=self.transient_errors)
+        return self.jobs[job_id]
+
+    def get_job(self, job_id):
+        return self.jobs[job_id]
+
+    def get_table(self, table_id):
+        if table_id.split(".")[-1] not in self.tables:
+            raise google.api_core.exceptions.NotFound(table_id)
+
+
+class MetaTablesClient:
+    # answers queries on __TABLES__ with last modified times keyed by project.dataset.table
+    project = "project"
+
+    def __init__(self, modified):
+        self.modified = modified
+        self.queries = []
+
+    def query(self, sql, job_config=None):
+        self.queries.append(sql)
+        parameters = {parameter.name: parameter.values for parameter in job_config.query_parameters}
+        rows = []
+        for select in sql.split(" UNION ALL "):
+            dataset_id = select.split("'")[1]
+            parameter = select.rsplit("@", 1)[1].rstrip(")")
+            rows.extend(SimpleNamespace(dataset_id=dataset_id, table_id=table_id,
+                                        last_modified_time=self.modified[f"{dataset_id}.{table_id}"])
+                        for table_id in parameters[parameter] if f"{dataset_id}.{table_id}" in self.modified)
+        return SimpleNamespace(result=lambda: rows)
+
+
+class Test(unittest.TestCase):
+
+    def test_in_memory_existing(self):
+        backend = InMemoryBackend(["a", "b"])
+        self.assertEqual({"a"}, backend.existing(["a", "c"]))
+        backend.add("c")
+        self.assertEqual({"a", "c"}, backend.existing(["a", "c"]))
+        self.assertEqual(2, backend.calls())
+
+    def test_bigquery_existing_single_pass(self):
+        client = ListTablesClient(["a", "b", "other"])
+        backend = BigQueryBackend(client, "dataset")
+        self.assertEqual({"a", "b"}, backend.existing(["a", "b", "c"]))
+        self.assertEqual(set(), backend.existing([]))
+        self.assertEqual(1, client.list_calls)
+
+    def test_bigquery_exists_single_table(self):
+        # no list_tables on this client: a single hash is looked up directly
+        backend = BigQueryBackend(JobsClient(tables=["a"]), "dataset")
+        self.assertTrue(backend.exists("a"))
+        self.assertFalse(backend.exists("b"))
+        self.assertTrue(InMemoryBackend(["a"]).exists("a"))
+
+    def test_job_id_for(self):
+        self.assertEqual(job_id_for("dataset", "a", 3600, now=7200), job_id_for("dataset", "a", 3600, now=10799))
+        self.assertNotEqual(job_id_for("dataset", "a", 3600, now=7200), job_id_for("dataset", "a", 3600, now=10800))
+        self.assertNotEqual(job_id_for("dataset", "a", now=0), job_id_for("dataset", "b", now=0))
+        self.assertNotEqual(job_id_for("dataset", "a", now=0), job_id_for("other", "a", now=0))
+        self.assertNotEqual(job_id_for("dataset", "a", now=0), job_id_for("dataset", "a", now=0, attempt=1))
+
+    def test_bigquery_start_attaches(self):
+        client = JobsClient()
+        backend = BigQueryBackend(client, "dataset")
+        first = backend.start("a", "SELECT 1", ttl=60)
+        self.assertIs(first, backend.start("a", "SELECT 1"))
+        self.assertEqual(1, len(client.queries))
+        self.assertIn("CREATE OR REPLACE TABLE `project.dataset.a` OPTIONS (expiration_timestamp", client.queries[0])
+
+    def test_bigquery_start_after_failure_or_eviction(self):
+        client = JobsClient()
+        backend = BigQueryBackend(client, "dataset")
+        failed = backend.start("a", "SELECT 1")
+        failed.state, failed.error_result = "DONE", {"message": "boom"}
+        retried = backend.start("a", "SELECT 1")
+        self.assertNotEqual(failed.job_id, retried.job_id)
+        # done, but its table was dropped since
+        retried.state = "DONE"
+        self.assertNotIn(backend.start("a", "SELECT 1").job_id, {failed.job_id, retried.job_id})
+        # once the table is there, the job that built it is attached to
+        client.tables.add("a")
+        self.assertEqual(retried.job_id, backend.start("a", "SELECT 1").job_id)
+        self.assertEqual(3, len(client.queries))
+
+    def test_bigquery_materialize_resumes_watching(self):
+        client = JobsClient(transient_errors=2)
+        backend = BigQueryBackend(client, "dataset")
+        with unittest.mock.patch("time.sleep"):
+            self.assertEqual(7, backend.materialize("a", "SELECT 1"))
+        self.assertEqual(1, len(client.queries))
+        self.assertEqual(3, list(client.jobs.values())[0].results)
+
+    def test_bigquery_materialize_gives_up(self):
+        client = JobsClient(transient_errors=10)
+        backend = BigQueryBackend(client, "dataset", max_retries=2)
+        with unittest.mock.patch("time.sleep"), self.assertRaises(google.api_core.exceptions.ServiceUnavailable):
+            backend.materialize("a", "SELECT 1")
+        self.assertEqual(1, len(client.queries))
+
+    def test_bigquery_materialize_reports_job_failure(self):
+        client = JobsClient(transient_errors=1)
+        backend = BigQueryBackend(client, "dataset")
+
+        def failed_job(job_id):
+            job = client.jobs[job_id]
+            job.state, job.error_result = "DONE", {"message": "division by zero"}
+            return job
+
+        client.get_job = failed_job
+        with unittest.mock.patch("time.sleep"), \
+                self.assertRaisesRegex(google.api_core.exceptions.BadRequest, "division by zero"):
+            backend.materialize("a", "SELECT 1 / 0")
+
+    def test_bigquery_table_versions_one_query(self):
+        client = MetaTablesClient({"project.a.t": 1, "other.b.u": 2, "other.b.v": 3})
+        backend = BigQueryBackend(client, "dataset")
+        self.assertEqual({"a.t": "1", "project.a.t": "1", "other.b.u": "2", "other.b.v": "3"},
+                         backend.table_versions(["a.t", "project.a.t", "other.b.u", "other.b.v", "other.b.gone",
+                                                 "unqualified"]))
+        self.assertEqual(1, len(client.queries))
+        self.assertEqual({}, backend.table_versions([]))
+        self.assertEqual(1, len(client.queries))
+
+    def test_in_memory_materialize_and_delete(self):
+        backend = InMemoryBackend(dry_run_bytes=lambda sql: 10)
+        self.assertEqual(10, backend.materialize("a", "SELECT 1"))
+        self.assertEqual(10, backend.metadata(["a", "b"])["a"].num_bytes())
+        backend.delete(["a", "b"])
+        self.assertEqual(set(), backend.existing(["a"]))
+
+    def test_sqlite_build_end_to_end(self):
+        source_str = synthetic_query("diamond", 10, body_size=2)
+        backend = SQLiteBackend()
+        datasource = DataSource(EncodedSource.from_str(source_str), backend)
+        built = datasource.build(max_in_flight=4)
+        plan = datasource.plan()
+        self.assertEqual(set(plan.hashes()), set(built))
+        self.assertEqual(set(plan.hashes()), backend.existing(plan.hashes()))
+        # the root cache table holds exactly what the original query returns
+        expected = sqlite3.connect(":memory:").execute(source_str).fetchall()
+        self.assertEqual(sorted(expected),
+                         sorted(backend.connection().execute(f'SELECT * FROM "{plan.root()}"').fetchall()))
+        metadata = backend.metadata(plan.hashes())
+        self.assertEqual(len(expected), metadata[plan.root()].num_rows())
+        self.assertGreater(metadata[plan.root()].num_bytes(), 0)
+        # nothing left to build, then only what was deleted
+        self.assertEqual({}, datasource.build())
+        backend.delete([plan.root()])
+        self.assertEqual([plan.root()], list(datasource.build()))
+
+    def test_sqlite_dry_run(self):
+        backend = SQLiteBackend()
+        backend.materialize("a", "SELECT 1 AS value UNION ALL SELECT 2")
+        self.assertEqual(backend.metadata(["a"])["a"].num_bytes(), backend.dry_run("SELECT * FROM `a`"))
+        self.assertFalse(backend.existing(["b"]))
+        with self.assertRaises(sqlite3.Error):
+            backend.dry_run("SELECT * FROM `b`")
+
+    def test_injected_latency(self):
+        backend = SQLiteBackend(latency=0.02)
+        tic = time.perf_counter()
+        backend.existing(["a"])
+        self.assertGreaterEqual(time.perf_counter() - tic, 0.02)
+
+    def test_build_needs_backend(self):
+        with self.assertRaises(ValueError):
+            DataSource(EncodedSource.from_str(synthetic_query("chain", 2))).build()
+
+    def test_missing_batched(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 20)))
+        nodes = datasource.all_encoded_sources()
+        backend = InMemoryBackend()
+        missing = datasource.missing_batched(backend)
+        self.assertEqual(1, backend.calls())
+        self.assertEqual(datasource.encoded_source().hashed(), missing[-1])
+        for hashed in missing[:len(missing) // 2]:
+            backend.add(hashed)
+        still_missing = datasource.missing_batched(backend)
+        self.assertEqual(2, backend.calls())
+        self.assertEqual(missing[len(missing) // 2:], still_missing)
+        backend.add(datasource.encoded_source().hashed())
+        self.assertEqual([], datasource.missing_batched(backend))
+        self.assertEqual(len(missing), len(set(missing) & set(nodes)))
+
+
+if __name__ == '__main__':
+    unittest.main()
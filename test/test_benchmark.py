@@ -0,0 +1,55 @@
+import sqlite3
+import sys
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import SHAPES, synthetic_query, node_names, node_parents
+from benchmark.bench_encoder import STAGES, run_benchmarks, compare
+from benchmark.bench_scheduler import POLICIES, run_simulations
+from src.source import EncodedSource
+
+
+class Test(unittest.TestCase):
+
+    def test_node_parents(self):
+        self.assertEqual([[], [0], [1], [2]], node_parents("chain", 4))
+        self.assertEqual([[], [0], [0], [0]], node_parents("fan_out", 4))
+        self.assertEqual([[], [], [], [0, 1, 2]], node_parents("fan_in", 4))
+        self.assertEqual([[], [], [0, 1], [0, 1], [2, 3]], node_parents("diamond", 5, width=2))
+        self.assertEqual([[], [], [], [], [3], [4]], node_parents("lopsided", 6))
+        with self.assertRaises(ValueError):
+            node_parents("star", 4)
+
+    def test_cached_fraction(self):
+        self.assertEqual(0, sum(name.startswith("cached_") for name in node_names(10, 0.0)))
+        self.assertEqual(3, sum(name.startswith("cached_") for name in node_names(10, 0.3)))
+        self.assertEqual(10, sum(name.startswith("cached_") for name in node_names(10, 1.0)))
+
+    def test_shapes_encode_and_run(self):
+        for shape in SHAPES:
+            source_str = synthetic_query(shape, 7, body_size=2, cached_fraction=0.5)
+            encoded_source = EncodedSource.from_str(source_str, prefix="cached_")
+            self.assertEqual(8, len(encoded_source.hashed_sources()))
+            # the generated sql is plain enough to execute on an embedded database
+            self.assertTrue(sqlite3.connect(":memory:").execute(source_str).fetchall())
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(["diamond"], [6], [1], [0.5], repeat=1)
+        self.assertEqual(STAGES, [result["stage"] for result in results])
+        for result in results:
+            self.assertGreaterEqual(result["seconds"], 0)
+            self.assertGreaterEqual(result["peak_bytes"], 0)
+            self.assertGreaterEqual(result["retained_bytes"], 0)
+        slower = [dict(result, seconds=result["seconds"] * 10 + 1) for result in results]
+        self.assertEqual(len(results), len(compare(slower, results, tolerance=0.5)))
+        self.assertFalse(compare(results, results, tolerance=0.5))
+
+    def test_run_simulations(self):
+        results = run_simulations(["lopsided"], [6], [2], seconds=0.001)
+        self.assertEqual(POLICIES, [result["policy"] for result in results])
+        for result in results:
+            self.assertGreaterEqual(result["seconds"], result["critical_path_seconds"])
+
+
+if __name__ == '__main__':
+    unittest.main()
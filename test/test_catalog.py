@@ -0,0 +1,84 @@
+import sys
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.backend import SQLiteBackend
+from src.bq.catalog import SQLiteCatalog, CatalogEntry
+from src.bq.data_source import DataSource
+
+
+class Test(unittest.TestCase):
+
+    def test_entries(self):
+        catalog = SQLiteCatalog(":memory:")
+        catalog.record_builds([CatalogEntry("a", "cte", "SELECT 1", 100, 2, 1000, 1.5, 1.0, 1.0),
+                               CatalogEntry("b", None, "SELECT 2", 50, 1, 500, 0.5, 1.0, 1.0)])
+        catalog.touch(["a", "unknown"], now=5.0)
+        catalog.touch(["a"], now=6.0)
+        catalog.touch(["b"], hit=False, now=7.0)
+        entries = catalog.entries(["a", "b", "c"])
+        self.assertEqual({"a", "b"}, set(entries))
+        self.assertEqual(("cte", "SELECT 1", 100, 2), (entries["a"].alias(), entries["a"].source(),
+                                                        entries["a"].num_bytes(), entries["a"].num_rows()))
+        self.assertEqual({"a": 6.0, "b": 7.0}, catalog.last_used(["a", "b"]))
+        self.assertEqual({"a": 2, "b": 0}, catalog.hits(["a", "b"]))
+        totals = catalog.totals()
+        self.assertEqual(2, totals["tables"])
+        self.assertEqual(150, totals["num_bytes"])
+        self.assertEqual(2000, totals["bytes_saved"])
+        catalog.forget(["a"])
+        self.assertEqual(["b"], list(catalog.entries()))
+
+    def test_rebuild_resets_hits(self):
+        catalog = SQLiteCatalog(":memory:")
+        catalog.record_builds([CatalogEntry("a", None, "SELECT 1", 1, 1, 1, 1.0, 1.0, 1.0)])
+        catalog.touch(["a"])
+        catalog.record_builds([CatalogEntry("a", None, "SELECT 1", 2, 1, 1, 1.0, 2.0, 2.0)])
+        self.assertEqual(0, catalog.entries(["a"])["a"].hits())
+        self.assertEqual(2, catalog.entries(["a"])["a"].num_bytes())
+
+    def test_build_writes_catalog(self):
+        backend = SQLiteBackend()
+        catalog = SQLiteCatalog(":memory:")
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 6)), backend)
+        plan = datasource.plan()
+        datasource.build(catalog=catalog)
+        entries = catalog.entries(plan.hashes())
+        self.assertEqual(set(plan.hashes()), set(entries))
+        tables = backend.metadata(plan.hashes())
+        for node in plan:
+            entry = entries[node.hashed()]
+            self.assertEqual(node.alias(), entry.alias())
+            self.assertEqual(node.sql(), entry.source())
+            self.assertEqual(tables[node.hashed()].num_bytes(), entry.num_bytes())
+            self.assertEqual(tables[node.hashed()].num_rows(), entry.num_rows())
+            self.assertGreaterEqual(entry.build_seconds(), 0)
+            self.assertEqual(0, entry.hits())
+        # a second run is a single hit on the root, nothing below it is touched
+        datasource.build(catalog=catalog)
+        self.assertEqual({plan.root(): 1}, {hashed: hits for hashed, hits in catalog.hits(plan.hashes()).items()
+                                            if hits})
+
+    def test_failed_build_catalogs_what_completed(self):
+        backend = SQLiteBackend()
+        catalog = SQLiteCatalog(":memory:")
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 6)), backend)
+        plan = datasource.plan()
+        failing = plan.hashes()[0]
+
+        def build(hashed: str, sql: str) -> int:
+            if hashed == failing:
+                raise RuntimeError("failed on purpose")
+            return backend.materialize(hashed, sql)
+
+        with self.assertRaises(RuntimeError):
+            datasource.build(build_func=build, catalog=catalog)
+        built = backend.existing(plan.hashes())
+        self.assertTrue(built)
+        self.assertEqual(built, set(catalog.entries(plan.hashes())))
+
+
+if __name__ == '__main__':
+    unittest.main()
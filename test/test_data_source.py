@@ -1,15 +1,19 @@
 
+import gc
 import json
 import sys
 from typing import Union, Dict, List
 import unittest
 
+import sqlparse
+
 from resources.test_source_sql import complex_query, basic_str, basic_whitespace_str, cte_1, cte_2, join_clause, \
     date_dim_query, settings, planning_date_dim_table, planning_week_dim_table, weeks, date_dim_query_sub_cached
 
 sys.path.append("..")
-from src.source import EncodedSource, ParsedSource, Source, hash_reference
+from src.source import EncodedSource, EncodedNode, ParsedSource, Source, hash_reference
 from src.bq.data_source import DataSource
+from src.bq.plan import unique_nodes
 
 
 class Test(unittest.TestCase):
@@ -25,7 +29,7 @@ class Test(unittest.TestCase):
     def test_basicsource(self):
         datasource = DataSource(EncodedSource.from_str(date_dim_query))
         for hashed, source in datasource.all_encoded_sources().items():
-            print(f"hash:{hashed} source:{source.encoded_sources()}")
+            print(f"hash:{hashed} source:{source.sql()}")
 
     def test_cte_date_dim_encode(self):
         source_str = date_dim_query
@@ -44,6 +48,53 @@ class Test(unittest.TestCase):
         datasource = DataSource(encoded_source_root)
         self.assertIsNotNone(datasource)
 
+    def test_datasource_releases_token_trees(self):
+        def live_statements() -> int:
+            gc.collect()
+            return sum(isinstance(obj, sqlparse.sql.Statement) for obj in gc.get_objects())
+
+        baseline = live_statements()
+        encoded_source_root = EncodedSource.from_str(complex_query)
+        self.assertGreater(live_statements(), baseline)
+        datasource = DataSource(encoded_source_root)
+        root_hash = encoded_source_root.hashed_sources()[-1]
+        del encoded_source_root
+        self.assertEqual(baseline, live_statements())
+        self.assertIsInstance(datasource.encoded_source(), EncodedNode)
+        self.assertEqual(root_hash, datasource.encoded_source().hashed())
+        run_order = []
+        datasource.apply_dependency_first(lambda hashed, sql: run_order.append(hashed))
+        self.assertEqual(root_hash, run_order[-1])
+
+    def test_missing_dependency_first(self):
+        datasource = DataSource(EncodedSource.from_str(date_dim_query))
+        root_hash = datasource.encoded_source().hashed()
+        checked = []
+
+        def all_cached(hashed: str) -> bool:
+            checked.append(hashed)
+            return True
+        self.assertEqual([], datasource.missing_dependency_first(all_cached))
+        self.assertEqual([root_hash], checked)
+
+        checked.clear()
+        def nothing_cached(hashed: str) -> bool:
+            checked.append(hashed)
+            return False
+        missing = datasource.missing_dependency_first(nothing_cached)
+        reachable = unique_nodes(datasource.encoded_source(), datasource.all_encoded_sources())
+        self.assertEqual([node.hashed() for node in reachable], missing)
+        self.assertEqual(len(missing), len(checked))
+        self.assertEqual(root_hash, missing[-1])
+
+        # only the root is missing: its direct dependencies are checked, nothing below them
+        checked.clear()
+        def root_missing(hashed: str) -> bool:
+            checked.append(hashed)
+            return hashed != root_hash
+        self.assertEqual([root_hash], datasource.missing_dependency_first(root_missing))
+        self.assertEqual({root_hash} | set(datasource.encoded_source().dependency_hashes()), set(checked))
+
     def test_apply_dependency_first(self):
         source_str = cte_1
         encoded_source_root = EncodedSource.from_str(source_str)
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+from typing import List
+import unittest
+
+from resources.test_source_sql import basic_str, date_dim_query_sub_cached, complex_query
+
+sys.path.append("..")
+from src.source import EncodedSource
+from src.encode_cache import EncodeCache
+from src.bq.data_source import DataSource
+
+
+def run_order(encoded_source: EncodedSource) -> List[str]:
+    order = []
+    DataSource(encoded_source).apply_dependency_first(lambda hashed, source: order.append(hashed))
+    return order
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._directory.name, "encode_cache.db")
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def test_miss_then_hit(self):
+        cache = EncodeCache(self._path)
+        self.assertIsNone(cache.get(basic_str))
+        encoded = cache.from_str(basic_str)
+        cached = cache.get(basic_str)
+        self.assertIsNotNone(cached)
+        self.assertIsNone(cached.decomposed_source())
+        self.assertEqual(encoded.hashed_sources(), cached.hashed_sources())
+        self.assertEqual(encoded.encoded_sources(), cached.encoded_sources())
+        cache.close()
+
+    def test_prefix_in_key(self):
+        cache = EncodeCache(self._path)
+        cache.from_str(date_dim_query_sub_cached, prefix="cached_")
+        self.assertIsNone(cache.get(date_dim_query_sub_cached))
+        self.assertIsNotNone(cache.get(date_dim_query_sub_cached, prefix="cached_"))
+        cache.close()
+
+    def test_persists_dag(self):
+        for source_str, prefix in [(date_dim_query_sub_cached, "cached_"), (complex_query, "")]:
+            encoded = EncodedSource.from_str(source_str, prefix=prefix)
+            cache = EncodeCache(self._path)
+            cache.put(source_str, encoded, prefix=prefix)
+            cache.close()
+            cached = EncodeCache(self._path).get(source_str, prefix=prefix)
+            self.assertEqual(list(encoded.all_encoded_sources_by_name().keys()),
+                             list(cached.all_encoded_sources_by_name().keys()))
+            self.assertEqual([node.alias() for node in encoded.all_encoded_sources_by_name().values()],
+                             [node.alias() for node in cached.all_encoded_sources_by_name().values()])
+            self.assertEqual(run_order(encoded), run_order(cached))
+
+
+if __name__ == '__main__':
+    unittest.main()
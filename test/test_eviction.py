@@ -0,0 +1,58 @@
+import sys
+import time
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend, SQLiteBackend
+from src.bq.data_source import DataSource
+from src.bq.catalog import SQLiteCatalog, CatalogEntry
+from src.bq.eviction import evict
+
+
+class Test(unittest.TestCase):
+
+    def test_ttl(self):
+        backend = InMemoryBackend()
+        backend.materialize("short", "SELECT 1", ttl=0.01)
+        backend.materialize("forever", "SELECT 1")
+        self.assertIsNotNone(backend.metadata(["short"])["short"].expires())
+        time.sleep(0.02)
+        self.assertEqual({"forever"}, backend.existing(["short", "forever"]))
+
+        backend = SQLiteBackend()
+        backend.materialize("short", "SELECT 1", ttl=0.01)
+        backend.materialize("forever", "SELECT 1")
+        self.assertIsNone(backend.metadata(["forever"])["forever"].expires())
+        time.sleep(0.02)
+        self.assertEqual(["forever"], list(backend.metadata()))
+
+    def test_evict_least_recently_used(self):
+        backend = InMemoryBackend()
+        for hashed in ["a", "b", "c", "d"]:
+            backend.add(hashed, num_bytes=10)
+        backend.add("_catalog", num_bytes=1000)
+        catalog = SQLiteCatalog(":memory:")
+        catalog.record_builds(CatalogEntry(hashed, None, "SELECT 1", 10, 1, 0, 0.0, 0.0, 0.0) for hashed in ["a", "b"])
+        catalog.touch(["a"], now=time.time() + 10)
+        catalog.touch(["b"], now=time.time() + 20)
+        # c and d were never used, so they go first; the budget only needs two of the four gone
+        self.assertEqual(["c", "d"], sorted(evict(backend, catalog, budget_bytes=25)))
+        self.assertEqual({"a", "b"}, backend.existing(["a", "b", "c", "d"]))
+        self.assertEqual([], evict(backend, catalog, budget_bytes=25))
+        self.assertEqual(["a"], evict(backend, catalog, budget_bytes=10))
+        self.assertEqual({}, catalog.entries(["a"]))
+        self.assertEqual([], evict(backend, catalog, budget_bytes=0, protect=["b"]))
+        # the catalog table itself is never a candidate
+        self.assertEqual({"_catalog"}, backend.existing(["_catalog"]))
+
+    def test_build_with_ttl(self):
+        backend = SQLiteBackend()
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 3)), backend)
+        datasource.build(ttl=3600)
+        self.assertTrue(all(table.expires() for table in backend.metadata().values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.data_source import DataSource
+from src.bq.executor import DependencyExecutor
+from src.bq.plan import unique_nodes
+
+
+class Test(unittest.TestCase):
+
+    def test_unique_nodes(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 9)))
+        nodes = unique_nodes(datasource.encoded_source(), datasource.all_encoded_sources())
+        hashes = [node.hashed() for node in nodes]
+        self.assertEqual(len(set(hashes)), len(hashes))
+        self.assertEqual(datasource.encoded_source().hashed(), hashes[-1])
+        for position, node in enumerate(nodes):
+            for dependency_hash in node.dependency_hashes():
+                self.assertLess(hashes.index(dependency_hash), position)
+
+    def test_dependencies_complete_first(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 12)))
+        nodes = datasource.all_encoded_sources()
+        completed = set()
+        lock = threading.Lock()
+
+        def apply(hashed: str, sql: str):
+            with lock:
+                for dependency_hash in nodes[hashed].dependency_hashes():
+                    self.assertIn(dependency_hash, completed)
+            time.sleep(0.01)
+            with lock:
+                self.assertNotIn(hashed, completed)
+                completed.add(hashed)
+            return sql
+
+        results = datasource.apply_concurrently(apply, max_in_flight=4)
+        self.assertEqual(set(nodes), completed)
+        self.assertEqual(datasource.encoded_source().sql(), results[datasource.encoded_source().hashed()])
+
+    def test_max_in_flight(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 12)))
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def apply(hashed: str, sql: str):
+            with lock:
+                running.append(hashed)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(hashed)
+
+        datasource.apply_concurrently(apply, max_in_flight=3)
+        self.assertEqual(3, max(peak))
+        with self.assertRaises(ValueError):
+            DependencyExecutor(0)
+
+    def test_wall_time_follows_critical_path(self):
+        # 12 independent leaves under one root: two rounds of leaves then the root, instead of 13 in a row
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 12)))
+        tic = time.perf_counter()
+        datasource.apply_concurrently(lambda hashed, sql: time.sleep(0.05), max_in_flight=12)
+        toc = time.perf_counter()
+        self.assertLess(toc - tic, 0.05 * 6)
+
+    def test_only_missing(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 5)))
+        nodes = datasource.all_encoded_sources()
+        missing = [hashed for hashed, node in nodes.items() if node.alias() in ["node_3", "node_4"]]
+        results = datasource.apply_concurrently(lambda hashed, sql: nodes[hashed].alias(), only=missing)
+        self.assertEqual({"node_3", "node_4"}, set(results.values()))
+
+    def test_failure_stops_dependents(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 5)))
+        nodes = datasource.all_encoded_sources()
+        applied = []
+
+        def apply(hashed: str, sql: str):
+            if nodes[hashed].alias() == "node_2":
+                raise RuntimeError("build failed")
+            applied.append(nodes[hashed].alias())
+
+        with self.assertRaises(RuntimeError):
+            datasource.apply_concurrently(apply, max_in_flight=2)
+        self.assertEqual(["node_0", "node_1"], applied)
+
+
+if __name__ == '__main__':
+    unittest.main()
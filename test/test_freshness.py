@@ -0,0 +1,108 @@
+import sys
+import unittest
+
+sys.path.append("..")
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend, SQLiteBackend
+from src.bq.data_source import DataSource
+from src.freshness import physical_tables, versioned_nodes
+
+BRANCHES_SQL = """WITH cached_sales AS (SELECT day, amount FROM main.events WHERE amount > 0),
+cached_one AS (SELECT 1 AS one),
+cached_total AS (SELECT SUM(amount) AS amount FROM cached_sales),
+cached_ones AS (SELECT one FROM cached_one)
+SELECT * FROM cached_total CROSS JOIN cached_ones"""
+
+
+def events_backend() -> SQLiteBackend:
+    backend = SQLiteBackend()
+    backend.connection().execute("CREATE TABLE events (day TEXT, amount INTEGER)")
+    backend.connection().execute("INSERT INTO events VALUES ('2024-01-01', 3)")
+    backend.connection().commit()
+    return backend
+
+
+def hashes_by_alias(datasource: DataSource):
+    return {node.alias(): node.hashed() for node in datasource.plan()}
+
+
+class Test(unittest.TestCase):
+
+    def test_physical_tables(self):
+        self.assertEqual(set(), physical_tables("SELECT EXTRACT(YEAR FROM dt) AS y FROM weeks JOIN days USING (d)"))
+        self.assertEqual({"project.dataset.a", "dataset.b", "my-project.dataset.c"}, physical_tables(
+            "WITH x AS (SELECT * FROM `project.dataset.a`) "
+            "SELECT * FROM x JOIN dataset.b USING (id) LEFT JOIN my-project.dataset.c ON TRUE"))
+        self.assertEqual(set(), physical_tables(
+            "SELECT * FROM `12f3762ff73a254c0f9eff70b303ef07c140d345` CROSS JOIN UNNEST(arr) "
+            "CROSS JOIN ml.predict(x)"))
+        self.assertEqual({"ds.a", "ds.b", "ds.c"}, physical_tables(
+            "SELECT * FROM ds.a x, ds.b AS y, (SELECT * FROM t) z, ds.c WHERE x.id IN (1, 2)"))
+        self.assertEqual({"p.ds.a", "p.ds.b", "my-project-123.ds.c"}, physical_tables(
+            "SELECT * FROM `p`.`ds`.`a` JOIN p.`ds`.b ON TRUE, my-project-123.ds.c"))
+        self.assertEqual({"ds.events"}, physical_tables(
+            "SELECT EXTRACT(YEAR FROM q1.dt), (SELECT MAX(day) FROM ds.events) FROM q1, q2 GROUP BY 1, 2"))
+        with open("../resources/complex.sql") as sql_file:
+            self.assertIn("stone-outpost-636.tier1_merch.event", physical_tables(sql_file.read()))
+
+    def test_only_downstream_rekeyed(self):
+        source = EncodedSource.from_str(BRANCHES_SQL, prefix="cached_")
+        backend = InMemoryBackend()
+        backend.set_table_version("main.events", "1")
+        before = hashes_by_alias(DataSource(source, backend, versioned=True))
+        plain = hashes_by_alias(DataSource(source))
+        self.assertEqual(1, backend.calls())
+        # what reads no base table, directly or not, keeps the hash of its sql
+        self.assertEqual(plain["cached_one"], before["cached_one"])
+        self.assertEqual(plain["cached_ones"], before["cached_ones"])
+        self.assertNotEqual(plain["cached_sales"], before["cached_sales"])
+        self.assertEqual(before, hashes_by_alias(DataSource(source, backend, versioned=True)))
+
+        backend.set_table_version("main.events", "2")
+        after = hashes_by_alias(DataSource(source, backend, versioned=True))
+        self.assertEqual({"cached_sales", "cached_total", None},
+                         {alias for alias in after if after[alias] != before[alias]})
+
+    def test_references_follow_new_hashes(self):
+        source = EncodedSource.from_str(BRANCHES_SQL, prefix="cached_")
+        nodes = source.all_encoded_nodes()
+        rekeyed = versioned_nodes(source.node(), nodes, lambda tables: {table: "v" for table in tables})
+        new_hashes = {node.hashed() for node in rekeyed.values()}
+        for old_hash, node in rekeyed.items():
+            self.assertEqual(len(nodes[old_hash].dependency_hashes()), len(node.dependency_hashes()))
+            for dependency_hash in node.dependency_hashes():
+                self.assertIn(dependency_hash, new_hashes)
+                self.assertIn(f"`{dependency_hash}`", node.sql())
+            for changed in set(nodes) - new_hashes:
+                self.assertNotIn(changed, node.sql())
+
+    def test_stable(self):
+        source = EncodedSource.from_str(BRANCHES_SQL, prefix="cached_")
+        backend = InMemoryBackend()
+        backend.set_table_version("main.events", "1")
+        versioned = hashes_by_alias(DataSource(source, backend, versioned=True, stable=["cached_sales"]))
+        self.assertEqual(hashes_by_alias(DataSource(source)), versioned)
+
+    def test_changed_base_table_misses_downstream(self):
+        backend = events_backend()
+        datasource = DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"), backend, versioned=True)
+        self.assertEqual(len(datasource.plan()), len(datasource.build()))
+        datasource = DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"), backend, versioned=True)
+        self.assertEqual({}, datasource.build())
+
+        backend.connection().execute("INSERT INTO events VALUES ('2024-01-02', 4)")
+        backend.connection().commit()
+        datasource = DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"), backend, versioned=True)
+        built = datasource.build()
+        aliases = {hashed: alias for alias, hashed in hashes_by_alias(datasource).items()}
+        self.assertEqual({"cached_sales", "cached_total", None}, {aliases[hashed] for hashed in built})
+        root = datasource.plan().root()
+        self.assertEqual([(7, 1)], backend.connection().execute(f'SELECT * FROM "{root}"').fetchall())
+
+    def test_versioned_needs_backend(self):
+        with self.assertRaises(ValueError):
+            DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"), versioned=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import sys
+import unittest
+from datetime import date
+
+sys.path.append("..")
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend, SQLiteBackend
+from src.bq.catalog import SQLiteCatalog
+from src.bq.data_source import DataSource
+from src.bq.incremental import IncrementalSpec, incremental_hashes, refresh_since
+from src.bq.lineage import SQLiteLineage
+
+DAILY_SQL = """WITH cached_daily AS (SELECT day, SUM(amount) AS amount FROM events GROUP BY day),
+cached_total AS (SELECT SUM(amount) AS amount FROM cached_daily)
+SELECT * FROM cached_total"""
+
+
+PEAK_SQL = """WITH cached_daily AS (SELECT day, SUM(amount) AS amount FROM events GROUP BY day),
+cached_peak AS (SELECT MAX(amount) AS amount FROM cached_daily)
+SELECT * FROM cached_peak"""
+
+
+def events_backend(days) -> SQLiteBackend:
+    backend = SQLiteBackend()
+    backend.connection().execute("CREATE TABLE events (day TEXT, amount INTEGER)")
+    add_events(backend, {day: day for day in days})
+    return backend
+
+
+def add_events(backend: SQLiteBackend, amounts):
+    backend.connection().executemany("INSERT INTO events VALUES (?, ?)",
+                                     [(date(2024, 1, day).isoformat(), amount) for day, amount in amounts.items()])
+    backend.connection().commit()
+
+
+class Test(unittest.TestCase):
+
+    def test_refresh_since(self):
+        spec = IncrementalSpec("day", lookback_days=2)
+        today = date(2024, 1, 10)
+        self.assertIsNone(refresh_since(spec, set(), today))
+        # caught up: only the lookback window
+        self.assertEqual(date(2024, 1, 8), refresh_since(spec, {date(2024, 1, 1), date(2024, 1, 9)}, today))
+        # behind: from the first missing day on
+        self.assertEqual(date(2024, 1, 4), refresh_since(spec, {date(2024, 1, 1), date(2024, 1, 3)}, today))
+        # future partitions, like a date dimension's
+        self.assertEqual(date(2024, 1, 8), refresh_since(spec, {date(2999, 12, 31)}, today))
+        with self.assertRaises(ValueError):
+            IncrementalSpec("day", lookback_days=-1)
+
+    def test_incremental_hashes(self):
+        datasource = DataSource(EncodedSource.from_str(DAILY_SQL, prefix="cached_"))
+        specs = incremental_hashes(datasource.plan(), {"cached_daily": IncrementalSpec("day"), "absent": None})
+        self.assertEqual(["cached_daily"], [datasource.plan().node(hashed).alias() for hashed in specs])
+
+    def test_appends_recent_partitions(self):
+        backend = events_backend(range(1, 6))
+        datasource = DataSource(EncodedSource.from_str(DAILY_SQL, prefix="cached_"), backend)
+        incremental = {"cached_daily": IncrementalSpec("day", lookback_days=1)}
+        daily, total, root = datasource.plan().hashes()
+        self.assertEqual({daily, total, root}, set(datasource.build(incremental=incremental, today=date(2024, 1, 6))))
+        self.assertEqual({daily: {date(2024, 1, day) for day in range(1, 6)}},
+                         backend.partitions({daily: "day"}))
+
+        # a late event for the 5th, a new day, and a change to the 1st that is too old to be looked at again
+        add_events(backend, {5: 10, 6: 6, 1: 100})
+        built = datasource.build(incremental=incremental, today=date(2024, 1, 6))
+        self.assertEqual({daily, total, root}, set(built))
+        amounts = dict(backend.connection().execute(f'SELECT day, amount FROM "{daily}"').fetchall())
+        self.assertEqual({"2024-01-01": 1, "2024-01-02": 2, "2024-01-03": 3, "2024-01-04": 4,
+                          "2024-01-05": 15, "2024-01-06": 6}, amounts)
+        # the node kept its table, and what reads it was rebuilt from the new partitions
+        self.assertEqual(sum(amounts.values()),
+                         backend.connection().execute(f'SELECT amount FROM "{root}"').fetchone()[0])
+        self.assertEqual(6, backend.metadata([daily])[daily].num_rows())
+
+        # nothing new landed: the recent partitions are recomputed, and what reads them is kept as it is
+        created = {hashed: table.created() for hashed, table in backend.metadata([total, root]).items()}
+        built = datasource.build(incremental=incremental, today=date(2024, 1, 6))
+        self.assertEqual({total: None, root: None}, {hashed: built[hashed] for hashed in (total, root)})
+        self.assertEqual(created,
+                         {hashed: table.created() for hashed, table in backend.metadata([total, root]).items()})
+
+    def test_refresh_drops_other_reports(self):
+        backend = events_backend(range(1, 6))
+        lineage = SQLiteLineage(":memory:")
+        catalog = SQLiteCatalog(":memory:")
+        incremental = {"cached_daily": IncrementalSpec("day", lookback_days=1)}
+        daily_report = DataSource(EncodedSource.from_str(DAILY_SQL, prefix="cached_"), backend)
+        peak_report = DataSource(EncodedSource.from_str(PEAK_SQL, prefix="cached_"), backend)
+        for report in (daily_report, peak_report):
+            report.build(incremental=incremental, today=date(2024, 1, 6), catalog=catalog, lineage=lineage)
+        daily = daily_report.plan().hashes()[0]
+        self.assertEqual(daily, peak_report.plan().hashes()[0])
+        peak_tables = set(peak_report.plan().hashes()) - {daily}
+
+        # the daily report refreshes the shared table, which drops what the peak report built from it
+        add_events(backend, {5: 10})
+        daily_report.build(incremental=incremental, today=date(2024, 1, 6), catalog=catalog, lineage=lineage)
+        self.assertEqual(set(), backend.existing(peak_tables))
+        self.assertEqual(set(), set(catalog.entries(peak_tables)))
+        built = peak_report.build(incremental=incremental, today=date(2024, 1, 6), lineage=lineage)
+        self.assertEqual(peak_tables | {daily}, set(built))
+        self.assertEqual(15, backend.connection().execute(
+            f'SELECT amount FROM "{peak_report.plan().root()}"').fetchone()[0])
+
+    def test_refresh_reports_changes(self):
+        backend = events_backend(range(1, 4))
+        sql = "SELECT day, amount FROM events"
+        self.assertTrue(backend.materialize_partitioned("daily", sql, "day")[1])
+        self.assertFalse(backend.materialize_partitioned("daily", sql, "day", since=date(2024, 1, 2))[1])
+        self.assertEqual(3, backend.metadata(["daily"])["daily"].num_rows())
+        add_events(backend, {3: 3})
+        self.assertTrue(backend.materialize_partitioned("daily", sql, "day", since=date(2024, 1, 2))[1])
+        self.assertEqual(4, backend.metadata(["daily"])["daily"].num_rows())
+
+    def test_without_incremental_nothing_rebuilt(self):
+        backend = events_backend(range(1, 3))
+        datasource = DataSource(EncodedSource.from_str(DAILY_SQL, prefix="cached_"), backend)
+        datasource.build()
+        self.assertEqual({}, datasource.build())
+
+    def test_in_memory_partitions(self):
+        backend = InMemoryBackend()
+        backend.materialize_partitioned("a", "SELECT 1", "day")
+        self.assertEqual({"a": set()}, backend.partitions({"a": "day", "b": "day"}))
+        backend.add("b", partitions=[date(2024, 1, 1)])
+        self.assertEqual({date(2024, 1, 1)}, backend.partitions({"b": "day"})["b"])
+        since = date.today()
+        backend.materialize_partitioned("b", "SELECT 1", "day", since=since)
+        self.assertEqual({date(2024, 1, 1), since}, backend.partitions({"b": "day"})["b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
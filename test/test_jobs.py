@@ -0,0 +1,206 @@
+import sys
+import threading
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend
+from src.bq.catalog import SQLiteCatalog
+from src.bq.data_source import DataSource
+from src.bq.jobs import AsyncDependencyExecutor, FakeJobBackend, JobError, JobState
+from src.bq.plan import ExecutionPlan
+
+
+class RecordingJobBackend(FakeJobBackend):
+    # remembers the order of submissions and the jobs each poll asked about
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = []
+        self.polled = []
+
+    def submit(self, hashed: str, sql: str, ttl: float = None) -> str:
+        self.submitted.append(hashed)
+        return super().submit(hashed, sql, ttl)
+
+    def poll(self, job_ids):
+        job_ids = list(job_ids)
+        self.polled.append(job_ids)
+        return super().poll(job_ids)
+
+
+def executor(jobs, **kwargs) -> AsyncDependencyExecutor:
+    kwargs.setdefault("poll_interval", 0.001)
+    kwargs.setdefault("max_poll_interval", 0.01)
+    return AsyncDependencyExecutor(jobs, **kwargs)
+
+
+class Test(unittest.TestCase):
+
+    def test_dependencies_submitted_after_completion(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 12)))
+        plan = datasource.plan()
+        backend = InMemoryBackend()
+        jobs = RecordingJobBackend(backend)
+        states = executor(jobs, max_in_flight=4).run(plan)
+        self.assertEqual(set(plan.hashes()), set(states))
+        self.assertEqual(set(plan.hashes()), backend.existing(plan.hashes()))
+        for position, hashed in enumerate(jobs.submitted):
+            for dependency_hash in plan.dependencies(hashed):
+                self.assertLess(jobs.submitted.index(dependency_hash), position)
+        self.assertTrue(all(state.done() and state.error() is None for state in states.values()))
+
+    def test_in_flight_polled_together(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 30)))
+        plan = datasource.plan()
+        jobs = RecordingJobBackend(duration=lambda hashed: 0.02)
+        executor(jobs, max_in_flight=100).run(plan)
+        leaves = [hashed for hashed in plan.hashes() if not plan.dependencies(hashed)]
+        self.assertEqual(len(leaves), len(jobs.polled[0]))
+        self.assertLess(jobs.polls(), len(plan))
+
+    def test_max_in_flight(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 30)))
+        jobs = RecordingJobBackend(duration=lambda hashed: 0.005)
+        executor(jobs, max_in_flight=3).run(datasource.plan())
+        self.assertEqual(3, max(len(polled) for polled in jobs.polled))
+
+    def test_few_threads(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 100)))
+        peak = []
+
+        class CountingJobBackend(FakeJobBackend):
+            def poll(self, job_ids):
+                peak.append(threading.active_count())
+                return super().poll(job_ids)
+
+        before = threading.active_count()
+        executor(CountingJobBackend(duration=lambda hashed: 0.02), max_in_flight=100, threads=2).run(datasource.plan())
+        self.assertLessEqual(max(peak), before + 2)
+
+    def test_empty_plan(self):
+        plan = DataSource(EncodedSource.from_str(synthetic_query("chain", 1))).plan().subset([])
+        jobs = RecordingJobBackend()
+        self.assertEqual({}, executor(jobs).run(plan))
+        self.assertEqual(0, jobs.polls())
+
+    def test_backoff(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 1)))
+        root = datasource.encoded_source().hashed()
+        jobs = RecordingJobBackend(duration=lambda hashed: 0.05)
+        states = executor(jobs, poll_interval=0.001, max_poll_interval=1.0, backoff=2.0).run(
+            ExecutionPlan([datasource.encoded_source()]))
+        # 1 + 2 + 4 + ... ms reaches 50 ms in about six polls, not fifty
+        self.assertLess(jobs.polls(), 10)
+        self.assertGreaterEqual(states[root].seconds(), 0.05)
+
+    def test_priorities(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 6)))
+        plan = datasource.plan()
+        leaves = [hashed for hashed in plan.hashes() if not plan.dependencies(hashed)]
+        jobs = RecordingJobBackend()
+        executor(jobs, max_in_flight=1).run(plan, priorities={leaves[-1]: 10.0})
+        self.assertEqual(leaves[-1], jobs.submitted[0])
+
+    def test_failure_stops_submitting(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 5)))
+        plan = datasource.plan()
+        first = plan.hashes()[0]
+        jobs = RecordingJobBackend(fail=[first])
+        with self.assertRaises(JobError) as raised:
+            executor(jobs).run(plan)
+        self.assertEqual(first, raised.exception.hashed)
+        self.assertEqual([first], jobs.submitted)
+
+    def test_failed_submission_drains_in_flight(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 6)))
+        plan = datasource.plan()
+        leaves = [hashed for hashed in plan.hashes() if not plan.dependencies(hashed)]
+        failing = leaves[0]
+
+        class UnreachableJobBackend(RecordingJobBackend):
+            def submit(self, hashed, sql, ttl=None):
+                if hashed == failing:
+                    raise ConnectionError("unreachable")
+                return super().submit(hashed, sql, ttl)
+
+        jobs = UnreachableJobBackend(duration=lambda hashed: 0.02)
+        with self.assertRaises(JobError) as raised:
+            executor(jobs).run(plan)
+        self.assertEqual(failing, raised.exception.hashed)
+        self.assertIsInstance(raised.exception.__cause__, ConnectionError)
+        # the other leaves were in flight already and were seen through, their dependents never submitted
+        self.assertEqual(set(leaves), set(raised.exception.states))
+        self.assertIn("unreachable", raised.exception.states[failing].error())
+        self.assertTrue(all(raised.exception.states[hashed].done() and not raised.exception.states[hashed].error()
+                            for hashed in leaves[1:]))
+        self.assertEqual(set(leaves[1:]), set(jobs.submitted))
+
+    def test_failed_build_async_catalogs_what_completed(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 6)), InMemoryBackend())
+        plan = datasource.plan()
+        failing = plan.hashes()[0]
+        catalog = SQLiteCatalog(":memory:")
+        with self.assertRaises(JobError) as raised:
+            datasource.build_async(executor(FakeJobBackend(datasource.backend(), fail=[failing])), catalog=catalog)
+        self.assertIn(failing, raised.exception.states)
+        built = datasource.backend().existing(plan.hashes())
+        self.assertTrue(built)
+        self.assertEqual(built, set(catalog.entries(plan.hashes())))
+
+    def test_concurrent_runs_share_jobs(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 12)))
+        plan = datasource.plan()
+        jobs = FakeJobBackend(duration=lambda hashed: 0.01)
+        runs = [threading.Thread(target=executor(jobs).run, args=(plan,)) for _ in range(3)]
+        for run in runs:
+            run.start()
+        for run in runs:
+            run.join()
+        self.assertEqual(len(plan), jobs.submits())
+        self.assertEqual(2 * len(plan), jobs.attaches())
+
+    def test_resubmit_after_failure_or_eviction(self):
+        backend = InMemoryBackend()
+        jobs = FakeJobBackend(backend, fail=["a"])
+        failed = jobs.submit("a", "SELECT 1")
+        self.assertIsNotNone(jobs.poll([failed])[failed].error())
+        self.assertNotEqual(failed, jobs.submit("a", "SELECT 1"))
+        built = jobs.submit("b", "SELECT 1")
+        self.assertTrue(jobs.poll([built])[built].done())
+        self.assertEqual(built, jobs.submit("b", "SELECT 1"))
+        backend.delete(["b"])
+        self.assertNotEqual(built, jobs.submit("b", "SELECT 1"))
+        self.assertEqual((4, 1), (jobs.submits(), jobs.attaches()))
+
+    def test_max_in_flight_positive(self):
+        with self.assertRaises(ValueError):
+            AsyncDependencyExecutor(FakeJobBackend(), max_in_flight=0)
+
+    def test_build_async(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 9)))
+        plan = datasource.plan()
+        cached = plan.hashes()[0]
+        backend = InMemoryBackend(tables=[cached])
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 9)), backend)
+        jobs = RecordingJobBackend(backend)
+        catalog = SQLiteCatalog(":memory:")
+        states = datasource.build_async(executor(jobs), catalog=catalog)
+        self.assertEqual(set(plan.hashes()) - {cached}, set(states))
+        self.assertNotIn(cached, jobs.submitted)
+        self.assertEqual(set(plan.hashes()), backend.existing(plan.hashes()))
+        entries = catalog.entries(states)
+        self.assertEqual(set(states), set(entries))
+        for hashed, state in states.items():
+            self.assertEqual(state.bytes_processed(), entries[hashed].bytes_processed())
+        self.assertEqual({}, datasource.build_async(executor(jobs)))
+
+    def test_job_state(self):
+        state = JobState("job", True, bytes_processed=3).timed(1.5)
+        self.assertEqual(("job", True, None, 3, 1.5),
+                         (state.job_id(), state.done(), state.error(), state.bytes_processed(), state.seconds()))
+
+
+if __name__ == '__main__':
+    unittest.main()
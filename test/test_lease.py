@@ -0,0 +1,169 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+sys.path.append("..")
+import google.api_core.exceptions
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend
+from src.bq.catalog import SQLiteCatalog
+from src.bq.data_source import DataSource
+from src.bq.lease import BigQueryLeaseStore, SQLiteLeaseStore, LeasedBuilder
+
+
+class LeaseTablesClient:
+    # just enough of bigquery.Client for lease tables: tables read by get_table carry an etag, and updating one
+    # fails once the etag changed, like the If-Match bigquery sends. before_update runs once, ahead of an update
+    project = "project"
+
+    def __init__(self):
+        self.tables = {}
+        self.versions = 0
+        self.before_update = None
+
+    def _stored(self, table_id, description, expires):
+        self.versions += 1
+        self.tables[table_id] = SimpleNamespace(table_id=table_id, description=description, expires=expires,
+                                                etag=str(self.versions))
+
+    def create_table(self, table):
+        table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        if table_id in self.tables:
+            raise google.api_core.exceptions.Conflict(table_id)
+        self._stored(table_id, table.description, table.expires)
+
+    def get_table(self, table_id):
+        if table_id not in self.tables:
+            raise google.api_core.exceptions.NotFound(table_id)
+        return SimpleNamespace(**vars(self.tables[table_id]))
+
+    def update_table(self, table, fields):
+        before_update, self.before_update = self.before_update, None
+        if before_update:
+            before_update()
+        stored = self.tables.get(table.table_id)
+        if stored is None:
+            raise google.api_core.exceptions.NotFound(table.table_id)
+        if table.etag != stored.etag:
+            raise google.api_core.exceptions.PreconditionFailed(table.table_id)
+        self._stored(table.table_id, *[getattr(table if field in fields else stored, field)
+                                       for field in ["description", "expires"]])
+
+    def delete_table(self, table_id, not_found_ok=False):
+        self.tables.pop(table_id, None)
+
+
+class Test(unittest.TestCase):
+
+    def test_lease_store(self):
+        leases = SQLiteLeaseStore(":memory:")
+        self.assertTrue(leases.acquire("a", "first", ttl=60))
+        self.assertFalse(leases.acquire("a", "second", ttl=60))
+        self.assertTrue(leases.acquire("a", "first", ttl=60))
+        self.assertEqual("first", leases.holder("a"))
+        self.assertFalse(leases.renew("a", "second", ttl=60))
+        self.assertTrue(leases.renew("a", "first", ttl=60))
+        leases.release("a", "second")
+        self.assertEqual("first", leases.holder("a"))
+        leases.release("a", "first")
+        self.assertIsNone(leases.holder("a"))
+        self.assertTrue(leases.acquire("a", "second", ttl=60))
+
+    def test_stale_lease(self):
+        leases = SQLiteLeaseStore(":memory:")
+        self.assertTrue(leases.acquire("a", "dead", ttl=0.01))
+        time.sleep(0.02)
+        self.assertIsNone(leases.holder("a"))
+        self.assertFalse(leases.renew("a", "dead", ttl=60))
+        self.assertTrue(leases.acquire("a", "alive", ttl=60))
+
+    def test_bigquery_stale_lease_taken_over_once(self):
+        client = LeaseTablesClient()
+        leases = BigQueryLeaseStore(client, "dataset")
+        self.assertTrue(leases.acquire("a", "dead", ttl=60))
+        self.assertFalse(leases.acquire("a", "first", ttl=60))
+        stale = client.tables[leases._table_id("a")]
+        stale.expires = datetime.fromtimestamp(time.time() - 1, tz=timezone.utc)
+        # second takes the stale lease over between first reading it and updating it
+        client.before_update = lambda: self.assertTrue(leases.acquire("a", "second", ttl=60))
+        self.assertFalse(leases.acquire("a", "first", ttl=60))
+        self.assertEqual("second", leases.holder("a"))
+        self.assertFalse(leases.renew("a", "dead", ttl=60))
+        # a renewal racing a takeover loses too
+        client.before_update = lambda: client._stored(leases._table_id("a"), "third", stale.expires)
+        self.assertFalse(leases.renew("a", "second", ttl=60))
+        # dropped by bigquery while being taken over, it is created anew
+        client.tables[leases._table_id("a")].expires = stale.expires
+        client.before_update = lambda: client.delete_table(leases._table_id("a"))
+        self.assertTrue(leases.acquire("a", "fourth", ttl=60))
+        self.assertEqual("fourth", leases.holder("a"))
+
+    def test_concurrent_runs_build_once(self):
+        # two users running the same report at once, sharing the lease file and the cache
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "leases.db")
+            backend = InMemoryBackend(latency=0.01)
+            source_str = synthetic_query("diamond", 9)
+            builds = []
+            lock = threading.Lock()
+
+            def materialize(hashed: str, sql: str) -> int:
+                with lock:
+                    builds.append(hashed)
+                time.sleep(0.03)
+                return backend.materialize(hashed, sql)
+
+            results = {}
+
+            def run(owner: str):
+                datasource = DataSource(EncodedSource.from_str(source_str), backend)
+                leases = LeasedBuilder(SQLiteLeaseStore(path), backend, owner=owner, poll_interval=0.01)
+                results[owner] = datasource.build(build_func=materialize, leases=leases)
+
+            runs = [threading.Thread(target=run, args=(owner,)) for owner in ["alice", "bob"]]
+            for thread in runs:
+                thread.start()
+            for thread in runs:
+                thread.join()
+            self.assertEqual(len(set(builds)), len(builds))
+            plan = DataSource(EncodedSource.from_str(source_str)).plan()
+            self.assertEqual(set(plan.hashes()), set(builds))
+            self.assertEqual(set(plan.hashes()), backend.existing(plan.hashes()))
+
+    def test_waits_then_takes_over_stale_lease(self):
+        backend = InMemoryBackend()
+        leases = SQLiteLeaseStore(":memory:")
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 1)), backend)
+        root = datasource.plan().root()
+        leaf = datasource.plan().hashes()[0]
+        # a run that died while holding the lease on the leaf
+        leases.acquire(leaf, "dead", ttl=0.05)
+        catalog = SQLiteCatalog(":memory:")
+        tic = time.perf_counter()
+        built = datasource.build(leases=LeasedBuilder(leases, backend, owner="alive", poll_interval=0.01),
+                                 catalog=catalog)
+        self.assertGreaterEqual(time.perf_counter() - tic, 0.04)
+        self.assertEqual({leaf, root}, set(built))
+        self.assertIsNone(leases.holder(leaf))
+        self.assertEqual({leaf, root}, set(catalog.entries()))
+
+    def test_built_by_another_run(self):
+        backend = InMemoryBackend()
+        leases = SQLiteLeaseStore(":memory:")
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 1)), backend)
+        leaf = datasource.plan().hashes()[0]
+        leases.acquire(leaf, "other", ttl=60)
+        threading.Timer(0.03, lambda: backend.add(leaf)).start()
+        built = datasource.build(leases=LeasedBuilder(leases, backend, owner="me", poll_interval=0.01))
+        self.assertIsNone(built[leaf])
+        self.assertIsNotNone(built[datasource.plan().root()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import sys
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.backend import SQLiteBackend
+from src.bq.catalog import SQLiteCatalog
+from src.bq.data_source import DataSource
+from src.bq.lineage import SQLiteLineage, invalidate, lineage_edges, qualified_table
+from test.test_freshness import BRANCHES_SQL, events_backend, hashes_by_alias
+
+
+class Test(unittest.TestCase):
+
+    def test_lineage_edges(self):
+        datasource = DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"))
+        hashes = hashes_by_alias(datasource)
+        self.assertEqual({("main.events", hashes["cached_sales"]),
+                          (hashes["cached_sales"], hashes["cached_total"]),
+                          (hashes["cached_one"], hashes["cached_ones"]),
+                          (hashes["cached_total"], hashes[None]),
+                          (hashes["cached_ones"], hashes[None])},
+                         set(lineage_edges(datasource.plan())))
+
+    def test_qualified_table(self):
+        self.assertEqual("main.events", qualified_table("`main`.`events`"))
+        self.assertEqual("my-project.main.events", qualified_table("`main.events`", "my-project"))
+        self.assertEqual("other.main.events", qualified_table("`other`.main.events", "my-project"))
+
+    def test_invalidate_other_spelling(self):
+        backend = events_backend()
+        lineage = SQLiteLineage(":memory:", project="my-project")
+        datasource = DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"), backend)
+        datasource.build(lineage=lineage)
+        hashes = hashes_by_alias(datasource)
+        # the queries write main.events, the restatement names it with backticks and its project
+        self.assertEqual(sorted([hashes["cached_sales"], hashes["cached_total"], hashes[None]]),
+                         invalidate(backend, lineage, tables=["`my-project.main`.`events`"]))
+        self.assertEqual({hashes["cached_one"], hashes["cached_ones"]}, backend.existing(hashes.values()))
+
+    def test_downstream(self):
+        lineage = SQLiteLineage(":memory:")
+        lineage.record([("t", "a"), ("a", "b"), ("a", "c"), ("b", "d"), ("c", "d"), ("u", "e")])
+        lineage.record([("t", "a")])
+        self.assertEqual({"a", "b", "c", "d"}, lineage.downstream(["t"]))
+        self.assertEqual({"d"}, lineage.downstream(["b"]))
+        self.assertEqual({"a", "b", "c", "d", "e"}, lineage.downstream(["t", "u"]))
+        self.assertEqual(set(), lineage.downstream(["d", "unknown"]))
+        self.assertEqual(set(), lineage.downstream([]))
+
+    def test_diamonds_walked_once(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 40)))
+        plan = datasource.plan()
+        lineage = SQLiteLineage(":memory:")
+        lineage.record(lineage_edges(plan))
+        for hashed in plan.hashes():
+            self.assertEqual(plan.downstream([hashed]), lineage.downstream([hashed]))
+
+    def test_invalidate_restated_table(self):
+        backend = events_backend()
+        lineage = SQLiteLineage(":memory:")
+        catalog = SQLiteCatalog(":memory:")
+        datasource = DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"), backend)
+        datasource.build(catalog=catalog, lineage=lineage)
+        hashes = hashes_by_alias(datasource)
+
+        dropped = invalidate(backend, lineage, tables=["main.events"], catalog=catalog)
+        self.assertEqual(sorted([hashes["cached_sales"], hashes["cached_total"], hashes[None]]), dropped)
+        self.assertEqual({hashes["cached_one"], hashes["cached_ones"]}, backend.existing(hashes.values()))
+        self.assertEqual({hashes["cached_one"], hashes["cached_ones"]}, set(catalog.entries()))
+
+        backend.connection().execute("UPDATE events SET amount = 5")
+        backend.connection().commit()
+        self.assertEqual(set(dropped), set(datasource.build(catalog=catalog, lineage=lineage)))
+        self.assertEqual([(5, 1)], backend.connection().execute(f'SELECT * FROM "{hashes[None]}"').fetchall())
+
+    def test_failed_build_still_invalidated(self):
+        backend = SQLiteBackend()
+        lineage = SQLiteLineage(":memory:")
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 4)), backend)
+        plan = datasource.plan()
+
+        def build(hashed: str, sql: str) -> int:
+            if hashed == plan.root():
+                raise RuntimeError("failed on purpose")
+            return backend.materialize(hashed, sql)
+
+        with self.assertRaises(RuntimeError):
+            datasource.build(build_func=build, lineage=lineage)
+        built = backend.existing(plan.hashes())
+        self.assertEqual(set(plan.hashes()) - {plan.root()}, built)
+        invalidate(backend, lineage, hashes=[plan.hashes()[0]])
+        self.assertEqual(set(), backend.existing(plan.hashes()))
+
+    def test_invalidate_hash(self):
+        backend = events_backend()
+        lineage = SQLiteLineage(":memory:")
+        datasource = DataSource(EncodedSource.from_str(BRANCHES_SQL, prefix="cached_"), backend)
+        datasource.build(lineage=lineage)
+        hashes = hashes_by_alias(datasource)
+        self.assertEqual(sorted([hashes["cached_one"], hashes["cached_ones"], hashes[None]]),
+                         invalidate(backend, lineage, hashes=[hashes["cached_one"]]))
+        self.assertEqual([], invalidate(backend, lineage, tables=["other.table"]))
+        self.assertEqual({hashes["cached_sales"], hashes["cached_total"]}, backend.existing(hashes.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
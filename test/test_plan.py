@@ -0,0 +1,61 @@
+import sys
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.data_source import DataSource
+from src.bq.plan import ExecutionPlan
+
+
+class Test(unittest.TestCase):
+
+    def test_shared_nodes_applied_once(self):
+        # every diamond layer is referenced by every node of the next one
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 15)))
+        applied = []
+        plan = datasource.apply_dependency_first(lambda hashed, sql: applied.append(hashed))
+        self.assertEqual(len(set(applied)), len(applied))
+        self.assertEqual(plan.hashes(), applied)
+        self.assertEqual(datasource.encoded_source().hashed(), plan.root())
+        self.assertIs(plan, datasource.plan())
+
+    def test_edges(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("diamond", 9)))
+        plan = datasource.plan()
+        position = {hashed: index for index, hashed in enumerate(plan.hashes())}
+        for before, after in plan.edges():
+            self.assertLess(position[before], position[after])
+            self.assertIn(after, plan.dependents(before))
+            self.assertIn(before, plan.dependencies(after))
+        for node in plan:
+            self.assertEqual(set(node.dependency_hashes()), set(plan.dependencies(node.hashed())))
+
+    def test_subset(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 5)))
+        plan = datasource.plan()
+        subset = plan.subset(plan.hashes()[2:])
+        self.assertEqual(len(plan) - 2, len(subset))
+        self.assertEqual((), subset.dependencies(subset.hashes()[0]))
+        self.assertNotIn(plan.hashes()[0], subset)
+        self.assertEqual(plan.root(), subset.root())
+        self.assertEqual(0, len(ExecutionPlan([])))
+
+    def test_downstream(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("chain", 5)))
+        plan = datasource.plan()
+        hashes = plan.hashes()
+        self.assertEqual(set(hashes[2:]), plan.downstream([hashes[1]]))
+        self.assertEqual(set(), plan.downstream([plan.root(), "unknown"]))
+        diamond = DataSource(EncodedSource.from_str(synthetic_query("diamond", 9))).plan()
+        for hashed in diamond.hashes():
+            expected = {node.hashed() for node in diamond if _depends_on(diamond, node.hashed(), hashed)}
+            self.assertEqual(expected, diamond.downstream([hashed]))
+
+
+def _depends_on(plan: ExecutionPlan, hashed: str, dependency: str) -> bool:
+    return any(direct == dependency or _depends_on(plan, direct, dependency) for direct in plan.dependencies(hashed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import sys
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend
+from src.bq.data_source import DataSource
+from src.bq.planner import dry_run_plan, inlined_sql, format_bytes
+
+
+class Test(unittest.TestCase):
+
+    def test_inlined_sql(self):
+        plan = DataSource(EncodedSource.from_str(synthetic_query("chain", 3))).plan()
+        hashes = plan.hashes()
+        self.assertEqual(plan.node(hashes[0]).sql(), inlined_sql(plan, hashes[0], set()))
+        self.assertEqual(plan.node(hashes[1]).sql(), inlined_sql(plan, hashes[1], {hashes[0]}))
+        inlined = inlined_sql(plan, hashes[2], set())
+        self.assertTrue(inlined.startswith(f"WITH `{hashes[0]}` AS ("))
+        self.assertIn(f"`{hashes[1]}` AS (", inlined)
+        self.assertNotIn(f"`{hashes[2]}` AS (", inlined)
+
+    def test_nothing_cached(self):
+        plan = DataSource(EncodedSource.from_str(synthetic_query("diamond", 9))).plan()
+        dry_runs = []
+        backend = InMemoryBackend(dry_run_bytes=lambda sql: dry_runs.append(sql) or 100)
+        report = dry_run_plan(plan, backend)
+        self.assertEqual(plan.hashes(), report.missing())
+        self.assertEqual(len(plan), len(dry_runs))
+        # the root computes everything inline
+        self.assertEqual(100, report.total_to_build())
+        self.assertEqual(0, report.total_avoided())
+        self.assertIn(f"MISS <root> {plan.root()}", report.format())
+
+    def test_partly_cached(self):
+        plan = DataSource(EncodedSource.from_str(synthetic_query("chain", 4))).plan()
+        hashes = plan.hashes()
+        backend = InMemoryBackend(tables=hashes[:2], dry_run_bytes=len)
+        report = dry_run_plan(plan, backend)
+        # the cached node under the first missing one is estimated, nothing below it is touched
+        self.assertEqual(hashes[1:], [estimate.hashed() for estimate in report.estimates()])
+        self.assertEqual(hashes[2:], report.missing())
+        self.assertEqual(len(inlined_sql(plan, plan.root(), set(hashes[:2]))), report.total_to_build())
+        self.assertEqual(len(plan.node(hashes[1]).sql()), report.total_avoided())
+        self.assertTrue(report.format().splitlines()[3].strip().startswith(f"HIT  node_1 {hashes[1]}"))
+
+    def test_everything_cached(self):
+        plan = DataSource(EncodedSource.from_str(synthetic_query("fan_in", 5))).plan()
+        report = dry_run_plan(plan, InMemoryBackend(tables=plan.hashes()))
+        self.assertEqual([plan.root()], [estimate.hashed() for estimate in report.estimates()])
+        self.assertEqual(0, report.total_to_build())
+
+    def test_format_bytes(self):
+        self.assertEqual("512 B", format_bytes(512))
+        self.assertEqual("1.50 KiB", format_bytes(1536))
+        self.assertEqual("2.00 GiB", format_bytes(2 * 1024 ** 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
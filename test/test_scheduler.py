@@ -0,0 +1,61 @@
+import sys
+import unittest
+
+sys.path.append("..")
+from benchmark.generator import synthetic_query
+from src.source import EncodedSource
+from src.bq.backend import InMemoryBackend
+from src.bq.data_source import DataSource
+from src.bq.scheduler import NodeStats, CriticalPathScheduler, critical_path
+
+
+class Test(unittest.TestCase):
+
+    def test_node_stats(self):
+        stats = NodeStats(":memory:")
+        self.assertIsNone(stats.get("a"))
+        self.assertIsNone(stats.bytes_per_second())
+        stats.record("a", 2.0, 100)
+        stats.record("a", 4.0, 300)
+        stats.record("b", 1.0, 200)
+        self.assertEqual((3.0, 200), stats.get("a"))
+        self.assertEqual({"b": (1.0, 200)}, stats.known(["b", "c"]))
+        self.assertEqual(600 / 7.0, stats.bytes_per_second())
+
+    def test_critical_path(self):
+        plan = DataSource(EncodedSource.from_str(synthetic_query("chain", 3))).plan()
+        remaining = critical_path(plan, {hashed: 1.0 for hashed in plan.hashes()})
+        self.assertEqual([4.0, 3.0, 2.0, 1.0], [remaining[hashed] for hashed in plan.hashes()])
+
+    def test_longest_chain_starts_first(self):
+        datasource = DataSource(EncodedSource.from_str(synthetic_query("lopsided", 8)))
+        plan = datasource.plan()
+        nodes = {node.hashed(): node.alias() for node in plan}
+        stats = NodeStats(":memory:")
+        for hashed in plan.hashes():
+            stats.record(hashed, 1.0, 0)
+        started = []
+        datasource.apply_concurrently(lambda hashed, sql: started.append(nodes[hashed]), max_in_flight=1)
+        self.assertEqual("node_0", started[0])
+        started.clear()
+        datasource.apply_concurrently(lambda hashed, sql: started.append(nodes[hashed]), max_in_flight=1,
+                                      scheduler=CriticalPathScheduler(stats))
+        self.assertEqual(["node_4", "node_5", "node_6"], started[:3])
+        self.assertEqual(len(plan), len(started))
+
+    def test_cold_costs_from_dry_runs(self):
+        plan = DataSource(EncodedSource.from_str(synthetic_query("chain", 3))).plan()
+        hashes = plan.hashes()
+        stats = NodeStats(":memory:")
+        stats.record(hashes[0], 5.0, 50)
+        scheduler = CriticalPathScheduler(stats, backend=InMemoryBackend(dry_run_bytes=len))
+        costs = scheduler.costs(plan)
+        self.assertEqual(5.0, costs[hashes[0]])
+        # the recorded throughput of 10 bytes a second turns each node's own share of its dry run into seconds
+        for hashed in hashes[1:]:
+            self.assertGreater(costs[hashed], 0)
+        self.assertEqual(1.0, CriticalPathScheduler(NodeStats(":memory:")).costs(plan)[hashes[1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
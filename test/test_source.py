@@ -1,4 +1,5 @@
 import sys
+import time
 import unittest
 
 import sqlparse
@@ -7,7 +8,21 @@ from resources.test_source_sql import complex_query, basic_str, basic_whitespace
     date_dim_query, settings, planning_date_dim_table, planning_week_dim_table, weeks, date_dim_select, date_dim_query_sub_cached
 
 sys.path.append("..")
-from src.source import Source, EncodedSource, ParsedSource, DecomposedSource
+from benchmark.generator import synthetic_query
+from src.source import Source, EncodedSource, ParsedSource, DecomposedSource, parse_normalized, parse_scope, \
+    node_key, ReachabilityIndex, DependencyGraph, CycleError
+
+
+def unique_dependencies(decomposed_source: DecomposedSource) -> list:
+    unique = {}
+    pending = [decomposed_source]
+    while pending:
+        for dependency_map in pending.pop().dependencies():
+            for dependency in dependency_map.values():
+                if id(dependency) not in unique:
+                    unique[id(dependency)] = dependency
+                    pending.append(dependency)
+    return list(unique.values())
 
 
 class Test(unittest.TestCase):
@@ -29,6 +44,22 @@ class Test(unittest.TestCase):
         self.assertEqual(source_str, parsed.source().source())
         self.assertNotEqual(source_str, parsed.parsed_statements())
 
+    def test_parse_cache(self):
+        with parse_scope():
+            parsed = ParsedSource(Source(cte_1))
+            parsed_again = ParsedSource(Source(cte_1))
+            # identical text is lexed once within a scope and shares the grouped statements
+            self.assertIs(parsed.parsed_statements()[0], parsed_again.parsed_statements()[0])
+            # the normalized text maps to the same statements as the raw text
+            self.assertIs(parse_normalized(str(parsed.parsed_statements()[0]))[0], parsed.parsed_statements()[0])
+        # the cache went with the scope
+        self.assertIsNot(ParsedSource(Source(cte_1)).parsed_statements()[0], parsed.parsed_statements()[0])
+
+    def test_parse_normalizes_comments(self):
+        source_str = "SELECT a -- first\n  , b /* second */ FROM-- third\n`universe.galaxy.system`"
+        parsed = ParsedSource(Source(source_str))
+        self.assertEqual("SELECT a , b FROM `universe.galaxy.system`", str(parsed.parsed_statements()[0]))
+
     def test_decompose(self):
         source_str = cte_1
         parsed_source = ParsedSource(Source(source_str))
@@ -152,6 +183,141 @@ class Test(unittest.TestCase):
         self.assertIsNotNone(encoded_source_2)
         self.assertEqual(encoded_source.encoded_sources(), encoded_source_2.encoded_sources())
 
+    def test_merkle_keys(self):
+        encoded = EncodedSource.from_str(basic_str)
+        decomposed = encoded.decomposed_source()
+        hashed_cte_1 = EncodedSource.from_str(cte_1).hashed_sources()[-1]
+        hashed_cte_2 = EncodedSource.from_str(cte_2).hashed_sources()[-1]
+        # a node is identified by its own body and the keys of its children, no rendering needed
+        self.assertEqual((("cte", hashed_cte_1), ("cte2", hashed_cte_2)), encoded.child_hashes()[-1])
+        expected = node_key(decomposed.parsed_sources()[-1].serialize(), [("cte2", hashed_cte_2), ("cte", hashed_cte_1)])
+        self.assertEqual(expected, encoded.hashed_sources()[-1])
+
+    def test_merkle_keys_change_with_children(self):
+        encoded = EncodedSource.from_str(basic_str)
+        changed = EncodedSource.from_str(basic_str.replace("country.state.city", "country.state.town"))
+        # cte is untouched, cte2 and the final join depend on the changed text
+        self.assertEqual(encoded.hashed_sources()[0], changed.hashed_sources()[0])
+        self.assertNotEqual(encoded.hashed_sources()[1], changed.hashed_sources()[1])
+        self.assertNotEqual(encoded.hashed_sources()[-1], changed.hashed_sources()[-1])
+        self.assertEqual(encoded.decomposed_source().parsed_sources()[-1].serialize(),
+                         changed.decomposed_source().parsed_sources()[-1].serialize())
+
+    def test_dependencies_case_insensitive_and_quoted(self):
+        source_str = """
+            WITH Settings AS (SELECT 2019 AS start_year),
+            dates AS (SELECT * FROM settings),
+            quoted AS (SELECT * FROM `DATES` CROSS JOIN `Settings`),
+            unrelated AS (SELECT 'settings' AS label, other.dates FROM `universe.galaxy.system` AS other)
+            SELECT * FROM quoted, unrelated
+        """
+        decomposed_source = DecomposedSource(ParsedSource(Source(source_str)))
+        dependencies = [list(dependency_map.keys()) for dependency_map in decomposed_source.dependencies()]
+        # dependencies are reported by their declared alias, however they are referenced
+        self.assertEqual([[], ["Settings"], ["dates", "Settings"], [], ["quoted", "unrelated"]], dependencies)
+
+    def test_decompose_diamond_benchmark(self):
+        depth, width = 10, 3
+        # every CTE in a layer reads every CTE of the layer before it, so there are width ** depth paths
+        source_str = synthetic_query("diamond", depth * width, width=width)
+        tic = time.perf_counter()
+        decomposed_source = DecomposedSource(ParsedSource(Source(source_str)))
+        root_key = decomposed_source.key()
+        toc = time.perf_counter()
+        print(f"decomposed diamond depth:{depth} width:{width} in {toc - tic:.3f} seconds")
+        # one node per CTE instead of one per path (width ** depth of them)
+        nodes = unique_dependencies(decomposed_source)
+        self.assertEqual(depth * width, len(nodes))
+        self.assertEqual(depth * width, len({node.alias() for node in nodes}))
+        self.assertEqual(root_key, DecomposedSource(ParsedSource(Source(source_str))).key())
+        self.assertLess(toc - tic, 10.0)
+
+    def test_reachability(self):
+        decomposed_source = DecomposedSource(ParsedSource(Source(date_dim_query)))
+        nodes = {node.alias(): node for node in unique_dependencies(decomposed_source)}
+        reachability = ReachabilityIndex(decomposed_source)
+        self.assertTrue(reachability.depends_on(nodes["weeks"], nodes["planning_date_dim_table"]))
+        self.assertTrue(reachability.depends_on(nodes["weeks"], nodes["planning_week_dim_table"]))
+        self.assertFalse(reachability.depends_on(nodes["planning_date_dim_table"], nodes["weeks"]))
+        self.assertFalse(reachability.depends_on(nodes["weeks"], nodes["weeks"]))
+        self.assertEqual(nodes["weeks"].has_dependency(nodes["planning_date_dim_table"]),
+                         reachability.depends_on(nodes["weeks"], nodes["planning_date_dim_table"]))
+        self.assertFalse(nodes["weeks"].has_dependency(nodes["planning_date_dim_table"], recurse=False))
+
+    def test_transitive_dependencies(self):
+        decomposed_source = DecomposedSource(ParsedSource(Source(synthetic_query("diamond", 8, width=2))))
+        root = next(node for node in unique_dependencies(decomposed_source) if node.alias() == "node_6")
+        direct_dependencies = list(root.dependencies())
+        closure = list(root.transitive_dependencies())
+        # each node once, dependencies first, and the node's own dependency list left untouched
+        self.assertEqual(6, len(closure))
+        self.assertEqual(len(closure), len({id(node) for node in closure}))
+        for idx, node in enumerate(closure):
+            for dependency in node.transitive_dependencies():
+                self.assertIn(dependency, closure[:idx])
+        self.assertEqual(direct_dependencies, root.dependencies())
+        self.assertEqual(closure, list(root.transitive_dependencies()))
+
+    def test_transitive_dependencies_lazy(self):
+        decomposed_source = DecomposedSource(ParsedSource(Source(synthetic_query("diamond", 12, width=2))))
+        nodes = {node.alias(): node for node in unique_dependencies(decomposed_source)}
+        closure = nodes["node_10"].transitive_dependencies()
+        self.assertIn(nodes["node_8"], closure)
+        self.assertFalse(closure.complete())
+        first = next(iter(closure))
+        self.assertEqual("node_0", first.alias())
+        self.assertNotIn(nodes["node_11"], closure)
+        self.assertTrue(closure.complete())
+
+    def test_dependency_graph_levels(self):
+        graph = DependencyGraph()
+        for vertex in ["weeks", "settings", "planning_week_dim_table", "planning_date_dim_table", "sales"]:
+            graph.add_vertex(vertex)
+        graph.add_edge("planning_date_dim_table", "planning_week_dim_table")
+        graph.add_edge("planning_week_dim_table", "weeks")
+        graph.add_edge("settings", "weeks")
+        graph.add_edge("weeks", "sales")
+        graph.add_edge("settings", "sales")
+        self.assertEqual([["settings", "planning_date_dim_table"], ["planning_week_dim_table"], ["weeks"], ["sales"]],
+                         graph.levels())
+        self.assertEqual(["settings", "planning_date_dim_table", "planning_week_dim_table", "weeks", "sales"],
+                         graph.topological_sort())
+
+    def test_dependency_graph_deep_chain(self):
+        graph = DependencyGraph()
+        depth = sys.getrecursionlimit() * 5
+        for vertex in range(depth - 1):
+            graph.add_edge(vertex, vertex + 1)
+        self.assertEqual(list(range(depth)), graph.topological_sort())
+        self.assertEqual(depth, len(graph.levels()))
+
+    def test_dependency_graph_cycle(self):
+        graph = DependencyGraph()
+        graph.add_edge("settings", "a")
+        graph.add_edge("a", "b")
+        graph.add_edge("b", "c")
+        graph.add_edge("c", "a")
+        graph.add_edge("c", "downstream")
+        with self.assertRaises(CycleError) as context:
+            graph.levels()
+        self.assertEqual(["a", "b", "c"], context.exception.aliases)
+
+    def test_encode_cycle(self):
+        with self.assertRaises(CycleError) as context:
+            EncodedSource.from_str("WITH a AS (SELECT * FROM b), b AS (SELECT * FROM a) SELECT * FROM a")
+        self.assertEqual({"a", "b"}, set(context.exception.aliases))
+
+    def test_encode_diamond_benchmark(self):
+        depth, width = 35, 3
+        source_str = synthetic_query("diamond", depth * width, width=width)
+        for prefix in ["", "cached_"]:
+            tic = time.perf_counter()
+            encoded_source = EncodedSource.from_str(source_str, prefix=prefix)
+            toc = time.perf_counter()
+            print(f"encoded diamond depth:{depth} width:{width} prefix:{prefix} in {toc - tic:.3f} seconds")
+            self.assertEqual(depth * width + 1, len(encoded_source.hashed_sources()))
+            self.assertLess(toc - tic, 10.0)
+
     def test_cte_date_dim_encode_cached(self):
         source_str = basic_str
         encoded_source_root = EncodedSource.from_str(source_str, prefix="cached_")
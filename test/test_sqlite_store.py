@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append("..")
+from src.sqlite_store import SQLiteStore, SELECT_BATCH
+
+
+class Test(unittest.TestCase):
+
+    def test_creates_directory_and_schema(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "nested", "store.db")
+            store = SQLiteStore(path, ["CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY)"])
+            self.assertEqual(path, store.path())
+            store.close()
+            # opening again keeps what is there
+            SQLiteStore(path, ["CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY)"]).close()
+            self.assertTrue(os.path.exists(path))
+
+    def test_select_in_batches(self):
+        store = SQLiteStore(":memory:", ["CREATE TABLE keys (key TEXT PRIMARY KEY)"])
+        keys = [str(key) for key in range(2 * SELECT_BATCH + 1)]
+        store._connection.executemany("INSERT INTO keys VALUES (?)", [(key,) for key in keys[::2]])
+        rows = store._select_in("SELECT key FROM keys WHERE key IN ({})", keys)
+        self.assertEqual(set(keys[::2]), {row[0] for row in rows})
+        self.assertEqual([], store._select_in("SELECT key FROM keys WHERE key IN ({})", []))
+
+
+if __name__ == '__main__':
+    unittest.main()